@@ -1,11 +1,23 @@
 import os
 
 from flask import Flask
+from werkzeug.utils import import_string
 
+from modules.addresses import address_index
+from modules.archive import archive
+from modules.async_delivery import async_delivery
+from modules.bodies import message_bodies
+from modules.delivery import delivery_queue
+from modules.events import status_events
 from modules.extensions import db, mail
-from modules.mail import mail_bp
-from modules.user import user_bp
-from modules.attachment import attachment_bp
+from modules import migrations, prefork, search
+from modules.lookup import clear_lookup_cache
+from modules.metrics import metrics
+from modules.mime import attachment_cache
+from modules.render_pool import render_pool
+from modules.resource_cache import resource_cache
+from modules.smtp import smtp_pool
+from modules.storage import sqlite_storage
 
 
 def create_app(test_config=None):
@@ -25,7 +37,87 @@ def create_app(test_config=None):
         MAIL_DEFAULT_SENDER=None,
         MAIL_MAX_EMAILS=None,
         MAIL_SUPPRESS_SEND=app.testing,
-        MAIL_ASCII_ATTACHMENTS=False)
+        MAIL_ASCII_ATTACHMENTS=False,
+        # 'production': WAL, synchronous=NORMAL, busy timeout and pooled
+        # connections, for many workers sharing the database file
+        SQLITE_PROFILE=None,
+        SQLITE_BUSY_TIMEOUT=5000,  # milliseconds
+        SQLITE_POOL_SIZE=5,
+        SQLITE_MAX_OVERFLOW=10,
+        DELIVERY_WORKERS=4,  # 0 sends pending emails inside the request
+        DELIVERY_BATCH_SIZE=100,
+        # share of every batch per priority, {1: 16, 2: 8, 3: 4, 4: 2, 5: 1}
+        DELIVERY_PRIORITY_WEIGHTS=None,
+        # {'domain': (envelopes per second, burst)}, default for other domains
+        DELIVERY_DOMAIN_RATES=None,
+        DELIVERY_DEFAULT_DOMAIN_RATE=None,
+        DELIVERY_MAX_RECIPENTS=100,  # RCPT TO in one SMTP transaction
+        # emails with the same sender and content are rendered once
+        # and sent together, with undisclosed recipients
+        DELIVERY_MERGE_IDENTICAL=False,
+        # statuses of all sending threads are committed together,
+        # waiting at most DELIVERY_GROUP_COMMIT_WINDOW seconds for each other
+        DELIVERY_GROUP_COMMIT=False,
+        DELIVERY_GROUP_COMMIT_WINDOW=0.005,
+        DELIVERY_GROUP_COMMIT_MAX_ROWS=1000,
+        # temporary failures are retried after DELIVERY_RETRY_BASE seconds,
+        # doubled every attempt up to DELIVERY_RETRY_MAX, then email is 'dead'
+        DELIVERY_MAX_ATTEMPTS=5,
+        DELIVERY_RETRY_BASE=60,
+        DELIVERY_RETRY_MAX=3600,
+        # 'sending' emails claimed this many seconds ago are claimed again
+        DELIVERY_CLAIM_TIMEOUT=900,
+        # sent emails older than this are moved to archive tables by
+        # 'flask archive-emails', ARCHIVE_BATCH_SIZE in one transaction
+        ARCHIVE_AFTER_DAYS=30,
+        ARCHIVE_BATCH_SIZE=1000,
+        SMTP_POOL_SIZE=8,  # 0 opens new SMTP connection for every email
+        SMTP_TIMEOUT=30,  # seconds, of every step of SMTP sessions
+        # connection failures in a row after which sending fails at once,
+        # for SMTP_BREAKER_RESET seconds, 0 never stops trying
+        SMTP_BREAKER_THRESHOLD=5,
+        SMTP_BREAKER_RESET=30,
+        # send_now returns 202 'sending' and SMTP runs on an event loop,
+        # not with MAIL_USE_TLS (STARTTLS)
+        SEND_NOW_ASYNC=False,
+        SEND_NOW_ASYNC_CONCURRENCY=1000,  # SMTP sessions at once
+        PAGE_SIZE=100,  # default limit of listings
+        MAX_PAGE_SIZE=1000,
+        MAX_BATCH_SIZE=10000,  # emails in one POST /emails/batch
+        ATTACHMENTS_DIR='attachments',
+        ATTACHMENT_CACHE_BYTES=64 * 1024 * 1024,  # encoded attachments
+        # bodies this big are stored zlib compressed and once per content,
+        # loaded only for GET /email/<id> and sending
+        MESSAGE_BODY_MIN_BYTES=64 * 1024,
+        MESSAGE_BODY_COMPRESS_LEVEL=6,
+        MESSAGE_BODY_CACHE_SIZE=64,  # decompressed bodies kept per process
+        # processes rendering messages with big attachments, 0 renders
+        # them in the sending thread
+        MIME_RENDER_PROCESSES=0,
+        MIME_RENDER_MIN_BYTES=1024 * 1024,  # attachments size worth a process
+        RESOURCE_CACHE_SIZE=10000,  # serialized emails and users, 0 disables
+        RESOURCE_CACHE_TTL=30,  # seconds, bounds staleness between processes
+        ADDRESS_CACHE_SIZE=10000,  # address -> user id of hot users
+        METRICS_ENABLED=True,  # request, query and SMTP metrics at /metrics
+        EVENTS_BUFFER_SIZE=10000,  # recent status events for Last-Event-ID
+        EVENTS_QUEUE_SIZE=1000,  # unsent events of a slow client, then closed
+        EVENTS_KEEPALIVE=15,  # seconds between comments on idle streams
+        # streams are closed after this and clients reconnect, so long
+        # connections do not stay on one worker forever
+        EVENTS_STREAM_SECONDS=300,
+        # open streams per process, each holds a thread of a gthread worker
+        # (half of gunicorn.conf.py threads), gunicorn_events.conf.py raises
+        # it for gevent workers
+        EVENTS_MAX_STREAMS=int(os.environ.get('EVENTS_MAX_STREAMS', 16)),
+        EVENTS_RETRY_AFTER=5,  # seconds, Retry-After of refused streams
+        # False skips db.create_all and migrations on start, run
+        # 'flask migrate-db' once instead of in every worker
+        SCHEMA_SETUP=True,
+        # imported only here, 'module:blueprint'
+        BLUEPRINTS=[
+            'modules.mail:mail_bp', 'modules.user:user_bp',
+            'modules.attachment:attachment_bp', 'modules.metrics:metrics_bp'
+        ])
 
     if test_config is None:
         app.config.from_pyfile('config.py', silent=True)
@@ -33,12 +125,29 @@ def create_app(test_config=None):
         app.config.from_mapping(test_config)
 
     db.init_app(app)
+    sqlite_storage.init_app(app)
     mail.init_app(app)
+    metrics.init_app(app)
+    smtp_pool.init_app(app)
+    attachment_cache.init_app(app)
+    render_pool.init_app(app)
+    resource_cache.init_app(app)
+    address_index.init_app(app)
+    delivery_queue.init_app(app)
+    async_delivery.init_app(app)
+    archive.init_app(app)
+    message_bodies.init_app(app)
+    status_events.init_app(app)
+    app.teardown_request(clear_lookup_cache)
+    migrations.init_app(app)
+    search.init_app(app)
+    prefork.register(app)  # worker state is reset after fork
 
     with app.app_context():
-        db.create_all()  # create database with app context
-        app.register_blueprint(mail_bp)
-        app.register_blueprint(user_bp)
-        app.register_blueprint(attachment_bp)
+        if app.config['SCHEMA_SETUP']:
+            db.create_all()  # create database with app context
+            migrations.upgrade(db.engine)  # update existing database
+        for blueprint in app.config['BLUEPRINTS']:
+            app.register_blueprint(import_string(blueprint))
 
     return app
@@ -0,0 +1,346 @@
+"""
+benchmark of the main endpoints against a seeded temporary database
+
+    python benchmarks/bench.py --emails 10000 --output results.json
+    python benchmarks/bench.py --compare results.json  # exit 1 on regression
+
+every run creates new sqlite database and attachments directory in a temp
+dir, seeds it with random (but seeded, so reproducible) users, emails and
+attachments and sends through a local stub SMTP server. Requests go through
+flask test client, so numbers are of the app itself, without HTTP server
+"""
+import argparse
+import io
+import json
+import math
+import os
+import platform
+import random
+import string
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'tests'))
+
+from application import create_app  # noqa: E402
+from modules.database import Email, EmailUser, recipents_rels  # noqa: E402
+from modules.delivery import delivery_queue  # noqa: E402
+from modules.extensions import db  # noqa: E402
+from smtp_stub import SMTPStub  # noqa: E402
+
+SCENARIOS = ('post_email', 'get_email', 'list_emails', 'flush_pending',
+             'post_file')
+
+
+def random_text(rng, length):
+    return ''.join(rng.choice(string.ascii_lowercase + ' ')
+                   for _ in range(length))
+
+
+def percentile(values, p):
+    # nearest-rank percentile of sorted values
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def summarize(latencies, items=None):
+    """
+    throughput and latency in milliseconds of timed requests,
+    items is number of processed things if it differs from requests
+    """
+    latencies = sorted(latencies)
+    total = sum(latencies)
+    result = {
+        'requests': len(latencies),
+        'seconds': round(total, 6),
+        'requests_per_second': round(len(latencies) / total, 2),
+        'mean_ms': round(total / len(latencies) * 1000, 3),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+        'max_ms': round(latencies[-1] * 1000, 3),
+    }
+    if items is not None:
+        result['items'] = items
+        result['items_per_second'] = round(items / total, 2)
+    return result
+
+
+def timed(call):
+    start = time.perf_counter()
+    response = call()
+    elapsed = time.perf_counter() - start
+    if response.status_code >= 400:
+        raise RuntimeError(
+            f'{response.status_code} {response.get_data(as_text=True)}')
+    return elapsed, response
+
+
+def insert_emails(rng, user_ids, count, status, recipents=3):
+    """
+    executemany insert of emails with random recipents, returns their ids
+    """
+    start = datetime.utcnow() - timedelta(days=30)
+    rows = [{
+        'subject': random_text(rng, 30),
+        'message': random_text(rng, 500),
+        'status': status,
+        'priority': rng.randint(1, 5),
+        'sender_id': rng.choice(user_ids),
+        'pub_date': start + timedelta(seconds=i)
+    } for i in range(count)]
+    db.session.execute(Email.__table__.insert(), rows)
+    last_id = db.session.query(db.func.max(Email.id)).scalar()
+    email_ids = list(range(last_id - count + 1, last_id + 1))
+    links = []
+    for email_id in email_ids:
+        links.extend({
+            'email_id': email_id,
+            'recipent_id': recipent_id,
+            'status': status
+        } for recipent_id in rng.sample(user_ids, recipents))
+    db.session.execute(recipents_rels.insert(), links)
+    db.session.commit()
+    return email_ids
+
+
+def seed(rng, users, emails, attachments, attachment_size):
+    domains = [f'domain{i}.test' for i in range(max(1, users // 50))]
+    db.session.execute(EmailUser.__table__.insert(), [{
+        'email_address': f'user{i}@{rng.choice(domains)}'
+    } for i in range(users)])
+    db.session.commit()
+    user_ids = [row.id for row in db.session.query(EmailUser.id)]
+    email_ids = insert_emails(rng, user_ids, emails, 'sent')
+
+    # attachments are stored by the app itself, as uploaded files would be
+    from werkzeug.datastructures import FileStorage
+    from modules.attachment import AttachmentResource
+    uploader = AttachmentResource()
+    for i in range(attachments):
+        data = rng.getrandbits(8 * attachment_size).to_bytes(
+            attachment_size, 'little')
+        uploader.save_attachment(
+            FileStorage(io.BytesIO(data),
+                        filename=f'seed{i}.bin',
+                        content_type='application/octet-stream'))
+    return user_ids, email_ids
+
+
+def bench_post_email(client, rng, user_ids, args):
+    latencies = []
+    for _ in range(args.requests):
+        body = {
+            'sender': rng.choice(user_ids),
+            'receipents': rng.sample(user_ids, 3),
+            'subject': random_text(rng, 30),
+            'message': random_text(rng, 500)
+        }
+        elapsed, _ = timed(lambda: client.post('/email', json=body))
+        latencies.append(elapsed)
+    return summarize(latencies)
+
+
+def bench_get_email(client, rng, email_ids, args):
+    latencies = []
+    for _ in range(args.requests):
+        email_id = rng.choice(email_ids)
+        elapsed, _ = timed(lambda: client.get(f'/email/{email_id}'))
+        latencies.append(elapsed)
+    return summarize(latencies)
+
+
+def bench_list_emails(client, args):
+    # walks the listing page by page, starting again at the end
+    latencies = []
+    rows = 0
+    cursor = None
+    for _ in range(args.requests):
+        url = f'/emails?limit={args.page_size}'
+        if cursor:
+            url += f'&cursor={cursor}'
+        elapsed, response = timed(lambda: client.get(url))
+        latencies.append(elapsed)
+        rows += len(response.get_json())
+        cursor = response.headers.get('X-Next-Cursor')
+    return summarize(latencies, items=rows)
+
+
+def bench_flush_pending(client, rng, user_ids, args):
+    latencies = []
+    sent = 0
+    for _ in range(max(1, args.requests // 10)):
+        # pending emails are created outside of the measured time
+        insert_emails(rng, user_ids, args.flush_size, 'pending')
+        start = time.perf_counter()
+        _, response = timed(lambda: client.post('/emails'))
+        job_id = response.get_json().get('job_id')
+        job = job_id and delivery_queue.get_job(job_id)
+        # with background workers the request only starts the job
+        while job and job.status != 'done':
+            time.sleep(0.001)
+        elapsed = time.perf_counter() - start
+        sent += job.sent if job else 0
+        latencies.append(elapsed)
+    return summarize(latencies, items=sent)
+
+
+def bench_post_file(client, rng, args):
+    latencies = []
+    for i in range(args.requests):
+        data = rng.getrandbits(8 * args.attachment_size).to_bytes(
+            args.attachment_size, 'little')
+        files = {'attachment': (io.BytesIO(data), f'upload{i}.bin')}
+        elapsed, _ = timed(lambda: client.post(
+            '/file', data=files, content_type='multipart/form-data'))
+        latencies.append(elapsed)
+    return summarize(latencies)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       cwd=ROOT,
+                                       stderr=subprocess.DEVNULL,
+                                       text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    rng = random.Random(args.seed)
+    smtp_server = SMTPStub().start()
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            app = create_app(
+                test_config={
+                    'SQLALCHEMY_DATABASE_URI': 'sqlite:///' +
+                    os.path.join(tmp_dir, 'bench.db'),
+                    'SQLALCHEMY_TRACK_MODIFICATIONS': False,
+                    'ATTACHMENTS_DIR': os.path.join(tmp_dir, 'attachments'),
+                    'MAIL_SERVER': '127.0.0.1',
+                    'MAIL_PORT': smtp_server.port,
+                    'MAIL_SUPPRESS_SEND': False,
+                    'DELIVERY_WORKERS': args.workers
+                })
+            with app.app_context():
+                seed_start = time.perf_counter()
+                user_ids, email_ids = seed(rng, args.users, args.emails,
+                                           args.attachments,
+                                           args.attachment_size)
+                seed_seconds = time.perf_counter() - seed_start
+                client = app.test_client()
+                benchmarks = {
+                    'post_email':
+                    lambda: bench_post_email(client, rng, user_ids, args),
+                    'get_email':
+                    lambda: bench_get_email(client, rng, email_ids, args),
+                    'list_emails':
+                    lambda: bench_list_emails(client, args),
+                    'flush_pending':
+                    lambda: bench_flush_pending(client, rng, user_ids, args),
+                    'post_file':
+                    lambda: bench_post_file(client, rng, args),
+                }
+                results = {
+                    name: benchmarks[name]()
+                    for name in args.scenarios
+                }
+                db.session.remove()
+    finally:
+        smtp_server.stop()
+
+    return {
+        'meta': {
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'date': datetime.utcnow().isoformat(),
+            'seed_seconds': round(seed_seconds, 3),
+            'smtp_messages': len(smtp_server.messages),
+            'params': {
+                key: getattr(args, key)
+                for key in ('users', 'emails', 'attachments',
+                            'attachment_size', 'requests', 'page_size',
+                            'flush_size', 'workers', 'seed')
+            }
+        },
+        'results': results
+    }
+
+
+def compare(results, baseline, threshold):
+    """
+    returns list of regressions: throughput lower or p99 higher than
+    in baseline by more than threshold (0.2 is 20%)
+    """
+    regressions = []
+    for name, result in results['results'].items():
+        before = baseline['results'].get(name)
+        if not before:
+            continue
+        if result['requests_per_second'] < before['requests_per_second'] * (
+                1 - threshold):
+            regressions.append(
+                f"{name}: {result['requests_per_second']} req/s, "
+                f"was {before['requests_per_second']}")
+        if result['p99_ms'] > before['p99_ms'] * (1 + threshold):
+            regressions.append(
+                f"{name}: p99 {result['p99_ms']} ms, was {before['p99_ms']}")
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--emails', type=int, default=10000)
+    parser.add_argument('--attachments', type=int, default=100)
+    parser.add_argument('--attachment-size', type=int, default=16 * 1024)
+    parser.add_argument('--requests',
+                        type=int,
+                        default=500,
+                        help='timed requests per scenario')
+    parser.add_argument('--page-size', type=int, default=100)
+    parser.add_argument('--flush-size',
+                        type=int,
+                        default=100,
+                        help='pending emails sent by one POST /emails')
+    parser.add_argument('--workers',
+                        type=int,
+                        default=0,
+                        help='DELIVERY_WORKERS, 0 sends inside the request')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--scenarios',
+                        nargs='+',
+                        choices=SCENARIOS,
+                        default=list(SCENARIOS))
+    parser.add_argument('--output', help='write results json to the file')
+    parser.add_argument('--compare',
+                        help='baseline results json, exit 1 on regression')
+    parser.add_argument('--threshold', type=float, default=0.2)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = run(args)
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            fp.write(output)
+    print(output)
+
+    if args.compare:
+        with open(args.compare) as fp:
+            regressions = compare(results, json.load(fp), args.threshold)
+        for regression in regressions:
+            print(f'Regression {regression}', file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
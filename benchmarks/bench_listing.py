@@ -0,0 +1,101 @@
+"""
+rows per second of email listing serialization, ORM objects + stdlib json
+(as GET /emails used to work) against projected rows + json_backend
+
+    python benchmarks/bench_listing.py --emails 20000 --page-size 1000
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench import seed  # noqa: E402 (also puts the repo on sys.path)
+from application import create_app  # noqa: E402
+from modules.database import Email  # noqa: E402
+from modules.extensions import db  # noqa: E402
+from modules.json_backend import BACKEND, dumps  # noqa: E402
+from modules.mail import MailList  # noqa: E402
+from modules.pagination import paginate  # noqa: E402
+
+
+def orm_page(resource, cursor, page_size):
+    # recipents are loaded by lazy='subquery' of Email.recipents
+    emails, cursor = paginate(Email.query, [Email.id], cursor, page_size)
+    body = json.dumps([resource.serialize_email(email) for email in emails])
+    return len(emails), body, cursor
+
+
+def projected_page(resource, cursor, page_size):
+    rows, cursor = paginate(resource.listing_query(), [Email.id], cursor,
+                            page_size)
+    serialize = resource.serialize_row
+    body = dumps([serialize(row) for row in rows])
+    return len(rows), body, cursor
+
+
+def rows_per_second(page, resource, page_size, repeats):
+    """
+    median over repeats of walking the whole listing page by page
+    """
+    rates = []
+    for _ in range(repeats):
+        db.session.expunge_all()
+        rows = 0
+        cursor = None
+        start = time.perf_counter()
+        while True:
+            count, _, cursor = page(resource, cursor, page_size)
+            rows += count
+            if not cursor:
+                break
+        rates.append(rows / (time.perf_counter() - start))
+    return round(statistics.median(rates), 1)
+
+
+def run(args):
+    rng = random.Random(args.seed)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        app = create_app(
+            test_config={
+                'SQLALCHEMY_DATABASE_URI': 'sqlite:///' +
+                os.path.join(tmp_dir, 'bench.db'),
+                'SQLALCHEMY_TRACK_MODIFICATIONS': False,
+                'ATTACHMENTS_DIR': os.path.join(tmp_dir, 'attachments'),
+                'MAX_PAGE_SIZE': args.page_size
+            })
+        with app.app_context():
+            seed(rng, args.users, args.emails, 0, 0)
+            resource = MailList()
+            before = rows_per_second(orm_page, resource, args.page_size,
+                                     args.repeats)
+            after = rows_per_second(projected_page, resource, args.page_size,
+                                    args.repeats)
+            db.session.remove()
+    return {
+        'emails': args.emails,
+        'page_size': args.page_size,
+        'json_backend': BACKEND,
+        'orm_rows_per_second': before,
+        'projected_rows_per_second': after,
+        'speedup': round(after / before, 2)
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--emails', type=int, default=20000)
+    parser.add_argument('--page-size', type=int, default=1000)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    print(json.dumps(run(parser.parse_args(argv)), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""
+startup time of the app, with and without schema setup and with preload
+
+    python benchmarks/bench_startup.py --repeats 10
+
+every run is a new python process importing and creating the app against
+an existing database, as a recycled gunicorn worker without preload does.
+'fork' is the time of a worker forked from a process with the app already
+created (preload), until its per process state is reset
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from application import create_app  # noqa: E402
+
+STARTUP = """
+import sys, time
+start = time.perf_counter()
+sys.path.insert(0, {root!r})
+from application import create_app
+imported = time.perf_counter()
+app = create_app(test_config={config!r})
+print(imported - start, time.perf_counter() - imported)
+"""
+
+
+def start_seconds(config):
+    """
+    (import seconds, create_app seconds) in a new process
+    """
+    script = STARTUP.format(root=ROOT, config=config)
+    output = subprocess.run([sys.executable, '-c', script],
+                            check=True,
+                            stdout=subprocess.PIPE,
+                            universal_newlines=True).stdout
+    imported, created = output.split()[-2:]
+    return float(imported), float(created)
+
+
+def fork_seconds(config):
+    app = create_app(test_config=config)
+    read, write = os.pipe()
+    start = time.perf_counter()
+    pid = os.fork()
+    if pid == 0:  # child, state is reset by modules.prefork
+        os.write(write, str(time.perf_counter() - start).encode())
+        os._exit(0)
+    os.waitpid(pid, 0)
+    seconds = float(os.read(read, 64))
+    os.close(read)
+    os.close(write)
+    del app
+    return seconds
+
+
+def run(args):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        config = {
+            'SQLALCHEMY_DATABASE_URI':
+            'sqlite:///' + os.path.join(tmp_dir, 'bench.db'),
+            'SQLALCHEMY_TRACK_MODIFICATIONS': False
+        }
+        start_seconds(config)  # creates the schema
+        lazy = dict(config, SCHEMA_SETUP=False)
+        with_setup = [start_seconds(config) for _ in range(args.repeats)]
+        without_setup = [start_seconds(lazy) for _ in range(args.repeats)]
+        results = {
+            'import': [imported for imported, _ in with_setup + without_setup],
+            'create_app_schema_setup': [created for _, created in with_setup],
+            'create_app_no_schema_setup':
+            [created for _, created in without_setup]
+        }
+        if hasattr(os, 'fork'):
+            results['fork'] = [
+                fork_seconds(lazy) for _ in range(args.repeats)
+            ]
+    return {
+        name: {
+            'median_ms': round(statistics.median(seconds) * 1000, 2),
+            'max_ms': round(max(seconds) * 1000, 2)
+        }
+        for name, seconds in results.items()
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--repeats', type=int, default=5)
+    print(json.dumps(run(parser.parse_args(argv)), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,33 @@
+"""
+gunicorn settings for many prefork workers
+
+    flask migrate-db                      # schema, once per deploy
+    gunicorn -c gunicorn.conf.py app:app
+
+the app is created once in the master (preload_app) and forked, so workers
+start without importing and setting it up again. Set SCHEMA_SETUP = False
+and SQLITE_PROFILE = 'production' in instance/config.py
+"""
+import multiprocessing
+import os
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:8887')
+workers = int(
+    os.environ.get('GUNICORN_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+# GET /emails/events streams hold a thread each while idle, at most
+# EVENTS_MAX_STREAMS (16) per worker so the other threads serve the API;
+# gunicorn_gevent.conf.py holds idle streams as greenlets instead
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.environ.get('GUNICORN_THREADS', 32))
+preload_app = True
+# recycle workers, cheap with preload
+max_requests = 10000
+max_requests_jitter = 1000
+
+
+def post_fork(server, worker):
+    # connections pooled by the master are not shared with workers, delivery
+    # threads, render processes and SMTP connections are reset by
+    # modules.prefork in every forked process
+    from modules.storage import dispose_engines
+    dispose_engines()
@@ -0,0 +1,38 @@
+"""
+gunicorn.conf.py with gevent workers, for many clients of GET /emails/events
+(pip install gevent)
+
+    flask migrate-db
+    gunicorn -c gunicorn_gevent.conf.py app:app
+
+an idle stream is a greenlet waiting on its subscription, not one of the
+threads of a gthread worker, so it costs only its socket and queue and
+does not keep API requests waiting. SMTP and streams yield to other
+requests, SQLite queries and rendering do not. Keep SEND_NOW_ASYNC off,
+send_now does not block other greenlets here anyway
+"""
+# patched before the app is preloaded in the master, its locks and queues
+# are then gevent ones
+from gevent import monkey
+
+monkey.patch_all()
+
+import multiprocessing  # noqa: E402
+import os  # noqa: E402
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:8887')
+workers = int(
+    os.environ.get('GUNICORN_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+worker_class = 'gevent'
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 1000))
+# read by create_app, streams may take all but 100 connections of a worker
+os.environ.setdefault('EVENTS_MAX_STREAMS', str(worker_connections - 100))
+preload_app = True
+max_requests = 10000
+max_requests_jitter = 1000
+
+
+def post_fork(server, worker):
+    # see gunicorn.conf.py
+    from modules.storage import dispose_engines
+    dispose_engines()
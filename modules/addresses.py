@@ -0,0 +1,115 @@
+"""
+email addresses to user ids, creating users that do not exist yet
+
+emails can be posted with raw addresses instead of user ids. Unknown
+addresses are inserted with one INSERT OR IGNORE against the unique index
+on email_address (concurrent requests creating the same user do not fail)
+and all ids are read back with one query. Ids of users never change, so
+hot senders and recipents are kept in a process local LRU of
+ADDRESS_CACHE_SIZE entries and resolved without the database
+"""
+import threading
+from collections import OrderedDict
+
+from flask import current_app
+
+from modules.database import EmailUser
+from modules.extensions import db
+from modules.lookup import MAX_IN_PARAMETERS
+
+user_table = EmailUser.__table__
+
+
+class LRUCache:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get_many(self, keys):
+        """
+        returns {key: value} of cached keys
+        """
+        found = {}
+        with self.lock:
+            for key in keys:
+                value = self.entries.get(key)
+                if value is None:
+                    self.misses += 1
+                    continue
+                self.entries.move_to_end(key)
+                self.hits += 1
+                found[key] = value
+        return found
+
+    def put_many(self, items):
+        if not self.max_entries:
+            return
+        with self.lock:
+            for key, value in items.items():
+                self.entries[key] = value
+                self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class AddressIndex:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('ADDRESS_CACHE_SIZE', 10000)
+        app.extensions['address_index'] = LRUCache(
+            app.config['ADDRESS_CACHE_SIZE'])
+
+    @property
+    def state(self):
+        return current_app.extensions['address_index']
+
+    def contains(self, address):
+        return bool(self.state.get_many([address]))
+
+    def load_ids(self, addresses):
+        ids = {}
+        for start in range(0, len(addresses), MAX_IN_PARAMETERS):
+            chunk = addresses[start:start + MAX_IN_PARAMETERS]
+            rows = db.session.query(EmailUser.id,
+                                    EmailUser.email_address).filter(
+                                        EmailUser.email_address.in_(chunk))
+            ids.update((row.email_address, row.id) for row in rows)
+        return ids
+
+    def resolve(self, addresses):
+        """
+        returns {address: user id}, users of unknown addresses are created
+        and committed, so cached ids always exist
+        """
+        addresses = list(dict.fromkeys(addresses))
+        cache = self.state
+        ids = cache.get_many(addresses)
+        missing = [address for address in addresses if address not in ids]
+        if not missing:
+            return ids
+
+        found = self.load_ids(missing)
+        new = [address for address in missing if address not in found]
+        if new:
+            # another process can create the same users meanwhile
+            db.session.execute(
+                user_table.insert().prefix_with('OR IGNORE'),
+                [{'email_address': address} for address in new])
+            db.session.commit()
+            found.update(self.load_ids(new))
+        cache.put_many(found)
+        ids.update(found)
+        return ids
+
+
+address_index = AddressIndex()
@@ -0,0 +1,128 @@
+"""
+moves old sent emails out of the working tables
+
+email and recipents only grow once mail is sent, so the queue, listings
+and every index write get slower with time. Sent emails older than
+ARCHIVE_AFTER_DAYS are copied with their recipent links to email_archive
+and recipents_archive and deleted from the working tables,
+ARCHIVE_BATCH_SIZE emails per transaction so writers are not blocked for
+long. GET /email/<id> falls back to the archive. Their attachments are
+linked by attachment.archived_email_id instead of email_id. Full text
+search covers the working tables only, archived emails are dropped from
+its index together with their rows
+"""
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import func, select
+
+from modules.database import (Attachment, Email, email_archive,
+                              recipents_archive, recipents_rels)
+from modules.extensions import db
+
+email_table = Email.__table__
+attachment_table = Attachment.__table__
+ARCHIVED_COLUMNS = ('id', 'pub_date', 'subject', 'message', 'body_sha256',
+                    'status', 'priority', 'sender_id', 'attempts')
+
+
+class EmailArchive:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('ARCHIVE_AFTER_DAYS', 30)
+        app.config.setdefault('ARCHIVE_BATCH_SIZE', 1000)
+        app.cli.add_command(archive_emails_command)
+
+    def archivable_ids(self, cutoff, limit):
+        # the newest email always stays, sqlite gives new rows max(id) + 1
+        # and must never give out an id that is already archived
+        newest = db.session.query(func.max(Email.id)).scalar()
+        if newest is None:
+            return []
+        rows = db.session.query(Email.id).filter(
+            Email.status == 'sent', Email.pub_date < cutoff,
+            Email.id < newest).order_by(Email.id).limit(limit)
+        return [row.id for row in rows]
+
+    def archive_batch(self, cutoff, batch_size):
+        """
+        moves up to batch_size sent emails published before cutoff,
+        in one transaction, returns number of moved emails
+        """
+        ids = self.archivable_ids(cutoff, batch_size)
+        if not ids:
+            return 0
+        columns = [email_table.c[name] for name in ARCHIVED_COLUMNS]
+        session = db.session
+        session.execute(
+            email_archive.insert().from_select(
+                ARCHIVED_COLUMNS,
+                select(columns).where(email_table.c.id.in_(ids))))
+        session.execute(
+            recipents_archive.insert().from_select(
+                ('email_id', 'recipent_id', 'status'),
+                select([
+                    recipents_rels.c.email_id, recipents_rels.c.recipent_id,
+                    recipents_rels.c.status
+                ]).where(recipents_rels.c.email_id.in_(ids))))
+        session.execute(recipents_rels.delete().where(
+            recipents_rels.c.email_id.in_(ids)))
+        session.execute(attachment_table.update().where(
+            attachment_table.c.email_id.in_(ids)).values(
+                archived_email_id=attachment_table.c.email_id,
+                email_id=None))
+        session.execute(email_table.delete().where(email_table.c.id.in_(ids)))
+        session.commit()
+        return len(ids)
+
+    def archive(self, older_than=None, batch_size=None):
+        """
+        moves all sent emails older than older_than (timedelta, default
+        ARCHIVE_AFTER_DAYS), batch by batch, returns number of moved emails
+        """
+        config = current_app.config
+        if older_than is None:
+            older_than = timedelta(days=config['ARCHIVE_AFTER_DAYS'])
+        batch_size = batch_size or config['ARCHIVE_BATCH_SIZE']
+        cutoff = datetime.utcnow() - older_than
+        total = 0
+        while True:
+            moved = self.archive_batch(cutoff, batch_size)
+            total += moved
+            if moved < batch_size:
+                return total
+
+    def get_email(self, email_id):
+        """
+        archived email row, has the same attributes as Email
+        """
+        return db.session.query(email_archive).filter(
+            email_archive.c.id == email_id).first()
+
+    def exists(self, email_id):
+        return db.session.query(email_archive.c.id).filter(
+            email_archive.c.id == email_id).first() is not None
+
+
+@click.command('archive-emails')
+@click.option('--days',
+              type=int,
+              default=None,
+              help='archive sent emails older than this, '
+              'default ARCHIVE_AFTER_DAYS')
+@with_appcontext
+def archive_emails_command(days):
+    """
+    move old sent emails to archive tables
+    """
+    older_than = timedelta(days=days) if days is not None else None
+    moved = archive.archive(older_than)
+    click.echo(f'Archived emails: {moved}')
+
+
+archive = EmailArchive()
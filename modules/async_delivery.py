@@ -0,0 +1,185 @@
+"""
+send_now delivery on an asyncio event loop running in a background thread
+
+Mail.post saves the email as 'sending', hands the rendered bytes to the
+loop and returns, the loop runs the SMTP session and the final statuses
+are written by a single database thread. The row has a claim lease, an
+email lost with the process (worker recycled, crash, deploy) is sent by
+the delivery queue once the lease expires. One loop holds thousands of SMTP
+sessions at once (SEND_NOW_ASYNC_CONCURRENCY), a stalled relay only holds
+a coroutine, never a request worker
+"""
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from flask import current_app
+
+from modules.async_smtp import SMTPReplyError, SMTPSession
+from modules.delivery import delivery_queue
+from modules.events import status_events
+from modules.extensions import db
+from modules.group_commit import write_statuses
+from modules.metrics import metrics
+from modules.resource_cache import resource_cache
+from modules.retry import error_status, outcome, refused_status
+from modules.smtp import CircuitOpenError
+
+
+class _AsyncDeliveryState:
+    def __init__(self, app):
+        self.app = app
+        self.loop = None
+        self.thread = None
+        self.semaphore = None
+        self.writer = None
+        self.in_flight = {}  # email id -> concurrent future
+        self.lock = threading.Lock()
+
+    def after_fork(self):
+        # loop thread is not copied by fork, started again on first send
+        self.__init__(self.app)
+
+    def start(self):
+        with self.lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                self.writer = ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix='async-status')
+                self.thread = threading.Thread(target=self.run,
+                                               name='async-delivery',
+                                               daemon=True)
+                self.thread.start()
+            return self.loop
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.semaphore = asyncio.Semaphore(
+            self.app.config['SEND_NOW_ASYNC_CONCURRENCY'])
+        self.loop.run_forever()
+
+
+class AsyncDelivery:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('SEND_NOW_ASYNC', False)
+        app.config.setdefault('SEND_NOW_ASYNC_CONCURRENCY', 1000)
+        app.config.setdefault('SMTP_TIMEOUT', 30)
+        app.extensions['async_delivery'] = _AsyncDeliveryState(app)
+
+    @property
+    def state(self):
+        return current_app.extensions['async_delivery']
+
+    def enabled(self):
+        config = current_app.config
+        # STARTTLS is not implemented by the async client
+        return config['SEND_NOW_ASYNC'] and not config['MAIL_USE_TLS']
+
+    def submit(self, email_id, msg, recipents):
+        """
+        delivers rendered msg of saved email in the event loop,
+        recipents are [(recipent id, address)]
+        """
+        state = self.state
+        loop = state.start()
+        future = asyncio.run_coroutine_threadsafe(
+            self.deliver(state, email_id, msg, recipents), loop)
+        with state.lock:
+            state.in_flight[email_id] = future
+        future.add_done_callback(
+            lambda _: state.in_flight.pop(email_id, None))
+        if future.done():  # finished before it was added
+            state.in_flight.pop(email_id, None)
+        return future
+
+    def wait(self, timeout=None):
+        """
+        waits until deliveries started so far are finished
+        """
+        with self.state.lock:
+            futures = list(self.state.in_flight.values())
+        return wait(futures, timeout)
+
+    async def deliver(self, state, email_id, msg, recipents):
+        mail = state.app.extensions['mail']
+        breaker = state.app.extensions['smtp_pool'].breaker
+        addresses = list(dict.fromkeys(address for _, address in recipents))
+        refused = {}
+        async with state.semaphore:
+            try:
+                if not mail.suppress:
+                    breaker.before_call()
+                    refused = await self.send(state.app.config, msg,
+                                              addresses)
+            except CircuitOpenError as e:
+                # relay is down, no need to log an error for every email
+                status = error_status(e)
+            except Exception as e:
+                state.app.logger.exception('Send error')
+                status = error_status(e)
+                # any other error ends the half-open probe as a failure
+                if isinstance(e, SMTPReplyError):
+                    breaker.record_success()  # relay is answering
+                else:
+                    breaker.record_failure()
+            else:
+                status = 'sent'
+                breaker.record_success()
+        results = {
+            recipent_id: refused_status(refused[address][0])
+            if address in refused else status
+            for recipent_id, address in recipents
+        }
+        await state.loop.run_in_executor(state.writer, self.save_statuses,
+                                         state.app, email_id, msg.sender_id,
+                                         results)
+
+    async def send(self, config, msg, addresses):
+        session = SMTPSession(config['MAIL_SERVER'],
+                              config['MAIL_PORT'],
+                              timeout=config['SMTP_TIMEOUT'],
+                              use_ssl=config['MAIL_USE_SSL'],
+                              username=config['MAIL_USERNAME'],
+                              password=config['MAIL_PASSWORD'])
+        try:
+            await session.connect()
+            return await session.sendmail(msg.sender, addresses,
+                                          msg.as_bytes())
+        finally:
+            await session.close()
+
+    def save_statuses(self, app, email_id, sender_id, results):
+        with app.app_context():
+            try:
+                # first attempt, temporary failures go to the delivery queue
+                email_status, statuses, attempts, next_attempt_at = outcome(
+                    list(results.values()), 0)
+                write_statuses([{
+                    'b_email_id': email_id,
+                    'b_status': email_status,
+                    'b_attempts': attempts,
+                    'b_next_attempt_at': next_attempt_at
+                }], [{
+                    'b_email_id': email_id,
+                    'b_recipent_id': recipent_id,
+                    'b_status': 'pending' if status == 'deferred' else status
+                } for recipent_id, status in zip(results, statuses)])
+                db.session.commit()
+                resource_cache.invalidate('email', [email_id])
+                status_events.publish([(email_id, sender_id, email_status)])
+                if next_attempt_at is not None:
+                    delivery_queue.schedule_retry(next_attempt_at)
+                metrics.inc('email_send_total', email_status)
+                for status in statuses:
+                    metrics.inc('email_recipents_total', status)
+            except Exception:
+                app.logger.exception('Status update error')
+            finally:
+                db.session.remove()
+
+
+async_delivery = AsyncDelivery()
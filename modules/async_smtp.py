@@ -0,0 +1,111 @@
+"""
+minimal asyncio SMTP client, enough to deliver one pre-rendered message
+per session: EHLO, optional implicit TLS and AUTH PLAIN, MAIL, RCPT, DATA.
+Every step has a timeout, so a stalled relay cannot hold a session forever
+"""
+import asyncio
+import base64
+import re
+import ssl
+from email.utils import parseaddr
+
+EOL = re.compile(rb'\r\n|\n|\r(?!\n)')
+LEADING_DOT = re.compile(rb'^\.', re.MULTILINE)
+
+
+class SMTPReplyError(Exception):
+    def __init__(self, code, message):
+        super().__init__(f'{code} {message}')
+        self.code = code
+        self.message = message
+
+
+class SMTPSession:
+    def __init__(self, host, port, timeout=30, use_ssl=False,
+                 username=None, password=None, local_hostname='localhost'):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.use_ssl = use_ssl
+        self.username = username
+        self.password = password
+        self.local_hostname = local_hostname
+        self.reader = None
+        self.writer = None
+
+    async def connect(self):
+        context = ssl.create_default_context() if self.use_ssl else None
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port, ssl=context),
+            self.timeout)
+        await self.expect(None, 220)
+        await self.expect(f'EHLO {self.local_hostname}', 250)
+        if self.username:
+            token = base64.b64encode(
+                f'\0{self.username}\0{self.password}'.encode()).decode()
+            await self.expect(f'AUTH PLAIN {token}', 235)
+
+    async def reply(self):
+        lines = []
+        while True:
+            line = await asyncio.wait_for(self.reader.readline(),
+                                          self.timeout)
+            if not line:
+                raise ConnectionError('SMTP server closed the connection')
+            lines.append(line[4:].strip().decode(errors='replace'))
+            if line[3:4] != b'-':
+                return int(line[:3]), '\n'.join(lines)
+
+    async def command(self, line):
+        if line is not None:
+            self.writer.write(line.encode() + b'\r\n')
+            await asyncio.wait_for(self.writer.drain(), self.timeout)
+        return await self.reply()
+
+    async def expect(self, line, expected):
+        code, message = await self.command(line)
+        if code != expected:
+            raise SMTPReplyError(code, message)
+        return message
+
+    async def sendmail(self, sender, recipients, data):
+        """
+        returns {address: (code, message)} of refused recipients,
+        raises SMTPReplyError if all of them were refused
+        """
+        await self.expect(f'MAIL FROM:<{parseaddr(sender)[1]}>', 250)
+        refused = {}
+        for recipient in recipients:
+            code, message = await self.command(f'RCPT TO:<{recipient}>')
+            if code not in (250, 251):
+                refused[recipient] = (code, message)
+        if len(refused) == len(recipients):
+            await self.command('RSET')
+            code, message = next(iter(refused.values()))
+            raise SMTPReplyError(code, message)
+
+        await self.expect('DATA', 354)
+        data = LEADING_DOT.sub(b'..', EOL.sub(b'\r\n', data))
+        if not data.endswith(b'\r\n'):
+            data += b'\r\n'
+        self.writer.write(data + b'.\r\n')
+        await asyncio.wait_for(self.writer.drain(), self.timeout)
+        code, message = await self.reply()
+        if code != 250:
+            raise SMTPReplyError(code, message)
+        return refused
+
+    async def close(self):
+        if self.writer is None:
+            return
+        try:
+            await self.command('QUIT')
+        except (OSError, asyncio.TimeoutError, SMTPReplyError):
+            pass  # closing anyway
+        finally:
+            self.writer.close()
+            try:
+                await asyncio.wait_for(self.writer.wait_closed(),
+                                       self.timeout)
+            except (OSError, asyncio.TimeoutError):
+                pass
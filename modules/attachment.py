@@ -1,10 +1,17 @@
 import uuid
 
-from flask import Blueprint, current_app, request
+from flask import Blueprint, current_app, request, send_file
 from flask_restful import Api, Resource
+from webargs import fields
+from webargs.flaskparser import abort, use_kwargs
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
 
 from modules.database import Attachment as AttachmentModel
+from modules.database import AttachmentContent
 from modules.extensions import db
+from modules.file_store import store_stream
+from modules.lookup import get_attachments
+from modules.validators import attachment_must_exist_in_db
 
 attachment_bp = Blueprint('attachment', __name__)
 attachment_api = Api(attachment_bp)
@@ -19,8 +26,9 @@ class AttachmentResource(Resource):
     @staticmethod
     def get_attachments(attachment_ids):
         files = []
+        attachments = get_attachments(attachment_ids)
         for attachment_id in attachment_ids:
-            attachment = AttachmentModel.query.get(attachment_id)
+            attachment = attachments[attachment_id]
             if attachment:
                 file = {
                     'filepath': attachment.file_path,
@@ -30,17 +38,81 @@ class AttachmentResource(Resource):
                 files.append(file)
         return files
 
+    @staticmethod
+    def add_content_reference(sha256, size, file_path):
+        content_table = AttachmentContent.__table__
+        # no-op if the content is already known
+        db.session.execute(content_table.insert().prefix_with(
+            'OR IGNORE').values(sha256=sha256,
+                                size=size,
+                                file_path=file_path,
+                                ref_count=0))
+        db.session.execute(content_table.update().where(
+            content_table.c.sha256 == sha256).values(
+                ref_count=content_table.c.ref_count + 1))
+
     def save_attachment(self, file):
-        file_name = str(uuid.uuid4())
-        file_path = f'attachments/{file_name}'
-        file_path = file.save(file_path)
+        sha256, size, file_path = store_stream(file.stream)
+        # duplicate content is only one more reference to the stored file
+        self.add_content_reference(sha256, size, file_path)
         attachment = AttachmentModel(file_path=file_path,
-                                     name=file_name,
-                                     content_type=file.content_type)
+                                     name=file.filename or str(uuid.uuid4()),
+                                     content_type=file.content_type,
+                                     sha256=sha256)
         db.session.add(attachment)
         db.session.commit()
         return attachment.id
 
+    @staticmethod
+    def file_response(attachment):
+        """
+        the file is not read here: the WSGI server streams it with
+        wsgi.file_wrapper (sendfile under gunicorn), or the proxy in front
+        with USE_X_SENDFILE. Content never changes for a stored hash, so
+        sha256 is the ETag
+        """
+        missing = {
+            'attachment_id':
+            [f'File of attachment {attachment.id} is missing']
+        }
+        if attachment.file_path is None:
+            # saved before file paths were stored
+            abort(404, errors=missing)
+        try:
+            response = send_file(attachment.file_path,
+                                 mimetype=attachment.content_type or None,
+                                 as_attachment=True,
+                                 attachment_filename=attachment.name,
+                                 add_etags=attachment.sha256 is None)
+        except FileNotFoundError:
+            abort(404, errors=missing)
+        if attachment.sha256:
+            response.set_etag(attachment.sha256)
+        # werkzeug only sets it on range requests, clients check it first
+        response.headers['Accept-Ranges'] = 'bytes'
+        try:
+            # 206 for Range, 304 for If-None-Match / If-Modified-Since
+            return response.make_conditional(
+                request,
+                accept_ranges=True,
+                complete_length=response.content_length)
+        except RequestedRangeNotSatisfiable:
+            response.close()
+            raise
+
+    @use_kwargs(
+        {
+            'attachment_id':
+            fields.Int(required=True, validate=attachment_must_exist_in_db)
+        },
+        location='view_args')
+    def get(self, attachment_id):
+        """
+        download attachment, supports Range and conditional requests:
+             http localhost:8887/file/1 Range:bytes=0-1023
+        """
+        return self.file_response(self.get_attachment(attachment_id))
+
     @use_kwargs({
         'attachment': fields.Field(required=True),
     },
@@ -57,4 +129,5 @@ class AttachmentResource(Resource):
         return {'file_id': file_id}
 
 
-attachment_api.add_resource(AttachmentResource, '/file')
+attachment_api.add_resource(AttachmentResource, '/file',
+                            '/file/<attachment_id>')
@@ -0,0 +1,94 @@
+"""
+large message bodies stored compressed, once per content
+
+bodies of MESSAGE_BODY_MIN_BYTES and more (html newsletters) are not kept in
+email.message, which every email query loads, but zlib compressed in
+message_body keyed by sha256, so a campaign sending the same body to
+thousands of emails stores it once. They are decompressed only when a
+single email is fetched or rendered for sending, listings show them as null
+"""
+import hashlib
+import zlib
+
+from flask import current_app
+
+from modules.addresses import LRUCache
+from modules.database import MessageBody
+from modules.extensions import db
+
+message_body_table = MessageBody.__table__
+
+
+class MissingBodyError(LookupError):
+    """
+    message_body row of an email is gone
+    """
+
+
+class MessageBodies:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('MESSAGE_BODY_MIN_BYTES', 64 * 1024)
+        app.config.setdefault('MESSAGE_BODY_COMPRESS_LEVEL', 6)
+        app.config.setdefault('MESSAGE_BODY_CACHE_SIZE', 64)
+        # bodies are never changed, cached by content hash
+        app.extensions['message_bodies'] = LRUCache(
+            app.config['MESSAGE_BODY_CACHE_SIZE'])
+
+    @property
+    def cache(self):
+        return current_app.extensions['message_bodies']
+
+    def load(self, sha256):
+        """
+        decompressed body, raises MissingBodyError if it is not stored
+        """
+        cached = self.cache.get_many([sha256])
+        if cached:
+            return cached[sha256]
+        row = db.session.query(MessageBody.data).filter(
+            MessageBody.sha256 == sha256).first()
+        if row is None:
+            raise MissingBodyError(f'Message body {sha256} does not exist')
+        text = zlib.decompress(row.data).decode('utf-8')
+        self.cache.put_many({sha256: text})
+        return text
+
+    def store(self, text):
+        """
+        returns (message, body_sha256) columns of email with body text,
+        big body is written to message_body if it is not there yet
+        """
+        if text is None:
+            return text, None
+        config = current_app.config
+        encoded = text.encode('utf-8')
+        if len(encoded) < config['MESSAGE_BODY_MIN_BYTES']:
+            return text, None
+        sha256 = hashlib.sha256(encoded).hexdigest()
+        exists = db.session.query(MessageBody.sha256).filter(
+            MessageBody.sha256 == sha256).first()
+        if not exists:
+            # another request can store the same body meanwhile
+            db.session.execute(
+                message_body_table.insert().prefix_with('OR IGNORE'), {
+                    'sha256': sha256,
+                    'data': zlib.compress(
+                        encoded, config['MESSAGE_BODY_COMPRESS_LEVEL']),
+                    'size': len(encoded)
+                })
+        return None, sha256
+
+    def text(self, email):
+        """
+        body of email (or archived email row)
+        """
+        if email.body_sha256 is None:
+            return email.message
+        return self.load(email.body_sha256)
+
+
+message_bodies = MessageBodies()
@@ -11,20 +11,50 @@ recipents_rels = db.Table(
     db.Column('recipent_id',
               db.Integer,
               db.ForeignKey('email_user.id'),
-              primary_key=True))
+              primary_key=True),
+    # delivery status of the email to this recipent
+    db.Column('status', db.String, default='pending'))
+
+# primary key covers lookups by email, this one emails of a recipent
+db.Index('ix_recipents_recipent_id', recipents_rels.c.recipent_id)
 
 
 class Email(db.Model):
+    __table_args__ = (
+        # sending queue: pending emails by priority, oldest first
+        db.Index('ix_email_status_priority_pub_date', 'status', 'priority',
+                 'pub_date'), )
+
     id = db.Column(db.Integer, primary_key=True)
-    pub_date = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    pub_date = db.Column(db.DateTime,
+                         nullable=False,
+                         default=datetime.utcnow,
+                         index=True)
     subject = db.Column(db.String)
+    # bodies of MESSAGE_BODY_MIN_BYTES and more are stored compressed in
+    # message_body instead, once per content (see modules.bodies)
     message = db.Column(db.String)
+    body_sha256 = db.Column(db.String(64),
+                            db.ForeignKey('message_body.sha256'),
+                            nullable=True)
     status = db.Column(db.String)
     priority = db.Column(db.Integer)
+    # delivery attempts so far, pending email is not sent before
+    # next_attempt_at (retry backoff, see modules.retry)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=True)
+    # token of the delivery claim that set 'sending', a worker only sends
+    # the rows it claimed itself (see DeliveryQueue.claim_batch)
+    claimed_by = db.Column(db.String(32), nullable=True)
+    # 'sending' rows claimed longer than DELIVERY_CLAIM_TIMEOUT ago are
+    # claimed again, their worker died or could not put them back
+    claimed_at = db.Column(db.DateTime, nullable=True)
 
     # one sender can have multiple emails
     sender = db.relationship("EmailUser", backref='sender_emails')
-    sender_id = db.Column(db.Integer, db.ForeignKey('email_user.id'))
+    sender_id = db.Column(db.Integer,
+                          db.ForeignKey('email_user.id'),
+                          index=True)
 
     # each mail can have multiple recipents
     recipents = db.relationship("EmailUser",
@@ -42,7 +72,7 @@ class Email(db.Model):
 
 class EmailUser(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    email_address = db.Column(db.String)
+    email_address = db.Column(db.String, unique=True, index=True)
 
 
 class Attachment(db.Model):
@@ -50,4 +80,58 @@ class Attachment(db.Model):
     file_path = db.Column(db.String)
     name = db.Column(db.String)
     content_type = db.Column(db.String)
-    email_id = db.Column(db.Integer, db.ForeignKey('email.id'), nullable=True)
+    email_id = db.Column(db.Integer,
+                         db.ForeignKey('email.id'),
+                         nullable=True,
+                         index=True)
+
+    # same content uploaded many times is stored once
+    sha256 = db.Column(db.String(64),
+                       db.ForeignKey('attachment_content.sha256'),
+                       nullable=True,
+                       index=True)
+    content = db.relationship("AttachmentContent", backref='attachments')
+    # email_id of an email moved to email_archive (modules.archive)
+    archived_email_id = db.Column(db.Integer,
+                                  db.ForeignKey('email_archive.id'),
+                                  nullable=True,
+                                  index=True)
+
+
+class AttachmentContent(db.Model):
+    sha256 = db.Column(db.String(64), primary_key=True)
+    file_path = db.Column(db.String, nullable=False)
+    size = db.Column(db.Integer, nullable=False)
+    # number of Attachment rows using this file
+    ref_count = db.Column(db.Integer, nullable=False, default=0)
+
+
+class MessageBody(db.Model):
+    sha256 = db.Column(db.String(64), primary_key=True)
+    data = db.Column(db.LargeBinary, nullable=False)  # zlib of utf-8 text
+    size = db.Column(db.Integer, nullable=False)  # bytes before compression
+
+
+# sent emails older than ARCHIVE_AFTER_DAYS are moved here (modules.archive),
+# keeping email and recipents small for the queue and listings
+email_archive = db.Table(
+    'email_archive',
+    db.Column('id', db.Integer, primary_key=True),
+    db.Column('pub_date', db.DateTime, nullable=False),
+    db.Column('subject', db.String),
+    db.Column('message', db.String),
+    db.Column('body_sha256', db.String(64)),
+    db.Column('status', db.String),
+    db.Column('priority', db.Integer),
+    db.Column('sender_id', db.Integer, index=True),
+    db.Column('attempts', db.Integer, nullable=False, default=0),
+    db.Column('archived_at',
+              db.DateTime,
+              nullable=False,
+              default=datetime.utcnow))
+
+recipents_archive = db.Table(
+    'recipents_archive',
+    db.Column('email_id', db.Integer, primary_key=True),
+    db.Column('recipent_id', db.Integer, primary_key=True),
+    db.Column('status', db.String))
@@ -0,0 +1,440 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import func
+from sqlalchemy.orm import joinedload, selectinload
+
+from modules.database import Email
+from modules.events import status_events
+from modules.extensions import db
+from modules.group_commit import GroupCommitter
+from modules.lookup import MAX_IN_PARAMETERS
+from modules.resource_cache import resource_cache
+from modules.scheduler import (DEFAULT_PRIORITY, PRIORITY_LEVELS,
+                               DomainThrottle, PriorityScheduler)
+
+
+class DeliveryJob:
+    """
+    progress of one flush of pending emails, shared by all workers draining it
+    """
+    def __init__(self, total, email_ids=None):
+        self.id = str(uuid.uuid4())
+        self.email_ids = email_ids
+        self.next_position = 0
+        self.total = total
+        self.sent = 0
+        self.failed = 0
+        self.deferred = 0  # back in the queue for a later attempt
+        self.status = 'queued'
+        self.running_workers = 0
+        self.started_at = None
+        self.finished_at = None
+        self._lock = threading.Lock()
+
+    def next_ids(self, count):
+        """
+        next chunk of ids for jobs sending only given emails
+        """
+        with self._lock:
+            ids = self.email_ids[self.next_position:self.next_position + count]
+            self.next_position += len(ids)
+            return ids
+
+    def worker_started(self):
+        with self._lock:
+            self.running_workers += 1
+            self.status = 'running'
+            if self.started_at is None:
+                self.started_at = time.perf_counter()
+
+    def worker_finished(self):
+        with self._lock:
+            self.running_workers -= 1
+            if self.running_workers == 0:
+                self.status = 'done'
+                self.total = self.sent + self.failed + self.deferred
+                self.finished_at = time.perf_counter()
+
+    def record(self, status):
+        with self._lock:
+            if status == 'sent':
+                self.sent += 1
+            elif status == 'pending':
+                self.deferred += 1
+            else:
+                self.failed += 1
+            # mails added after the job was created can be claimed as well
+            self.total = max(self.total,
+                             self.sent + self.failed + self.deferred)
+
+    def elapsed(self):
+        if self.started_at is None:
+            return 0.0
+        return (self.finished_at or time.perf_counter()) - self.started_at
+
+    def serialize(self):
+        with self._lock:
+            elapsed = self.elapsed()
+            done = self.sent + self.failed + self.deferred
+            rate = done / elapsed if elapsed else 0
+            return {
+                'job_id': self.id,
+                'status': self.status,
+                'total': self.total,
+                'sent': self.sent,
+                'failed': self.failed,
+                'deferred': self.deferred,
+                'elapsed': round(elapsed, 3),
+                'messages_per_second': round(rate, 2)
+            }
+
+
+class _DeliveryState:
+    def __init__(self, app):
+        self.app = app
+        self.workers = app.config['DELIVERY_WORKERS']
+        self.batch_size = app.config['DELIVERY_BATCH_SIZE']
+        self.executor = None
+        self.jobs = OrderedDict()
+        self.claim_lock = threading.Lock()
+        self.lock = threading.Lock()
+        self.scheduler = PriorityScheduler(
+            app.config['DELIVERY_PRIORITY_WEIGHTS'])
+        self.throttle = DomainThrottle(
+            app.config['DELIVERY_DOMAIN_RATES'],
+            app.config['DELIVERY_DEFAULT_DOMAIN_RATE'])
+        # wakes up when the earliest retry is due or claim expires
+        self.retry_timer = None
+        self.retry_at = None
+        self.committer = None
+        if app.config['DELIVERY_GROUP_COMMIT']:
+            self.committer = GroupCommitter(
+                app.config['DELIVERY_GROUP_COMMIT_WINDOW'],
+                app.config['DELIVERY_GROUP_COMMIT_MAX_ROWS'])
+
+    def after_fork(self):
+        # threads of the executor and the retry timer are not copied by
+        # fork, jobs running in the parent are not tracked here
+        self.__init__(self.app)
+
+    def get_executor(self):
+        with self.lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(
+                    max_workers=self.workers,
+                    thread_name_prefix='delivery')
+            return self.executor
+
+
+class DeliveryQueue:
+    """
+    sends pending emails in background worker threads
+
+    each worker claims a batch of pending rows (status 'pending' -> 'sending'),
+    sends them and writes the final status back, until nothing is left.
+    temporary failures put the email back to 'pending' for a later
+    attempt, 'dead' after DELIVERY_MAX_ATTEMPTS (see modules.retry).
+    batches are split between priorities by PriorityScheduler, recipents
+    of a batch are grouped into per domain envelopes of at most
+    DELIVERY_MAX_RECIPENTS addresses (see planner) and sending to every
+    recipent domain is rate limited by DomainThrottle.
+    DELIVERY_WORKERS = 0 drains the queue synchronously in the calling thread
+    """
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('DELIVERY_WORKERS', 4)
+        app.config.setdefault('DELIVERY_BATCH_SIZE', 100)
+        app.config.setdefault('DELIVERY_JOB_HISTORY', 1000)
+        app.config.setdefault('DELIVERY_PRIORITY_WEIGHTS', None)
+        app.config.setdefault('DELIVERY_DOMAIN_RATES', None)
+        app.config.setdefault('DELIVERY_DEFAULT_DOMAIN_RATE', None)
+        app.config.setdefault('DELIVERY_MAX_RECIPENTS', 100)
+        app.config.setdefault('DELIVERY_MERGE_IDENTICAL', False)
+        app.config.setdefault('DELIVERY_GROUP_COMMIT', False)
+        app.config.setdefault('DELIVERY_GROUP_COMMIT_WINDOW', 0.005)
+        app.config.setdefault('DELIVERY_GROUP_COMMIT_MAX_ROWS', 1000)
+        app.config.setdefault('DELIVERY_MAX_ATTEMPTS', 5)
+        app.config.setdefault('DELIVERY_RETRY_BASE', 60)
+        app.config.setdefault('DELIVERY_RETRY_MAX', 3600)
+        app.config.setdefault('DELIVERY_CLAIM_TIMEOUT', 900)
+        app.extensions['delivery'] = _DeliveryState(app)
+
+    @property
+    def state(self):
+        return current_app.extensions['delivery']
+
+    @staticmethod
+    def claim_lease():
+        return timedelta(seconds=current_app.config['DELIVERY_CLAIM_TIMEOUT'])
+
+    def claimable(self, now=None):
+        """
+        pending emails that are due (emails waiting for a retry are left
+        out until next_attempt_at) and 'sending' ones whose claim expired
+        """
+        now = now or datetime.utcnow()
+        due = (Email.status == 'pending') & (
+            Email.next_attempt_at.is_(None)
+            | (Email.next_attempt_at <= now))
+        expired = (Email.status == 'sending') & (Email.claimed_at <
+                                                 now - self.claim_lease())
+        return due | expired
+
+    def pending_query(self):
+        return Email.query.filter(self.claimable())
+
+    def count_pending(self, email_ids=None):
+        if email_ids is None:
+            return self.pending_query().count()
+        total = 0
+        for start in range(0, len(email_ids), MAX_IN_PARAMETERS):
+            chunk = email_ids[start:start + MAX_IN_PARAMETERS]
+            total += self.pending_query().filter(Email.id.in_(chunk)).count()
+        return total
+
+    def submit(self, email_ids=None):
+        """
+        create job sending all pending emails (or only given ids),
+        returns None if there is nothing to send
+        """
+        state = self.state
+        if email_ids is not None:
+            email_ids = sorted(set(email_ids))
+        total = self.count_pending(email_ids)
+        if not total:
+            return None
+
+        job = DeliveryJob(total, email_ids=email_ids)
+        self.add_job(job)
+
+        if not state.workers:
+            job.worker_started()
+            try:
+                self.drain(job)
+            finally:
+                job.worker_finished()
+            return job
+
+        executor = state.get_executor()
+        workers = min(state.workers,
+                      -(-total // state.batch_size))  # ceil division
+        for _ in range(workers):
+            job.worker_started()
+            executor.submit(self._work, state.app, job)
+        return job
+
+    def add_job(self, job):
+        state = self.state
+        with state.lock:
+            state.jobs[job.id] = job
+            # forget the oldest finished jobs
+            history = state.app.config['DELIVERY_JOB_HISTORY']
+            for job_id in list(state.jobs):
+                if len(state.jobs) <= history:
+                    break
+                if state.jobs[job_id].status == 'done':
+                    del state.jobs[job_id]
+
+    def get_job(self, job_id):
+        return self.state.jobs.get(job_id)
+
+    def pending_priority_query(self, priority):
+        query = self.pending_query()
+        if priority == DEFAULT_PRIORITY:
+            query = query.filter((Email.priority == priority)
+                                 | Email.priority.is_(None))
+        else:
+            query = query.filter(Email.priority == priority)
+        return query.with_entities(Email.id).order_by(Email.pub_date, Email.id)
+
+    def pending_ids(self, priority, limit, offset=0):
+        query = self.pending_priority_query(priority)
+        return [row.id for row in query.offset(offset).limit(limit)]
+
+    def next_pending_ids(self, batch_size):
+        """
+        ids of next pending emails, batch is split between priorities
+        by the scheduler, slots of priorities without pending emails
+        are given to the highest priority that has some
+        """
+        counts = self.state.scheduler.plan(batch_size)
+        ids = []
+        exhausted = set()
+        for priority, count in counts.items():
+            if count:
+                level_ids = self.pending_ids(priority, count)
+                if len(level_ids) < count:
+                    exhausted.add(priority)
+                ids.extend(level_ids)
+        for priority in PRIORITY_LEVELS:
+            free = batch_size - len(ids)
+            if not free:
+                break
+            if priority not in exhausted:
+                ids.extend(
+                    self.pending_ids(priority, free, offset=counts[priority]))
+        return ids
+
+    def claim_batch(self, job):
+        state = self.state
+        # rows are marked with a token of this claim, rows claimed a moment
+        # earlier by another job or process are 'sending' as well and must
+        # not be sent twice
+        token = uuid.uuid4().hex
+        with state.claim_lock:
+            claimed = 0
+            while not claimed:
+                if job.email_ids is None:
+                    ids = self.next_pending_ids(state.batch_size)
+                else:
+                    ids = job.next_ids(state.batch_size)
+                if not ids:
+                    return []
+                # rows already taken by another process are skipped
+                now = datetime.utcnow()
+                claimed = Email.query.filter(
+                    Email.id.in_(ids), self.claimable(now)).update(
+                        {
+                            'status': 'sending',
+                            'claimed_by': token,
+                            'claimed_at': now
+                        },
+                        synchronize_session=False)
+                db.session.commit()
+            resource_cache.invalidate('email', ids)
+        emails = Email.query.options(joinedload(Email.sender),
+                                     selectinload(Email.attachments)).filter(
+                                         Email.id.in_(ids),
+                                         Email.claimed_by == token,
+                                         Email.status == 'sending').all()
+        status_events.publish(
+            [(email.id, email.sender_id, 'sending') for email in emails])
+        # keep order decided by the scheduler
+        position = {email_id: i for i, email_id in enumerate(ids)}
+        return sorted(emails, key=lambda email: position[email.id])
+
+    def drain(self, job):
+        # imported here as mail module enqueues jobs using this module
+        from modules.mail import MailResource
+        sender = MailResource()
+        throttle = self.state.throttle
+        while True:
+            emails = self.claim_batch(job)
+            if not emails:
+                break
+            ids = [email.id for email in emails]
+            token = emails[0].claimed_by
+            # recipents of the batch are grouped by domain into envelopes,
+            # statuses of the whole batch are written in one transaction
+            try:
+                statuses = sender.send_saved_emails(emails, throttle)
+            except Exception:
+                self.release(ids, token)
+                raise
+            for email in emails:
+                job.record(statuses[email.id])
+        self.schedule_retry()
+
+    def next_wakeup(self):
+        """
+        earliest time a deferred email is due or a 'sending' claim
+        expires, None if there is nothing to wait for
+        """
+        now = datetime.utcnow()
+        retry_at = db.session.query(func.min(Email.next_attempt_at)).filter(
+            Email.status == 'pending', Email.next_attempt_at > now).scalar()
+        claimed_at = db.session.query(func.min(Email.claimed_at)).filter(
+            Email.status == 'sending').scalar()
+        times = [retry_at] if retry_at else []
+        if claimed_at:
+            times.append(claimed_at + self.claim_lease())
+        return min(times) if times else None
+
+    def schedule_retry(self, when=None):
+        """
+        drains the queue again at when (default next_wakeup()), so deferred
+        emails are sent without another POST /emails. Only the earliest
+        wakeup is kept, an earlier one replaces it
+        """
+        if when is None:
+            when = self.next_wakeup()
+            if when is None:
+                return
+        state = self.state
+        with state.lock:
+            if state.retry_at is not None and state.retry_at <= when:
+                return
+            if state.retry_timer is not None:
+                state.retry_timer.cancel()
+            delay = max(0.0, (when - datetime.utcnow()).total_seconds())
+            state.retry_at = when
+            state.retry_timer = threading.Timer(delay, self._retry,
+                                                (state.app, ))
+            state.retry_timer.daemon = True
+            state.retry_timer.start()
+
+    def cancel_retry(self):
+        state = self.state
+        with state.lock:
+            if state.retry_timer is not None:
+                state.retry_timer.cancel()
+            state.retry_timer = state.retry_at = None
+
+    def _retry(self, app):
+        with app.app_context():
+            state = self.state
+            with state.lock:
+                state.retry_timer = state.retry_at = None
+            try:
+                # a finished drain schedules the next wakeup
+                if self.submit() is None:
+                    self.schedule_retry()
+            except Exception:
+                app.logger.exception('Delivery retry error')
+            finally:
+                db.session.remove()
+
+    def release(self, ids, token):
+        """
+        puts emails of claim token back to 'pending' after an error,
+        before their statuses were written, so they are sent again
+        instead of staying 'sending'. If this fails too the claim lease
+        expires
+        """
+        try:
+            db.session.rollback()
+            Email.query.filter(Email.id.in_(ids), Email.claimed_by == token,
+                               Email.status == 'sending').update(
+                                   {
+                                       'status': 'pending',
+                                       'claimed_by': None,
+                                       'claimed_at': None
+                                   },
+                                   synchronize_session=False)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            current_app.logger.exception('Delivery release error')
+        resource_cache.invalidate('email', ids)
+
+    def _work(self, app, job):
+        with app.app_context():
+            try:
+                self.drain(job)
+            except Exception:
+                app.logger.exception('Delivery worker error')
+            finally:
+                db.session.remove()
+                job.worker_finished()
+
+
+delivery_queue = DeliveryQueue()
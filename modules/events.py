@@ -0,0 +1,182 @@
+"""
+in-process fan-out of email status changes to subscribed clients
+(GET /emails/events, server-sent events), instead of polling
+GET /email/<id>
+
+every status written by this process (new emails, claimed batches, send
+results) is published once to the hub. A subscriber is only a bounded
+queue indexed by the email ids or sender it watches, so publishing costs
+the number of interested clients and an idle connection holds no
+database session and polls nothing. The last EVENTS_BUFFER_SIZE events
+are kept for clients reconnecting with Last-Event-ID. Changes written by
+other processes are not seen here
+
+every open stream holds a request thread of a threaded worker, so a
+process serves at most EVENTS_MAX_STREAMS of them and the others get 503
+to leave threads for the API (gunicorn_events.conf.py runs the streams on
+gevent workers, where they are greenlets)
+"""
+import itertools
+import queue
+import threading
+from collections import deque
+
+from flask import current_app
+
+
+class TooManyStreams(Exception):
+    pass
+
+
+class Subscription:
+    """
+    events of email_ids (all if None) sent by sender (any if None)
+    """
+    def __init__(self, email_ids=None, sender=None, max_events=1000):
+        self.email_ids = frozenset(email_ids) if email_ids else None
+        self.sender = sender
+        self.events = queue.Queue(maxsize=max_events)
+        # client did not keep up, its stream is closed and it reconnects
+        # with Last-Event-ID
+        self.overflowed = False
+
+    def matches(self, email_id, sender_id):
+        if self.email_ids is not None and email_id not in self.email_ids:
+            return False
+        return self.sender is None or self.sender == sender_id
+
+    def offer(self, event):
+        try:
+            self.events.put_nowait(event)
+        except queue.Full:
+            self.overflowed = True
+
+    def get(self, timeout):
+        """
+        next (event id, email id, sender id, status) or None on timeout
+        """
+        try:
+            return self.events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class _EventHub:
+    def __init__(self, buffer_size, max_streams=None):
+        self.buffer_size = buffer_size
+        self.max_streams = max_streams  # None for no limit
+        self.ids = itertools.count(1)
+        self.recent = deque(maxlen=buffer_size)
+        self.by_email = {}  # email id -> subscriptions
+        self.by_sender = {}  # sender id -> subscriptions without email ids
+        self.everything = set()
+        self.subscriptions = set()
+        self.lock = threading.Lock()
+
+    def after_fork(self):
+        # subscribers are connections of the parent
+        self.__init__(self.buffer_size, self.max_streams)
+
+    def groups(self, subscription):
+        if subscription.email_ids is not None:
+            return [
+                self.by_email.setdefault(email_id, set())
+                for email_id in subscription.email_ids
+            ]
+        if subscription.sender is not None:
+            return [self.by_sender.setdefault(subscription.sender, set())]
+        return [self.everything]
+
+    def subscribe(self, subscription, last_event_id=None):
+        """
+        raises TooManyStreams if max_streams subscriptions are open
+        """
+        with self.lock:
+            if (self.max_streams is not None
+                    and len(self.subscriptions) >= self.max_streams):
+                raise TooManyStreams()
+            self.subscriptions.add(subscription)
+            for group in self.groups(subscription):
+                group.add(subscription)
+            if last_event_id is not None:
+                # missed while reconnecting, under the lock so nothing is
+                # published in between
+                for event in self.recent:
+                    if event[0] > last_event_id and subscription.matches(
+                            event[1], event[2]):
+                        subscription.offer(event)
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self.subscriptions.discard(subscription)
+            if subscription.email_ids is not None:
+                for email_id in subscription.email_ids:
+                    self._discard(self.by_email, email_id, subscription)
+            elif subscription.sender is not None:
+                self._discard(self.by_sender, subscription.sender,
+                              subscription)
+            else:
+                self.everything.discard(subscription)
+
+    @staticmethod
+    def _discard(index, key, subscription):
+        group = index.get(key)
+        if group is not None:
+            group.discard(subscription)
+            if not group:
+                del index[key]
+
+    def publish(self, changes):
+        """
+        changes are (email id, sender id, status)
+        """
+        with self.lock:
+            for email_id, sender_id, status in changes:
+                event = (next(self.ids), email_id, sender_id, status)
+                self.recent.append(event)
+                for group in (self.by_email.get(email_id),
+                              self.by_sender.get(sender_id),
+                              self.everything):
+                    for subscription in group or ():
+                        if subscription.matches(email_id, sender_id):
+                            subscription.offer(event)
+
+    def subscribers(self):
+        with self.lock:
+            return len(self.subscriptions)
+
+
+class StatusEvents:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('EVENTS_BUFFER_SIZE', 10000)
+        app.config.setdefault('EVENTS_QUEUE_SIZE', 1000)
+        app.config.setdefault('EVENTS_KEEPALIVE', 15)
+        app.config.setdefault('EVENTS_STREAM_SECONDS', 300)
+        app.config.setdefault('EVENTS_MAX_STREAMS', 16)
+        app.config.setdefault('EVENTS_RETRY_AFTER', 5)
+        app.extensions['events'] = _EventHub(
+            app.config['EVENTS_BUFFER_SIZE'],
+            app.config['EVENTS_MAX_STREAMS'])
+
+    @property
+    def state(self):
+        return current_app.extensions['events']
+
+    def publish(self, changes):
+        self.state.publish(changes)
+
+    def subscribe(self, email_ids=None, sender=None, last_event_id=None):
+        subscription = Subscription(email_ids, sender,
+                                    current_app.config['EVENTS_QUEUE_SIZE'])
+        self.state.subscribe(subscription, last_event_id)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self.state.unsubscribe(subscription)
+
+
+status_events = StatusEvents()
@@ -0,0 +1,61 @@
+import hashlib
+import os
+import uuid
+
+from flask import current_app
+
+from modules.metrics import metrics
+
+CHUNK_SIZE = 64 * 1024
+
+
+def store_root():
+    return os.path.join(current_app.root_path,
+                        current_app.config['ATTACHMENTS_DIR'])
+
+
+def content_path(sha256):
+    """
+    path of stored content relative to app root, sharded by first bytes
+    of the hash so no directory grows too big: attachments/ab/cd/abcd...
+    """
+    return os.path.join(current_app.config['ATTACHMENTS_DIR'], sha256[:2],
+                        sha256[2:4], sha256)
+
+
+def store_stream(stream):
+    """
+    copies stream to disk in chunks while hashing it,
+    content already stored under the same hash is not written again
+    returns (sha256, size, file_path relative to app root)
+    """
+    tmp_dir = os.path.join(store_root(), 'tmp')
+    os.makedirs(tmp_dir, exist_ok=True)
+    tmp_path = os.path.join(tmp_dir, str(uuid.uuid4()))
+
+    sha256 = hashlib.sha256()
+    size = 0
+    try:
+        with open(tmp_path, 'wb') as fp, metrics.timer(
+                'attachment_io_duration_seconds', 'store', phase='file'):
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                sha256.update(chunk)
+                fp.write(chunk)
+                size += len(chunk)
+
+        digest = sha256.hexdigest()
+        file_path = content_path(digest)
+        full_path = os.path.join(current_app.root_path, file_path)
+        if os.path.exists(full_path):
+            os.unlink(tmp_path)
+        else:
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            os.replace(tmp_path, full_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    return digest, size, file_path
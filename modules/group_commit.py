@@ -0,0 +1,103 @@
+import threading
+import time
+
+from sqlalchemy import bindparam
+
+from modules.database import Email, recipents_rels
+from modules.extensions import db
+
+email_table = Email.__table__
+
+update_email_status = email_table.update().where(
+    email_table.c.id == bindparam('b_email_id')).values(
+        status=bindparam('b_status'),
+        attempts=bindparam('b_attempts'),
+        next_attempt_at=bindparam('b_next_attempt_at'))
+
+update_recipent_status = recipents_rels.update().where(
+    (recipents_rels.c.email_id == bindparam('b_email_id'))
+    & (recipents_rels.c.recipent_id == bindparam('b_recipent_id'))).values(
+        status=bindparam('b_status'))
+
+
+def write_statuses(email_rows, recipent_rows):
+    """
+    executemany UPDATEs of email and recipent statuses, not committed
+    rows are dicts with b_email_id, b_status (and b_recipent_id),
+    email rows also with b_attempts and b_next_attempt_at
+    """
+    if email_rows:
+        db.session.execute(update_email_status, email_rows)
+    if recipent_rows:
+        db.session.execute(update_recipent_status, recipent_rows)
+
+
+class _Waiter:
+    def __init__(self, email_rows, recipent_rows):
+        self.email_rows = email_rows
+        self.recipent_rows = recipent_rows
+        self.done = threading.Event()
+        self.error = None
+
+
+class GroupCommitter:
+    """
+    writes status updates of many sending threads in one transaction
+
+    the first thread to arrive becomes the leader, waits up to window
+    seconds (or until max_rows emails are waiting) for others, then writes
+    all of them and commits once. Every caller returns only after its
+    rows are committed, so nothing is reported sent before it is stored
+    """
+    def __init__(self, window, max_rows):
+        self.window = window
+        self.max_rows = max_rows
+        self.waiting = []
+        self.waiting_rows = 0
+        self.has_leader = False
+        self.commits = 0
+        self.condition = threading.Condition()
+
+    def commit(self, email_rows, recipent_rows):
+        waiter = _Waiter(email_rows, recipent_rows)
+        with self.condition:
+            self.waiting.append(waiter)
+            self.waiting_rows += len(email_rows)
+            leader = not self.has_leader
+            self.has_leader = True
+            if not leader and self.waiting_rows >= self.max_rows:
+                self.condition.notify_all()
+
+        if leader:
+            self.lead()
+        else:
+            waiter.done.wait()
+        if waiter.error is not None:
+            raise waiter.error
+
+    def lead(self):
+        deadline = time.monotonic() + self.window
+        with self.condition:
+            while self.waiting_rows < self.max_rows:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            group, self.waiting = self.waiting, []
+            self.waiting_rows = 0
+            # next caller starts a new group while this one is written
+            self.has_leader = False
+
+        error = None
+        try:
+            write_statuses(
+                [row for waiter in group for row in waiter.email_rows],
+                [row for waiter in group for row in waiter.recipent_rows])
+            db.session.commit()
+            self.commits += 1
+        except Exception as e:
+            db.session.rollback()
+            error = e
+        for waiter in group:
+            waiter.error = error
+            waiter.done.set()
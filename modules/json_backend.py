@@ -0,0 +1,45 @@
+"""
+json encoding for big responses, with orjson or ujson when installed,
+falling back to the standard library
+"""
+import json
+
+from flask import Response
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+if orjson is not None:
+    BACKEND = 'orjson'
+
+    def dumps(obj):
+        return orjson.dumps(obj)
+elif ujson is not None:
+    BACKEND = 'ujson'
+
+    def dumps(obj):
+        return ujson.dumps(obj, ensure_ascii=False).encode()
+else:
+    BACKEND = 'json'
+    _encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+
+    def dumps(obj):
+        return _encoder.encode(obj).encode()
+
+
+def json_response(data, status=200, headers=None):
+    """
+    flask-restful passes Response objects through untouched,
+    so resources can return this instead of data to be encoded
+    """
+    return Response(dumps(data) + b'\n',
+                    status=status,
+                    headers=headers,
+                    mimetype='application/json')
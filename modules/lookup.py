@@ -0,0 +1,36 @@
+from flask import g
+
+from modules.database import Attachment, EmailUser
+
+MAX_IN_PARAMETERS = 900
+
+
+def _lookup(model, ids):
+    """
+    loads all given ids with one IN (...) query (per 900 ids),
+    results (also misses) are cached until the end of the request
+    returns dict id -> instance or None
+    """
+    caches = g.setdefault('lookup_cache', {})
+    cache = caches.setdefault(model.__tablename__, {})
+    missing = list(set(ids) - cache.keys())
+    # sqlite limits number of query parameters
+    for start in range(0, len(missing), MAX_IN_PARAMETERS):
+        chunk = missing[start:start + MAX_IN_PARAMETERS]
+        for instance in model.query.filter(model.id.in_(chunk)):
+            cache[instance.id] = instance
+        for instance_id in chunk:
+            cache.setdefault(instance_id, None)
+    return {instance_id: cache[instance_id] for instance_id in ids}
+
+
+def get_users(user_ids):
+    return _lookup(EmailUser, user_ids)
+
+
+def get_attachments(attachment_ids):
+    return _lookup(Attachment, attachment_ids)
+
+
+def clear_lookup_cache(exception=None):
+    g.pop('lookup_cache', None)
@@ -1,118 +1,483 @@
+import json
+import smtplib
+import time
 import uuid
+from collections import deque
+from datetime import datetime
 
-from flask import Blueprint, current_app, request
-from flask_mail import Message
+from flask import Blueprint, Response, current_app, request
 from flask_restful import Api, Resource
+from marshmallow import Schema, ValidationError
+from flask_mail import sanitize_address
+from sqlalchemy import bindparam, func
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm.attributes import set_committed_value
 from webargs import fields, validate
 from webargs.flaskparser import abort, parser, use_args, use_kwargs
 
-from modules.attachment import AttachmentResource
-from modules.database import Email
+from modules import search
+from modules.addresses import address_index
+from modules.archive import archive
+from modules.async_delivery import async_delivery
+from modules.bodies import MissingBodyError, message_bodies
+from modules.database import (Attachment, Email, EmailUser, recipents_archive,
+                              recipents_rels)
+from modules.delivery import delivery_queue
+from modules.events import TooManyStreams, status_events
 from modules.extensions import db
-from modules.extensions import mail as mailer
-from modules.user import UserResource
-from modules.validators import (attachment_must_exist_in_db,
-                                attachment_must_not_be_connected_to_email,
-                                email_must_exist_in_db, user_must_exist_in_db)
+from modules.group_commit import write_statuses
+from modules.json_backend import dumps, json_response
+from modules.lookup import MAX_IN_PARAMETERS, get_attachments, get_users
+from modules.metrics import metrics
+from modules.mime import MailMessage
+from modules.pagination import (InvalidCursor, keyset_query, page_size,
+                                paginate, pagination_args, stream_json)
+from modules.planner import plan_deliveries
+from modules.render_pool import render_pool
+from modules.resource_cache import resource_cache
+from modules.retry import error_status, outcome, refused_status
+from modules.smtp import CircuitOpenError, smtp_pool
+from modules.validators import (attachments_must_exist_in_db,
+                                attachments_must_not_be_connected_to_email,
+                                email_must_exist_in_db, user_must_exist_in_db,
+                                users_must_exist_in_db)
 
 mail_bp = Blueprint('mail', __name__)
 mail_api = Api(mail_bp)
 
+DATE_FORMAT = '%m/%d/%Y, %H:%M:%S'
+
 
 class MailResource(Resource):
     def connect_attachments_to_email(self, email, attachments_ids):
-        email_id = email.id
+        # single UPDATE, commited together with the email
         if attachments_ids:
-            for attachments_id in attachments_ids:
-                attachment = AttachmentResource.get_attachment(attachments_id)
-                if attachment:
-                    attachment.email_id = email_id
-            db.session.commit()
+            Attachment.query.filter(Attachment.id.in_(attachments_ids)).update(
+                {'email_id': email.id}, synchronize_session=False)
+
+    def connect_recipents_to_email(self, email, recipents_ids,
+                                   status='pending', statuses=None):
+        # executemany INSERT into association table instead of
+        # loading every recipent to append it to email.recipents
+        # statuses are {recipent id: status} overriding status
+        statuses = statuses or {}
+        rows = [{
+            'email_id': email.id,
+            'recipent_id': recipent_id,
+            'status': statuses.get(recipent_id, status)
+        } for recipent_id in dict.fromkeys(recipents_ids)]
+        if rows:
+            db.session.execute(recipents_rels.insert(), rows)
 
-    def save_message(self, msg: Message):
+    def save_message(self,
+                     msg: MailMessage,
+                     attempts=0,
+                     next_attempt_at=None,
+                     recipent_statuses=None):
         subject = msg.subject
-        body = msg.body
+        body, body_sha256 = message_bodies.store(msg.body)
         status = msg.status
         priority = msg.priority
         sender_id = msg.sender_id
 
         message = Email(subject=subject,
                         message=body,
+                        body_sha256=body_sha256,
                         status=status,
                         priority=priority,
-                        sender_id=sender_id)
-
-        recipents_ids = msg.recipents_ids
-        for recipent_id in recipents_ids:
-            recipent = UserResource.get_user(recipent_id)
-            message.recipents.append(recipent)
+                        sender_id=sender_id,
+                        attempts=attempts,
+                        next_attempt_at=next_attempt_at)
+        claimed_at = None
+        if status == 'sending':
+            # delivered by the async loop, if this process dies before the
+            # status is written the delivery queue claims it again after
+            # DELIVERY_CLAIM_TIMEOUT
+            claimed_at = message.claimed_at = datetime.utcnow()
 
         db.session.add(message)
-        db.session.commit()
+        db.session.flush()  # get id of the new email
+        if body_sha256:
+            search.index_bodies({message.id: msg.body})
 
+        self.connect_recipents_to_email(message, msg.recipents_ids, status,
+                                        recipent_statuses)
         self.connect_attachments_to_email(message, msg.attachments_ids)
+        db.session.commit()
+        resource_cache.invalidate('email', [message.id])
+        status_events.publish([(message.id, sender_id, status)])
+        if next_attempt_at is not None:
+            delivery_queue.schedule_retry(next_attempt_at)
+        elif status == 'sending':
+            delivery_queue.schedule_retry(claimed_at +
+                                          delivery_queue.claim_lease())
         return message.id
 
-    def send_message(self, msg: Message, extra_headers, attachment_ids):
-        try:
-            if attachment_ids:
-                files = self.get_attachments(attachment_ids)
-                if files:
-                    for file in files:
-                        with current_app.open_resource(file['filepath']) as fp:
-                            msg.attach(filename=file['name'],
-                                       content_type=file['content_type'],
-                                       data=fp.read)
+    def save_messages(self, specs):
+        """
+        bulk version of save_message for list of dicts with Email columns,
+        recipents_ids and attachments_ids; one transaction, executemany
+        INSERTs, returns ids of new emails in the same order
+        """
+        email_table = Email.__table__
+        columns = ('subject', 'status', 'priority', 'sender_id')
+        stored = {}  # campaigns repeat the same body
+        rows = []
+        for spec in specs:
+            row = {c: spec[c] for c in columns}
+            body = spec['message']
+            if body not in stored:
+                stored[body] = message_bodies.store(body)
+            row['message'], row['body_sha256'] = stored[body]
+            rows.append(row)
+        db.session.execute(email_table.insert(), rows)
+        # sqlite assigns consecutive rowids to rows inserted in one write
+        # transaction, last_insert_rowid() is the one of the last row
+        last_id = db.session.execute(func.last_insert_rowid()).scalar()
+        ids = list(range(last_id - len(specs) + 1, last_id + 1))
+        inserted = db.session.query(func.count(Email.id)).filter(
+            Email.id.between(ids[0], ids[-1])).scalar()
+        if inserted != len(specs):
+            db.session.rollback()
+            raise RuntimeError('Could not determine ids of inserted emails')
+
+        search.index_bodies({
+            email_id: spec['message']
+            for email_id, spec, row in zip(ids, specs, rows)
+            if row['body_sha256']
+        })
+
+        recipents = []
+        attachments = []
+        for email_id, spec in zip(ids, specs):
+            recipents.extend({
+                'email_id': email_id,
+                'recipent_id': recipent_id,
+                'status': spec['status']
+            } for recipent_id in dict.fromkeys(spec['recipents_ids']))
+            attachments.extend({
+                'attachment_id': attachment_id,
+                'email_id': email_id
+            } for attachment_id in spec['attachments_ids'] or [])
+        if recipents:
+            db.session.execute(recipents_rels.insert(), recipents)
+        if attachments:
+            attachment_table = Attachment.__table__
+            db.session.execute(
+                attachment_table.update().where(
+                    attachment_table.c.id == bindparam('attachment_id')).
+                values(email_id=bindparam('email_id')), attachments)
+        db.session.commit()
+        status_events.publish([(email_id, spec['sender_id'], spec['status'])
+                               for email_id, spec in zip(ids, specs)])
+        return ids
+
+    def render(self, msg: MailMessage, attachments):
+        """
+        starts rendering msg to bytes, in a worker process when attachments
+        are big, returns function waiting for it
+        """
+        future = render_pool.submit(msg, attachments)
+        if future is not None:
+            def wait():
+                msg.rendered = future.result()
+                return msg
+
+            return wait
+
+        for attachment in attachments:
+            # read and encoded once, shared by all emails using it
+            msg.attach_encoded(attachment)
+        msg.render()
+        return lambda: msg
 
+    def send_message(self, msg: MailMessage, extra_headers, attachments):
+        """
+        returns (status, refused), status is 'sent', 'failed' or 'deferred'
+        if it can be tried again, refused is {address: (code, response)}
+        of recipients rejected by the relay
+        """
+        refused = {}
+        try:
             msg.extra_headers = extra_headers
-            mailer.send(msg)
-        except ConnectionRefusedError:
-            print('Could not connect to SMTP server')
+            self.render(msg, list(attachments or []))()
+            refused = smtp_pool.send(msg)
+        except ConnectionRefusedError as e:
+            current_app.logger.error('Could not connect to SMTP server')
+            metrics.inc('email_send_errors_total', type(e).__name__)
+            status = error_status(e)
+        except CircuitOpenError as e:
+            # relay is down, no need to log an error for every email
+            metrics.inc('email_send_errors_total', type(e).__name__)
+            status = error_status(e)
+        except smtplib.SMTPRecipientsRefused as e:
+            metrics.inc('email_send_errors_total', type(e).__name__)
+            refused = e.recipients
             status = 'failed'
         except Exception as e:
-            print(f'Send error: {e}')
-            status = 'failed'
+            current_app.logger.exception('Send error')
+            metrics.inc('email_send_errors_total', type(e).__name__)
+            status = error_status(e)
         else:
             status = 'sent'
-        finally:
-            return status
+        return status, refused
 
     def get_headers(self, priority=None):
         headers = {}
         if priority:
-            headers['X-Priority'] = priority
+            headers['X-Priority'] = str(priority)
         return headers
 
+    def build_message(self, email, merged=False):
+        """
+        MailMessage of saved email, without attachments,
+        merged message is shared by many emails and does not list recipents
+        """
+        if merged:
+            recipents = ['undisclosed-recipients:;']
+        else:
+            recipents = [
+                recipent.email_address for recipent in email.recipents
+            ]
+        msg = MailMessage(subject=email.subject,
+                          recipients=recipents,
+                          body=message_bodies.text(email),
+                          sender=email.sender.email_address)
+        msg.extra_headers = self.get_headers(priority=email.priority)
+        return msg
+
+    def render_messages(self, plan):
+        """
+        renders every content of the plan once, for all its envelopes,
+        big ones in parallel in the render pool
+        returns {key: rendered MailMessage or None if rendering failed}
+        """
+        pending = {}
+        for key, emails in plan.messages.items():
+            try:
+                msg = self.build_message(emails[0], merged=len(emails) > 1)
+                pending[key] = self.render(msg, emails[0].attachments)
+            except Exception as e:
+                current_app.logger.exception('Render error')
+                metrics.inc('email_send_errors_total', type(e).__name__)
+                pending[key] = lambda: None
+
+        messages = {}
+        for key, wait in pending.items():
+            try:
+                messages[key] = wait()
+            except Exception as e:
+                current_app.logger.exception('Render error')
+                metrics.inc('email_send_errors_total', type(e).__name__)
+                messages[key] = None
+        return messages
+
+    def send_envelope(self, msg, envelope):
+        """
+        returns {(email_id, recipent_id): status} for envelope recipents,
+        'deferred' for temporary failures (4xx, relay down)
+        """
+        refused = {}
+        try:
+            if msg is None:
+                raise ValueError('message could not be rendered')
+            refused = smtp_pool.send(msg, envelope_to=envelope.addresses)
+        except ConnectionRefusedError as e:
+            current_app.logger.error('Could not connect to SMTP server')
+            metrics.inc('email_send_errors_total', type(e).__name__)
+            status = error_status(e)
+        except CircuitOpenError as e:
+            # relay is down, no need to log an error for every envelope
+            metrics.inc('email_send_errors_total', type(e).__name__)
+            status = error_status(e)
+        except smtplib.SMTPRecipientsRefused as e:
+            metrics.inc('email_send_errors_total', type(e).__name__)
+            refused = e.recipients
+            status = 'failed'
+        except Exception as e:
+            current_app.logger.exception('Send error')
+            metrics.inc('email_send_errors_total', type(e).__name__)
+            status = error_status(e)
+        else:
+            status = 'sent'
+        results = {}
+        for recipent in envelope.recipents:
+            refusal = refused.get(sanitize_address(recipent.address))
+            results[(recipent.email_id, recipent.recipent_id)] = (
+                refused_status(refusal[0]) if refusal else status)
+        return results
+
+    def send_plan(self, plan, throttle=None):
+        """
+        sends envelopes of delivery plan, envelopes to throttled domains
+        wait while the others are sent
+        returns {(email_id, recipent_id): status}
+        """
+        messages = self.render_messages(plan)
+        results = {}
+        envelopes = deque(plan.envelopes)
+        while envelopes:
+            deferred = deque()
+            wait = None
+            for envelope in envelopes:
+                envelope_wait = throttle.try_acquire(
+                    {envelope.domain}) if throttle else 0
+                if envelope_wait:
+                    deferred.append(envelope)
+                    wait = min(wait or envelope_wait, envelope_wait)
+                    continue
+                results.update(
+                    self.send_envelope(messages[envelope.key], envelope))
+            if deferred:
+                time.sleep(wait)
+            envelopes = deferred
+        return results
+
+    def save_statuses(self, emails, results):
+        """
+        writes per recipent results and status of every email, which is
+        sent only if all its recipents were accepted, pending again if some
+        were deferred (see modules.retry), in one transaction
+        (shared with other sending threads with DELIVERY_GROUP_COMMIT)
+        returns {email_id: status}
+        """
+        statuses = {}
+        rows = []
+        email_rows = []
+        for email in emails:
+            email_status, recipent_statuses, attempts, next_attempt_at = (
+                outcome([
+                    results.get((email.id, recipent.id), 'failed')
+                    for recipent in email.recipents
+                ], email.attempts))
+            rows.extend({
+                'b_email_id': email.id,
+                'b_recipent_id': recipent.id,
+                # deferred recipents wait for the next attempt
+                'b_status': 'pending' if status == 'deferred' else status
+            } for recipent, status in zip(email.recipents, recipent_statuses))
+            # written below with UPDATE, not as a change of the object
+            set_committed_value(email, 'status', email_status)
+            set_committed_value(email, 'attempts', attempts)
+            set_committed_value(email, 'next_attempt_at', next_attempt_at)
+            email_rows.append({
+                'b_email_id': email.id,
+                'b_status': email_status,
+                'b_attempts': attempts,
+                'b_next_attempt_at': next_attempt_at
+            })
+            statuses[email.id] = email_status
+            metrics.inc('email_send_total', email_status)
+            for status in recipent_statuses:
+                metrics.inc('email_recipents_total', status)
+
+        committer = delivery_queue.state.committer
+        if committer is not None:
+            committer.commit(email_rows, rows)
+        else:
+            write_statuses(email_rows, rows)
+            db.session.commit()
+        resource_cache.invalidate('email', statuses)
+        status_events.publish([(email.id, email.sender_id, statuses[email.id])
+                               for email in emails])
+        return statuses
+
+    def send_saved_emails(self, emails, throttle=None):
+        """
+        sends emails grouped by recipent domain (see planner),
+        returns {email_id: status}
+        """
+        config = current_app.config
+        accepted = self.accepted_recipents(emails)
+        plan = plan_deliveries(emails,
+                               config['DELIVERY_MAX_RECIPENTS'],
+                               config['DELIVERY_MERGE_IDENTICAL'],
+                               skip=accepted)
+        results = self.send_plan(plan, throttle)
+        results.update(dict.fromkeys(accepted, 'sent'))
+        return self.save_statuses(emails, results)
+
+    def accepted_recipents(self, emails):
+        """
+        {(email_id, recipent_id)} already sent in earlier attempts of
+        retried emails, those are not sent again
+        """
+        retried = [email.id for email in emails if email.attempts]
+        if not retried:
+            return set()
+        rows = db.session.query(
+            recipents_rels.c.email_id, recipents_rels.c.recipent_id).filter(
+                recipents_rels.c.email_id.in_(retried),
+                recipents_rels.c.status == 'sent')
+        return {(row.email_id, row.recipent_id) for row in rows}
+
     def send_saved_email(self, email):
-        # create msg instance from db data
-        attachments_ids = email.attachments
-        subject = email.subject
-        body = email.message
-        priority = email.priority
-
-        sender = email.sender.email_address
-        recipents = [recipent.email_address for recipent in email.recipents]
-
-        msg = Message(subject=subject,
-                      recipients=recipents,
-                      body=body,
-                      sender=sender)
-
-        headers = self.get_headers(priority=priority)
-        status = self.send_message(msg=msg,
-                                   extra_headers=headers,
-                                   attachment_ids=attachments_ids)
-        email.status = status
-        db.session.commit()
-        return status
+        return self.send_saved_emails([email])[email.id]
+
+    def recipent_statuses(self, email_id, table=recipents_rels):
+        rows = db.session.query(
+            EmailUser.id, EmailUser.email_address, table.c.status).join(
+                table, table.c.recipent_id == EmailUser.id).filter(
+                    table.c.email_id == email_id).order_by(EmailUser.id)
+        return [{
+            'id': row.id,
+            'address': row.email_address,
+            'status': row.status
+        } for row in rows]
+
+    @staticmethod
+    def missing_users(users):
+        """
+        errors if neither ids nor addresses of sender or receipents are given
+        """
+        errors = {}
+        if users.get('sender') is None and users.get('sender_email') is None:
+            errors['sender'] = ['Missing data for required field.']
+        if (users.get('receipents') is None
+                and users.get('receipents_emails') is None):
+            errors['receipents'] = ['Missing data for required field.']
+        return errors
+
+    @staticmethod
+    def addresses(users):
+        # addresses given instead of ids, ids win if both are given
+        addresses = []
+        if users.get('sender') is None:
+            addresses.append(users['sender_email'])
+        if users.get('receipents') is None:
+            addresses.extend(users['receipents_emails'])
+        return addresses
+
+    def resolve_users(self, users, ids):
+        """
+        returns (sender id, sender address, [(recipent id, address)]),
+        ids is {address: user id} of addresses(users)
+        """
+        # users given by id are already loaded by validators
+        given = [users.get('sender'), *(users.get('receipents') or [])]
+        loaded = get_users(
+            [user_id for user_id in given if user_id is not None])
+        if users.get('sender') is None:
+            sender = ids[users['sender_email']]
+            sender_email = users['sender_email']
+        else:
+            sender = users['sender']
+            sender_email = loaded[sender].email_address
+        if users.get('receipents') is None:
+            recipents = [(ids[address], address)
+                         for address in users['receipents_emails']]
+        else:
+            recipents = [(receipent, loaded[receipent].email_address)
+                         for receipent in users['receipents']]
+        return sender, sender_email, recipents
 
     def serialize_email(self, email):
         # this can be done with marshammlow in production environment
         d = {}
         d['id'] = email.id
-        d['date'] = email.pub_date.strftime("%m/%d/%Y, %H:%M:%S")
+        d['date'] = email.pub_date.strftime(DATE_FORMAT)
         d['subject'] = email.subject
-        d['message'] = email.message
+        d['message'] = message_bodies.text(email)
         d['status'] = email.status
         return d
 
@@ -125,25 +490,45 @@ class Mail(MailResource):
         },
         location='view_args')
     def get(self, email_id):
-        # get email details
+        # get email details, repeated polls are answered from the cache
+        try:
+            return resource_cache.response('email', email_id,
+                                           lambda: self.load_email(email_id))
+        except MissingBodyError as e:
+            abort(404, errors={'email_id': [str(e)]})
+
+    def load_email(self, email_id):
         email = Email.query.get(email_id)
-        return self.serialize_email(email)
+        if email is None:  # old sent email, moved to the archive
+            serialized = self.serialize_email(archive.get_email(email_id))
+            serialized['recipents'] = self.recipent_statuses(
+                email_id, recipents_archive)
+            return serialized
+        serialized = self.serialize_email(email)
+        serialized['recipents'] = self.recipent_statuses(email.id)
+        return serialized
 
     mail_args = {
         'receipents':
-        fields.DelimitedList(fields.Integer(validate=user_must_exist_in_db),
-                             required=True),
+        fields.DelimitedList(fields.Integer(),
+                             validate=users_must_exist_in_db),
         'sender':
-        fields.Integer(validate=user_must_exist_in_db, required=True),
+        fields.Integer(validate=user_must_exist_in_db),
+        # or addresses, users that do not exist yet are created
+        'receipents_emails':
+        fields.DelimitedList(fields.Email()),
+        'sender_email':
+        fields.Email(),
         'subject':
         fields.String(required=True),
         'message':
         fields.String(required=True),
         'attachments':
-        fields.DelimitedList(fields.Int(validate=[
-            attachment_must_exist_in_db,
-            attachment_must_not_be_connected_to_email
-        ]),
+        fields.DelimitedList(fields.Int(),
+                             validate=[
+                                 attachments_must_exist_in_db,
+                                 attachments_must_not_be_connected_to_email
+                             ],
                              required=False),
         'send_now':
         fields.Boolean(required=False),
@@ -154,34 +539,68 @@ class Mail(MailResource):
 
     @use_kwargs(mail_args, location='json')
     def post(self,
-             receipents,
-             sender,
              subject,
              message,
+             receipents=None,
+             sender=None,
+             receipents_emails=None,
+             sender_email=None,
              attachments=None,
              send_now=False,
              priority=None):
         """
         http POST localhost:8887/email message='asd' subject='asd' sender_email='sendermail@a.pl'\
              receipents_emails='firstmail@a.pl,secondmail@a.pl' send_now=true
-        create new email
+        create new email, sender and receipents are given by user ids
+        (sender, receipents) or addresses (sender_email, receipents_emails)
         """
-        sender_email = UserResource.get_user(sender).email_address
-        receipents_emails = [
-            UserResource.get_user(receipent).email_address
-            for receipent in receipents
-        ]
+        users = {
+            'sender': sender,
+            'receipents': receipents,
+            'sender_email': sender_email,
+            'receipents_emails': receipents_emails
+        }
+        errors = self.missing_users(users)
+        if errors:
+            abort(422, errors={'json': errors})
+        sender, sender_email, recipents = self.resolve_users(
+            users, address_index.resolve(self.addresses(users)))
+        receipents = [receipent for receipent, _ in recipents]
+
+        msg = MailMessage(subject=subject,
+                          recipients=[address for _, address in recipents],
+                          body=message,
+                          sender=sender_email)
 
-        msg = Message(subject=subject,
-                      recipients=receipents_emails,
-                      body=message,
-                      sender=sender_email)
+        if send_now and async_delivery.enabled():
+            return self.post_async(msg, sender, recipents, attachments,
+                                   priority)
 
+        attempts = 0
+        next_attempt_at = None
+        recipent_statuses = None
         if send_now:
             headers = self.get_headers(priority=priority)
-            status = self.send_message(msg=msg,
-                                       extra_headers=headers,
-                                       attachment_ids=attachments)
+            # attachments are already loaded by validators
+            email_attachments = get_attachments(attachments or []).values()
+            send_status, refused = self.send_message(
+                msg=msg, extra_headers=headers, attachments=email_attachments)
+            results = {}
+            for receipent, address in recipents:
+                refusal = refused.get(sanitize_address(address))
+                results[receipent] = (refused_status(refusal[0])
+                                      if refusal else send_status)
+            # temporary failures are retried by the delivery queue later
+            status, statuses, attempts, next_attempt_at = outcome(
+                list(results.values()), 0)
+            # deferred recipents wait for the next attempt
+            recipent_statuses = {
+                receipent: 'pending' if value == 'deferred' else value
+                for receipent, value in zip(results, statuses)
+            }
+            metrics.inc('email_send_total', status)
+            for recipent_status in statuses:
+                metrics.inc('email_recipents_total', recipent_status)
         else:
             status = 'pending'
 
@@ -191,33 +610,424 @@ class Mail(MailResource):
         msg.sender_id = sender
         msg.recipents_ids = receipents
 
-        message_id = self.save_message(msg)
+        message_id = self.save_message(msg, attempts, next_attempt_at,
+                                       recipent_statuses)
         return {'id': message_id, 'status': status}
 
+    def post_async(self, msg, sender, recipents, attachments, priority):
+        """
+        send_now with SEND_NOW_ASYNC: email is saved as 'sending' and
+        delivered by the event loop, the request does not wait for SMTP
+        recipents are [(user id, address)]
+        """
+        msg.extra_headers = self.get_headers(priority=priority)
+        try:
+            email_attachments = get_attachments(attachments or []).values()
+            self.render(msg, list(email_attachments))()
+            status = 'sending'
+        except Exception as e:
+            current_app.logger.exception('Render error')
+            metrics.inc('email_send_errors_total', type(e).__name__)
+            status = 'failed'
+
+        msg.attachments_ids = attachments
+        msg.priority = priority
+        msg.status = status
+        msg.sender_id = sender
+        msg.recipents_ids = [receipent for receipent, _ in recipents]
+        message_id = self.save_message(msg)
+
+        if status == 'sending':
+            async_delivery.submit(message_id, msg,
+                                  list(dict.fromkeys(recipents)))
+        return {'id': message_id, 'status': status}, 202
+
 
 class MailList(MailResource):
-    def get(self):
+    list_args = {
+        'status': fields.String(),
+        'sender': fields.Int(),
+        'order': fields.String(validate=validate.OneOf(['id', 'pub_date'])),
+        **pagination_args
+    }
+
+    # listings select only these columns as tuples, no ORM objects,
+    # date is formatted by sqlite, pub_date is there for the cursor,
+    # big bodies stored in message_body are not loaded (message is null)
+    listing_columns = (Email.id,
+                       func.strftime(DATE_FORMAT, Email.pub_date).label('date'),
+                       Email.subject, Email.message, Email.status,
+                       Email.pub_date)
+
+    @staticmethod
+    def serialize_row(row):
+        # same as serialize_email, for a row of listing_columns
+        return {
+            'id': row[0],
+            'date': row[1],
+            'subject': row[2],
+            'message': row[3],
+            'status': row[4]
+        }
+
+    def listing_query(self, status=None, sender=None):
+        query = db.session.query(*self.listing_columns)
+        if status:
+            query = query.filter(Email.status == status)
+        if sender:
+            query = query.filter(Email.sender_id == sender)
+        return query
+
+    @use_kwargs(list_args, location='query')
+    def get(self,
+            limit=None,
+            cursor=None,
+            stream=False,
+            status=None,
+            sender=None,
+            order='id'):
         """
-        get list of all emails in the system
-        http localhost:8887/emails
+        get list of emails in the system, page by page
+        http localhost:8887/emails limit==50 status==pending sender==1
+        next page: http localhost:8887/emails cursor==<X-Next-Cursor header>
+        whole list as stream: http --stream localhost:8887/emails stream==true
         """
-        # possibly add pagination/limits
-        return [self.serialize_email(email) for email in Email.query.all()]
+        query = self.listing_query(status, sender)
+        if order == 'pub_date':
+            columns = [Email.pub_date, Email.id]
+        else:
+            columns = [Email.id]
+
+        try:
+            if stream:
+                query = keyset_query(query, columns, cursor)
+                if limit:
+                    query = query.limit(limit)
+                return stream_json(query.yield_per(1000), self.serialize_row)
+            rows, next_cursor = paginate(query, columns, cursor,
+                                         page_size(limit))
+        except InvalidCursor:
+            abort(400, errors={'cursor': ['Invalid cursor']})
+
+        headers = {'X-Next-Cursor': next_cursor} if next_cursor else {}
+        serialize = self.serialize_row
+        return json_response([serialize(row) for row in rows],
+                             headers=headers)
 
     def post(self):
         """
-        send all pending
+        send all pending in background workers
         http POST localhost:8887/emails
+        returns job id, progress is available at /emails/jobs/<job_id>
         """
-        pending_emails = Email.query.filter_by(status='pending').all()
-        # as I am not sending any emails I do not care about failed emails
-        # otherwise query 'failed' here as well
-        if not pending_emails:
+        # temporary failures are back in 'pending' with next_attempt_at,
+        # permanent ones stay 'failed' and 'dead' after the last attempt
+        job = delivery_queue.submit()
+        if not job:
             return {'status': 'no pending mails'}
-        for email in pending_emails:
-            # this could be sent to queue / async code (not in flask)
-            status = self.send_saved_email(email)
-        return {'status': 'ok'}
+        return job.serialize(), 202
+
+
+class MailSearch(MailResource):
+    search_args = {
+        'q': fields.String(required=True, validate=validate.Length(min=1)),
+        'status': fields.String(),
+        'sender': fields.Int(),
+        'since': fields.DateTime(),
+        'until': fields.DateTime(),
+        'limit': pagination_args['limit'],
+        'cursor': pagination_args['cursor']
+    }
+
+    @staticmethod
+    def serialize_row(row):
+        return {
+            'id': row.id,
+            'date': row.date,
+            'subject': row.subject,
+            'snippet': row.snippet,
+            'status': row.status
+        }
+
+    def search_query(self, q, status=None, sender=None, since=None,
+                     until=None):
+        # rows come from the FTS index, email is only joined by id
+        fts = search.search_table
+        query = db.session.query(
+            Email.id,
+            func.strftime(DATE_FORMAT, Email.pub_date).label('date'),
+            Email.subject,
+            func.snippet(search.search_match, 1, '[', ']', '...',
+                         16).label('snippet'), Email.status,
+            fts.c.rank.label('rank')).select_from(fts).join(
+                Email, Email.id == fts.c.rowid).filter(
+                    search.search_match.match(q))
+        if status:
+            query = query.filter(Email.status == status)
+        if sender:
+            query = query.filter(fts.c.sender_id == sender)
+        if since:
+            query = query.filter(fts.c.pub_date >= since)
+        if until:
+            query = query.filter(fts.c.pub_date < until)
+        return query
+
+    @use_kwargs(search_args, location='query')
+    def get(self, q, limit=None, cursor=None, **filters):
+        """
+        full text search in subjects and messages, best matches first
+        http localhost:8887/emails/search q=='invoice OR receipt' status==sent
+        next page: same query with cursor==<X-Next-Cursor header>
+        """
+        query = self.search_query(q, **filters)
+        columns = [search.search_table.c.rank, Email.id]
+        try:
+            rows, next_cursor = paginate(query, columns, cursor,
+                                         page_size(limit))
+        except InvalidCursor:
+            abort(400, errors={'cursor': ['Invalid cursor']})
+        except OperationalError as e:
+            # FTS5 query syntax errors, e.g. unbalanced quotes
+            db.session.rollback()
+            abort(400, errors={'q': [str(e.orig)]})
+
+        headers = {'X-Next-Cursor': next_cursor} if next_cursor else {}
+        serialize = self.serialize_row
+        return json_response([serialize(row) for row in rows],
+                             headers=headers)
+
+
+class MailJob(MailResource):
+    def get(self, job_id):
+        """
+        progress of sending pending emails
+        http localhost:8887/emails/jobs/<job_id>
+        """
+        job = delivery_queue.get_job(job_id)
+        if not job:
+            abort(404, errors={'job_id': [f'Job {job_id} does not exist']})
+        return job.serialize()
+
+
+class MailEvents(MailResource):
+    events_args = {
+        'email_id': fields.DelimitedList(fields.Int()),
+        'sender': fields.Int(),
+    }
+
+    @staticmethod
+    def format_event(event):
+        event_id, email_id, sender_id, status = event
+        data = dumps({'id': email_id, 'sender': sender_id, 'status': status})
+        # current statuses sent on connect have no id, Last-Event-ID of
+        # the client stays at the last published event it got
+        head = f'id: {event_id}\n' if event_id is not None else ''
+        return f'{head}event: status\ndata: '.encode() + data + b'\n\n'
+
+    @staticmethod
+    def last_event_id():
+        try:
+            return int(request.headers['Last-Event-ID'])
+        except (KeyError, ValueError):
+            return None
+
+    @staticmethod
+    def current_statuses(email_ids, sender=None):
+        events = []
+        email_ids = list(dict.fromkeys(email_ids))
+        for start in range(0, len(email_ids), MAX_IN_PARAMETERS):
+            chunk = email_ids[start:start + MAX_IN_PARAMETERS]
+            query = db.session.query(Email.id, Email.sender_id,
+                                     Email.status).filter(Email.id.in_(chunk))
+            if sender:
+                query = query.filter(Email.sender_id == sender)
+            events.extend((None, ) + tuple(row) for row in query)
+        return events
+
+    def stream(self, subscription, events, keepalive, seconds):
+        # runs after the request context is gone, an idle stream holds
+        # no database session, only its subscription
+        deadline = time.monotonic() + seconds
+        yield b': subscribed\n\n'
+        for event in events:
+            yield self.format_event(event)
+        while not subscription.overflowed:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            event = subscription.get(min(keepalive, remaining))
+            if event is None:
+                yield b': keepalive\n\n'
+            else:
+                yield self.format_event(event)
+
+    @use_kwargs(events_args, location='query')
+    def get(self, email_id=None, sender=None):
+        """
+        server-sent events with status changes of emails instead of polling
+        GET /email/<id>, of given emails and/or sender or of all of them
+        http --stream localhost:8887/emails/events email_id==1,2 sender==3
+        reconnecting clients send Last-Event-ID and get the missed events
+        """
+        config = current_app.config
+        last_event_id = self.last_event_id()
+        try:
+            subscription = status_events.subscribe(email_id, sender,
+                                                   last_event_id)
+        except TooManyStreams:
+            # threads of this worker are kept for the API
+            return {
+                'errors': {
+                    'events': ['Too many open streams, try again later']
+                }
+            }, 503, {
+                'Retry-After': str(config['EVENTS_RETRY_AFTER'])
+            }
+        events = []
+        try:
+            if email_id and last_event_id is None:
+                # changed before the client connected
+                events = self.current_statuses(email_id, sender)
+        except Exception:
+            status_events.unsubscribe(subscription)
+            raise
+        stream = self.stream(subscription, events,
+                             config['EVENTS_KEEPALIVE'],
+                             config['EVENTS_STREAM_SECONDS'])
+        response = Response(stream,
+                            mimetype='text/event-stream',
+                            headers={
+                                'Cache-Control': 'no-cache',
+                                'X-Accel-Buffering': 'no'  # nginx
+                            })
+        # the server closes the response when the client is gone, also
+        # before the generator started, where its finally would not run
+        hub = status_events.state
+        response.call_on_close(lambda: hub.unsubscribe(subscription))
+        return response
+
+
+class MailBatch(MailResource):
+    schema = Schema.from_dict(Mail.mail_args)
+
+    def read_items(self):
+        """
+        json array of emails or ndjson (one email per line)
+        """
+        try:
+            if request.mimetype == 'application/x-ndjson':
+                items = [
+                    json.loads(line) for line in request.stream
+                    if line.strip()
+                ]
+            else:
+                items = json.loads(request.get_data())
+        except ValueError:
+            abort(400, errors={'json': ['Invalid JSON']})
+        if not isinstance(items, list):
+            abort(400, errors={'json': ['Expected list of emails']})
+        max_size = current_app.config['MAX_BATCH_SIZE']
+        if len(items) > max_size:
+            abort(413,
+                  errors={'json': [f'Batch can have at most {max_size} emails']})
+        return items
+
+    @staticmethod
+    def raw_ids(value):
+        # ids before validation, only used to prefetch rows
+        if isinstance(value, str):
+            value = value.split(',')
+        elif not isinstance(value, list):
+            value = [value]
+        ids = []
+        for v in value:
+            try:
+                ids.append(int(v))
+            except (TypeError, ValueError):
+                pass
+        return ids
+
+    def prefetch(self, items):
+        # load rows for validators of all emails with one query per table
+        user_ids = set()
+        attachment_ids = set()
+        for item in items:
+            if isinstance(item, dict):
+                user_ids.update(self.raw_ids(item.get('sender')))
+                user_ids.update(self.raw_ids(item.get('receipents')))
+                attachment_ids.update(self.raw_ids(item.get('attachments')))
+        get_users(user_ids)
+        get_attachments(attachment_ids)
+
+    def post(self):
+        """
+        create many emails at once, accepts list of objects same as POST /email
+        http POST localhost:8887/emails/batch < emails.json
+        returns id or errors for every email, send_now emails are queued
+        """
+        items = self.read_items()
+        self.prefetch(items)
+
+        schema = self.schema()
+        results = []
+        specs = []
+        used_attachments = set()
+        for index, item in enumerate(items):
+            try:
+                data = schema.load(item)
+                attachments = data.get('attachments') or []
+                if used_attachments.intersection(attachments):
+                    raise ValidationError(
+                        {'attachments': ['Attachment used twice in batch']})
+                errors = self.missing_users(data)
+                if errors:
+                    raise ValidationError(errors)
+            except ValidationError as err:
+                results.append({'index': index, 'errors': err.messages})
+                continue
+            used_attachments.update(attachments)
+            results.append({'index': index})
+            specs.append({
+                'subject': data['subject'],
+                'message': data['message'],
+                'status': 'pending',
+                'priority': data.get('priority'),
+                'users': data,
+                'attachments_ids': attachments,
+                'send_now': data.get('send_now', False),
+                'result': results[-1]
+            })
+
+        job = None
+        if specs:
+            # addresses of the whole batch resolved at once
+            address_ids = address_index.resolve([
+                address for spec in specs
+                for address in self.addresses(spec['users'])
+            ])
+            for spec in specs:
+                sender, _, recipents = self.resolve_users(
+                    spec.pop('users'), address_ids)
+                spec['sender_id'] = sender
+                spec['recipents_ids'] = [
+                    receipent for receipent, _ in recipents
+                ]
+            ids = self.save_messages(specs)
+            for email_id, spec in zip(ids, specs):
+                spec['result'].update(id=email_id, status='pending')
+            send_now = [
+                email_id for email_id, spec in zip(ids, specs)
+                if spec['send_now']
+            ]
+            if send_now:
+                job = delivery_queue.submit(email_ids=send_now)
+
+        return {
+            'results': results,
+            'created': len(specs),
+            'failed': len(items) - len(specs),
+            'job': job.serialize() if job else None
+        }
 
 
 @parser.error_handler
@@ -231,4 +1041,8 @@ def handle_request_parsing_error(err, req, schema, *, error_status_code,
 
 
 mail_api.add_resource(MailList, '/emails')
+mail_api.add_resource(MailBatch, '/emails/batch')
+mail_api.add_resource(MailSearch, '/emails/search')
+mail_api.add_resource(MailJob, '/emails/jobs/<job_id>')
+mail_api.add_resource(MailEvents, '/emails/events')
 mail_api.add_resource(Mail, '/email/<email_id>', '/email')
@@ -0,0 +1,301 @@
+"""
+request, database, SMTP and queue metrics in Prometheus text format
+
+every request records its latency and the part of it spent in database
+queries, SMTP and attachment file I/O (the rest is validation and
+serialization), so slow sends can be tracked to their cause. Metrics are
+kept in memory of the process, /metrics returns them for scraping
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import (Blueprint, Response, current_app, g, has_app_context,
+                   has_request_context, request)
+from sqlalchemy import event, func
+from sqlalchemy.engine import Engine
+
+from modules.database import Email
+from modules.extensions import db
+
+metrics_bp = Blueprint('metrics', __name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1, 2.5, 5, 10)
+# queries in one request
+QUERY_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100, 500)
+# time of a request not spent in database, SMTP or file I/O is 'other'
+PHASES = ('db', 'smtp', 'file')
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace(
+        '\n', r'\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"'
+                          for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            values = dict(self.values)
+        for labels, value in sorted(values.items()):
+            yield self.name, _format_labels(self.labelnames, labels), value
+
+
+class Gauge(Counter):
+    """
+    value is computed by collect() on every scrape,
+    it returns {label values: value}
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), collect=None):
+        super().__init__(name, documentation, labelnames)
+        self.collect = collect
+
+    def samples(self):
+        if self.collect:
+            with self.lock:
+                self.values = self.collect()
+        yield from super().samples()
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self,
+                 name,
+                 documentation,
+                 labelnames=(),
+                 buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        # label values -> [count per bucket (last one is +Inf), sum]
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                entry = self.values[labels] = [[0] * (len(self.buckets) + 1),
+                                               0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def samples(self):
+        with self.lock:
+            values = {
+                labels: (list(counts), total)
+                for labels, (counts, total) in self.values.items()
+            }
+        bounds = self.buckets + (float('inf'), )
+        for labels, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                yield (f'{self.name}_bucket',
+                       _format_labels(self.labelnames, labels,
+                                      [('le', _format_value(bound))]),
+                       cumulative)
+            label_text = _format_labels(self.labelnames, labels)
+            yield f'{self.name}_sum', label_text, total
+            yield f'{self.name}_count', label_text, cumulative
+
+
+def queue_depth():
+    # both statuses are a range of the status index
+    rows = db.session.query(Email.status, func.count(Email.id)).filter(
+        Email.status.in_(['pending', 'sending'])).group_by(Email.status)
+    depth = {('pending', ): 0, ('sending', ): 0}
+    depth.update({(status, ): count for status, count in rows})
+    return depth
+
+
+class _MetricsState:
+    def __init__(self):
+        metrics = [
+            Counter('http_requests_total', 'Handled requests',
+                    ('method', 'endpoint', 'status')),
+            Histogram('http_request_duration_seconds', 'Request latency',
+                      ('method', 'endpoint')),
+            Histogram('http_request_phase_seconds',
+                      'Request time spent in database, SMTP, file I/O '
+                      'and everything else', ('endpoint', 'phase')),
+            Histogram('http_request_db_queries',
+                      'Database queries per request', ('endpoint', ),
+                      buckets=QUERY_BUCKETS),
+            Histogram('db_query_duration_seconds', 'Database query time'),
+            Histogram('smtp_connect_duration_seconds',
+                      'SMTP connect, EHLO, STARTTLS and login time',
+                      ('reconnect', )),
+            Histogram('smtp_send_duration_seconds',
+                      'SMTP transaction time', ('outcome', )),
+            Histogram('attachment_io_duration_seconds',
+                      'Attachment storing and encoding time',
+                      ('operation', )),
+            Counter('email_send_total', 'Emails by final send status',
+                    ('status', )),
+            Counter('email_recipents_total',
+                    'Recipents by final send status', ('status', )),
+            Counter('email_send_errors_total', 'Send errors by type',
+                    ('error', )),
+            Gauge('email_queue_depth', 'Emails waiting for delivery',
+                  ('status', ), queue_depth),
+        ]
+        self.metrics = {metric.name: metric for metric in metrics}
+
+    def expose(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{labels} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    if context is not None:
+        context._metrics_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    start = getattr(context, '_metrics_start', None)
+    if start is None:
+        return
+    metrics.observe('db_query_duration_seconds',
+                    time.perf_counter() - start,
+                    phase='db')
+    if has_request_context() and 'metrics_queries' in g:
+        g.metrics_queries += 1
+
+
+class Metrics:
+    """
+    records metrics of the current app, every call is a no-op outside
+    of app context or with METRICS_ENABLED = False
+    """
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('METRICS_ENABLED', True)
+        if not app.config['METRICS_ENABLED']:
+            return
+        app.extensions['metrics'] = _MetricsState()
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        # listens on all engines, so engines created later are measured too
+        for name, listener in (('before_cursor_execute',
+                                _before_cursor_execute),
+                               ('after_cursor_execute',
+                                _after_cursor_execute)):
+            if not event.contains(Engine, name, listener):
+                event.listen(Engine, name, listener)
+
+    @property
+    def state(self):
+        if not has_app_context():
+            return None
+        return current_app.extensions.get('metrics')
+
+    def observe(self, name, value, *labels, phase=None):
+        """
+        adds value to histogram, phase adds it to time of the current
+        request spent in that phase
+        """
+        state = self.state
+        if state is None:
+            return
+        state.metrics[name].observe(value, *labels)
+        if phase and has_request_context() and 'metrics_phases' in g:
+            g.metrics_phases[phase] += value
+
+    def inc(self, name, *labels, amount=1):
+        state = self.state
+        if state is not None:
+            state.metrics[name].inc(*labels, amount=amount)
+
+    @contextmanager
+    def timer(self, name, *labels, phase=None):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name,
+                         time.perf_counter() - start,
+                         *labels,
+                         phase=phase)
+
+    def _before_request(self):
+        g.metrics_start = time.perf_counter()
+        g.metrics_queries = 0
+        g.metrics_phases = dict.fromkeys(PHASES, 0.0)
+
+    def _after_request(self, response):
+        if 'metrics_start' not in g:
+            return response
+        elapsed = time.perf_counter() - g.metrics_start
+        # route pattern, not the path, so ids do not create new series
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        state = self.state
+        state.metrics['http_requests_total'].inc(request.method, endpoint,
+                                                 response.status_code)
+        state.metrics['http_request_duration_seconds'].observe(
+            elapsed, request.method, endpoint)
+        state.metrics['http_request_db_queries'].observe(
+            g.metrics_queries, endpoint)
+        phases = state.metrics['http_request_phase_seconds']
+        for phase, seconds in g.metrics_phases.items():
+            phases.observe(seconds, endpoint, phase)
+        phases.observe(max(0.0, elapsed - sum(g.metrics_phases.values())),
+                       endpoint, 'other')
+        return response
+
+
+metrics = Metrics()
+
+
+@metrics_bp.route('/metrics')
+def expose():
+    state = metrics.state
+    if state is None:
+        return Response('metrics are disabled\n', status=404,
+                        content_type=CONTENT_TYPE)
+    return Response(state.expose(), content_type=CONTENT_TYPE)
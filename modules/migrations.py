@@ -0,0 +1,175 @@
+"""
+schema migrations for existing sqlite databases
+
+db.create_all() creates missing tables but never changes existing ones,
+migrations below bring older database.db files up to date. Schema version
+is kept in sqlite's PRAGMA user_version, every migration has to be safe to
+run on a database already created with the current models
+"""
+import click
+from flask.cli import with_appcontext
+
+from modules import search
+from modules.extensions import db
+
+
+def column_names(conn, table):
+    return {row[1] for row in conn.execute(f'PRAGMA table_info({table})')}
+
+
+def add_column(conn, table, column, definition):
+    if column not in column_names(conn, table):
+        conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+
+def create_missing_indexes(conn):
+    existing = {
+        row[0]
+        for row in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index'")
+    }
+    for table in db.metadata.sorted_tables:
+        columns = column_names(conn, table.name)
+        for index in table.indexes:
+            # columns added by a later migration get their index there
+            if index.name not in existing and all(
+                    column.name in columns for column in index.columns):
+                index.create(bind=conn)
+
+
+def add_attachment_content(conn):
+    # attachment_content table itself is created by create_all
+    add_column(conn, 'attachment', 'sha256', 'VARCHAR(64)')
+
+
+def merge_duplicate_users(conn):
+    # email_address gets unique index, keep lowest id of every address
+    conn.execute("""
+        CREATE TEMP TABLE user_merge AS
+        SELECT u.id AS old_id, k.keep_id
+        FROM email_user u
+        JOIN (SELECT email_address, MIN(id) AS keep_id
+              FROM email_user
+              WHERE email_address IS NOT NULL
+              GROUP BY email_address
+              HAVING COUNT(*) > 1) k
+        ON u.email_address = k.email_address
+        WHERE u.id != k.keep_id""")
+    conn.execute("""
+        UPDATE email
+        SET sender_id = (SELECT keep_id FROM user_merge
+                         WHERE old_id = email.sender_id)
+        WHERE sender_id IN (SELECT old_id FROM user_merge)""")
+    conn.execute("""
+        INSERT OR IGNORE INTO recipents (email_id, recipent_id)
+        SELECT r.email_id, m.keep_id
+        FROM recipents r JOIN user_merge m ON r.recipent_id = m.old_id""")
+    conn.execute("""
+        DELETE FROM recipents
+        WHERE recipent_id IN (SELECT old_id FROM user_merge)""")
+    conn.execute(
+        'DELETE FROM email_user WHERE id IN (SELECT old_id FROM user_merge)')
+    conn.execute('DROP TABLE user_merge')
+
+
+def add_indexes(conn):
+    merge_duplicate_users(conn)
+    create_missing_indexes(conn)
+
+
+def add_recipent_status(conn):
+    add_column(conn, 'recipents', 'status', 'VARCHAR')
+    # recipents of already sent emails share status of the email
+    conn.execute("""
+        UPDATE recipents
+        SET status = (SELECT status FROM email
+                      WHERE email.id = recipents.email_id)
+        WHERE status IS NULL""")
+
+
+def add_retry_columns(conn):
+    add_column(conn, 'email', 'attempts', 'INTEGER NOT NULL DEFAULT 0')
+    add_column(conn, 'email', 'next_attempt_at', 'DATETIME')
+
+
+def add_message_body(conn):
+    # message_body table itself is created by create_all
+    add_column(conn, 'email', 'body_sha256', 'VARCHAR(64)')
+    add_column(conn, 'email_archive', 'body_sha256', 'VARCHAR(64)')
+
+
+def add_search_index(conn):
+    search.create_index(conn)
+    search.rebuild_index(conn)
+
+
+def add_claim_token(conn):
+    add_column(conn, 'email', 'claimed_by', 'VARCHAR(32)')
+
+
+def add_claim_lease(conn):
+    add_column(conn, 'email', 'claimed_at', 'DATETIME')
+    # emails left in 'sending' by older versions are claimed again once
+    # the lease expires
+    conn.execute("""
+        UPDATE email SET claimed_at = CURRENT_TIMESTAMP
+        WHERE status = 'sending' AND claimed_at IS NULL""")
+
+
+def add_archived_attachment_link(conn):
+    add_column(conn, 'attachment', 'archived_email_id', 'INTEGER')
+    create_missing_indexes(conn)
+    # attachments of emails archived before, pointing at deleted rows
+    conn.execute("""
+        UPDATE attachment
+        SET archived_email_id = email_id, email_id = NULL
+        WHERE email_id IN (SELECT id FROM email_archive)""")
+
+
+# (version, migration), append only
+MIGRATIONS = [
+    (1, add_attachment_content),
+    (2, add_indexes),
+    (3, add_recipent_status),
+    (4, add_retry_columns),
+    (5, add_message_body),
+    (6, add_search_index),
+    (7, add_claim_token),
+    (8, add_claim_lease),
+    (9, add_archived_attachment_link),
+]
+
+
+def schema_version(conn):
+    return conn.execute('PRAGMA user_version').scalar()
+
+
+def upgrade(engine):
+    """
+    applies migrations newer than the database, returns applied versions
+    """
+    applied = []
+    with engine.begin() as conn:
+        version = schema_version(conn)
+        for migration_version, migration in MIGRATIONS:
+            if migration_version <= version:
+                continue
+            migration(conn)
+            conn.execute(f'PRAGMA user_version = {migration_version}')
+            applied.append(migration_version)
+    return applied
+
+
+@click.command('migrate-db')
+@with_appcontext
+def migrate_db_command():
+    """
+    bring existing database up to date with models
+    """
+    db.create_all()
+    applied = upgrade(db.engine)
+    click.echo(f'Applied migrations: {applied or "none"}')
+
+
+def init_app(app):
+    app.cli.add_command(migrate_db_command)
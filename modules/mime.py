@@ -0,0 +1,175 @@
+import base64
+import mmap
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from email.mime.base import MIMEBase
+
+from flask import current_app
+from flask_mail import Attachment as MailAttachment
+from flask_mail import Message
+
+from modules.metrics import metrics
+
+SPACES = re.compile(r'[\s]+', re.UNICODE)
+
+# forces multipart layout in Message._message, removed right after
+_PLACEHOLDER = MailAttachment(content_type='application/octet-stream',
+                              data=b'')
+
+
+def read_file(path):
+    """
+    returns file content as memory map (or bytes for empty file),
+    the caller closes it
+    """
+    with open(path, 'rb') as fp:
+        if not os.fstat(fp.fileno()).st_size:
+            return b''
+        return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def encode_attachment(attachment, ascii_attachments=False):
+    """
+    builds base64 encoded MIME part for Attachment row, same as flask-mail
+    does for attached data, reading the file through mmap
+    """
+    path = os.path.join(current_app.root_path, attachment.file_path)
+    with metrics.timer('attachment_io_duration_seconds', 'encode',
+                       phase='file'):
+        data = read_file(path)
+        try:
+            payload = base64.encodebytes(data).decode('ascii')
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
+
+    content_type = attachment.content_type or 'application/octet-stream'
+    part = MIMEBase(*content_type.split('/', 1))
+    part.set_payload(payload)
+    part['Content-Transfer-Encoding'] = 'base64'
+
+    filename = attachment.name
+    if filename and ascii_attachments:
+        filename = unicodedata.normalize('NFKD', filename)
+        filename = filename.encode('ascii', 'ignore').decode('ascii')
+        filename = SPACES.sub(' ', filename).strip()
+    try:
+        filename and filename.encode('ascii')
+    except UnicodeEncodeError:
+        filename = ('UTF8', '', filename)
+    part.add_header('Content-Disposition', 'attachment', filename=filename)
+    return part, len(payload)
+
+
+class EncodedPartCache:
+    """
+    LRU cache of encoded attachment parts keyed by Attachment id,
+    bounded by size of encoded payloads
+
+    stored content never changes (see file_store), so entries never
+    get stale. ATTACHMENT_CACHE_BYTES = 0 disables the cache
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.parts = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, attachment, ascii_attachments=False):
+        with self.lock:
+            entry = self.parts.get(attachment.id)
+            if entry:
+                self.parts.move_to_end(attachment.id)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        part, size = encode_attachment(attachment, ascii_attachments)
+        if size > self.max_bytes:
+            return part
+
+        with self.lock:
+            if attachment.id not in self.parts:
+                self.parts[attachment.id] = (part, size)
+                self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted_size) = self.parts.popitem(last=False)
+                self.size -= evicted_size
+        return part
+
+    def clear(self):
+        with self.lock:
+            self.parts.clear()
+            self.size = 0
+
+
+class AttachmentCache:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('ATTACHMENT_CACHE_BYTES', 64 * 1024 * 1024)
+        app.extensions['attachment_cache'] = EncodedPartCache(
+            app.config['ATTACHMENT_CACHE_BYTES'])
+
+    @property
+    def state(self):
+        return current_app.extensions['attachment_cache']
+
+    def get_part(self, attachment):
+        ascii_attachments = current_app.extensions['mail'].ascii_attachments
+        return self.state.get(attachment, ascii_attachments)
+
+
+attachment_cache = AttachmentCache()
+
+
+class MailMessage(Message):
+    """
+    flask-mail Message that can carry already encoded attachment parts,
+    so the same attachment is not read and encoded for every email
+
+    render() freezes the message to bytes, so it can be sent in many
+    SMTP transactions without being serialized again
+    """
+    def __init__(self, *args, **kwargs):
+        self.encoded_parts = kwargs.pop('encoded_parts', [])
+        self.rendered = None
+        super().__init__(*args, **kwargs)
+
+    def render(self):
+        if self.date is None:
+            self.date = time.time()
+        self.rendered = None
+        self.rendered = self.as_bytes()
+        return self.rendered
+
+    def as_bytes(self):
+        if self.rendered is not None:
+            return self.rendered
+        return super().as_bytes()
+
+    def attach_encoded(self, attachment):
+        self.encoded_parts.append(attachment_cache.get_part(attachment))
+
+    def _message(self):
+        if not self.encoded_parts:
+            return super()._message()
+
+        attachments = self.attachments
+        self.attachments = attachments + [_PLACEHOLDER]
+        try:
+            msg = super()._message()
+        finally:
+            self.attachments = attachments
+        msg.get_payload().pop()
+        for part in self.encoded_parts:
+            msg.attach(part)
+        return msg
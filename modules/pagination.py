@@ -0,0 +1,99 @@
+import base64
+import binascii
+import json
+from datetime import datetime
+
+from flask import Response, current_app, stream_with_context
+from sqlalchemy import and_, or_
+from webargs import fields, validate
+
+from modules.extensions import db
+from modules.json_backend import dumps
+
+
+pagination_args = {
+    'limit': fields.Int(validate=validate.Range(min=1)),
+    'cursor': fields.String(),
+    'stream': fields.Boolean()
+}
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def page_size(limit=None):
+    config = current_app.config
+    return min(limit or config['PAGE_SIZE'], config['MAX_PAGE_SIZE'])
+
+
+def encode_cursor(values):
+    values = [v.isoformat() if isinstance(v, datetime) else v for v in values]
+    raw = json.dumps(values, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode()
+
+
+def decode_cursor(cursor, columns):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, ValueError):
+        raise InvalidCursor(cursor)
+    if not isinstance(values, list) or len(values) != len(columns):
+        raise InvalidCursor(cursor)
+    decoded = []
+    for column, value in zip(columns, values):
+        if isinstance(column.type, db.DateTime):
+            try:
+                value = datetime.fromisoformat(value)
+            except (TypeError, ValueError):
+                raise InvalidCursor(cursor)
+        decoded.append(value)
+    return decoded
+
+
+def after(columns, values):
+    """
+    keyset condition (c1, c2, ...) > (v1, v2, ...) that can use an index
+    """
+    column, value = columns[0], values[0]
+    if len(columns) == 1:
+        return column > value
+    return or_(column > value,
+               and_(column == value, after(columns[1:], values[1:])))
+
+
+def keyset_query(query, columns, cursor=None):
+    """
+    orders query by columns (last one has to be unique) and skips rows
+    up to and including the cursor
+    """
+    if cursor:
+        query = query.filter(after(columns, decode_cursor(cursor, columns)))
+    return query.order_by(*columns)
+
+
+def paginate(query, columns, cursor=None, limit=100):
+    """
+    returns (rows, next_cursor), next_cursor is None on the last page
+    """
+    rows = keyset_query(query, columns, cursor).limit(limit + 1).all()
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    last = rows[-1]
+    next_cursor = encode_cursor([getattr(last, c.key) for c in columns])
+    return rows, next_cursor
+
+
+def stream_json(rows, serialize):
+    """
+    streams rows as json array without building it in memory
+    """
+    def generate():
+        yield b'['
+        for i, row in enumerate(rows):
+            yield (b',' if i else b'') + dumps(serialize(row))
+        yield b']\n'
+
+    return Response(stream_with_context(generate()),
+                    mimetype='application/json')
@@ -0,0 +1,74 @@
+from collections import OrderedDict, namedtuple
+
+Recipent = namedtuple('Recipent', ['email_id', 'recipent_id', 'address'])
+
+
+class Envelope:
+    """
+    one SMTP transaction: one message data, many RCPT TO of one domain
+    """
+    def __init__(self, key, sender, domain, recipents):
+        self.key = key
+        self.sender = sender
+        self.domain = domain
+        self.recipents = recipents
+
+    @property
+    def addresses(self):
+        return list(dict.fromkeys(r.address for r in self.recipents))
+
+
+class DeliveryPlan:
+    def __init__(self):
+        # content key -> emails with that content, first one is rendered
+        self.messages = OrderedDict()
+        self.envelopes = []
+
+
+def content_key(email, merge_identical=False):
+    if not merge_identical:
+        return ('email', email.id)
+    attachments = tuple(
+        sorted((attachment.sha256 or f'id:{attachment.id}', attachment.name,
+                attachment.content_type)
+               for attachment in email.attachments))
+    # big bodies are compared by their hash, not loaded
+    return ('content', email.sender_id, email.subject, email.message,
+            email.body_sha256, email.priority, attachments)
+
+
+def recipent_domain(address):
+    return address.rsplit('@', 1)[-1].lower()
+
+
+def plan_deliveries(emails, max_recipents=100, merge_identical=False,
+                    skip=frozenset()):
+    """
+    groups recipents of emails by content and domain, so every message is
+    rendered once and sent in as few SMTP transactions as possible, each
+    with at most max_recipents RCPT TO
+    with merge_identical emails with the same sender, subject, body,
+    priority and attachment content share one rendered message
+    skip is set of (email_id, recipent_id) not to send, already accepted
+    in an earlier attempt
+    """
+    plan = DeliveryPlan()
+    by_domain = OrderedDict()
+    for email in emails:
+        key = content_key(email, merge_identical)
+        plan.messages.setdefault(key, []).append(email)
+        for recipent in email.recipents:
+            if (not recipent.email_address
+                    or (email.id, recipent.id) in skip):
+                continue
+            domain = recipent_domain(recipent.email_address)
+            by_domain.setdefault((key, domain), []).append(
+                Recipent(email.id, recipent.id, recipent.email_address))
+
+    for (key, domain), recipents in by_domain.items():
+        sender = plan.messages[key][0].sender.email_address
+        for start in range(0, len(recipents), max_recipents):
+            plan.envelopes.append(
+                Envelope(key, sender, domain,
+                         recipents[start:start + max_recipents]))
+    return plan
@@ -0,0 +1,34 @@
+"""
+per process state of extensions, reset in every forked worker
+
+with gunicorn --preload the app is created once in the master and forked
+into workers. Threads (delivery executor, async delivery loop), process
+pools, open SMTP sockets and status event subscribers do not survive fork
+or must not be shared, so after fork every worker drops them and starts
+its own on first use.
+Database engines are handled by modules.storage.dispose_engines
+"""
+import os
+import weakref
+
+# app.extensions keys of states with after_fork()
+FORK_STATES = ('smtp_pool', 'render_pool', 'delivery', 'async_delivery',
+               'events')
+
+_apps = weakref.WeakSet()
+
+
+def register(app):
+    _apps.add(app)
+
+
+def reset_after_fork():
+    for app in list(_apps):
+        for name in FORK_STATES:
+            state = app.extensions.get(name)
+            if state is not None:
+                state.after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset_after_fork)
@@ -0,0 +1,137 @@
+"""
+renders messages with big attachments to RFC 5322 bytes in worker
+processes, so base64 and MIME serialization use all cores instead of one
+
+the parent sends plain data (headers, body and attachment file paths),
+workers read and encode the files themselves, every worker keeps its own
+encoded attachment cache. MIME_RENDER_PROCESSES = 0 renders everything in
+the calling thread
+"""
+import multiprocessing
+import os
+import threading
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from types import SimpleNamespace
+
+from flask import Flask, current_app
+
+from modules.mime import EncodedPartCache, MailMessage
+
+# what a worker needs of an Attachment row
+AttachmentSpec = namedtuple('AttachmentSpec',
+                            ['id', 'file_path', 'name', 'content_type'])
+
+
+def _init_worker(root_path, ascii_attachments, cache_bytes):
+    # minimal app context for flask-mail and the attachment cache
+    app = Flask('render_worker', root_path=root_path)
+    app.extensions['mail'] = SimpleNamespace(
+        ascii_attachments=ascii_attachments, default_sender=None)
+    app.extensions['attachment_cache'] = EncodedPartCache(cache_bytes)
+    app.app_context().push()
+
+
+def render(spec):
+    """
+    runs in worker process, returns message bytes
+    """
+    msg = MailMessage(subject=spec['subject'],
+                      recipients=spec['recipients'],
+                      body=spec['body'],
+                      sender=spec['sender'],
+                      date=spec['date'],
+                      extra_headers=spec['extra_headers'])
+    for attachment in spec['attachments']:
+        msg.attach_encoded(AttachmentSpec(*attachment))
+    return msg.render()
+
+
+class _RenderPoolState:
+    def __init__(self, app):
+        self.app = app
+        self.processes = app.config['MIME_RENDER_PROCESSES']
+        self.min_bytes = app.config['MIME_RENDER_MIN_BYTES']
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def after_fork(self):
+        # worker processes belong to the parent
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def get_executor(self):
+        with self.lock:
+            if self.executor is None:
+                config = self.app.config
+                workers = config['MIME_RENDER_PROCESSES']
+                self.executor = ProcessPoolExecutor(
+                    max_workers=workers,
+                    # fork of a process with running threads can deadlock
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=_init_worker,
+                    initargs=(self.app.root_path,
+                              self.app.extensions['mail'].ascii_attachments,
+                              config['ATTACHMENT_CACHE_BYTES'] // workers))
+            return self.executor
+
+
+class RenderPool:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('MIME_RENDER_PROCESSES', 0)
+        app.config.setdefault('MIME_RENDER_MIN_BYTES', 1024 * 1024)
+        app.extensions['render_pool'] = _RenderPoolState(app)
+
+    @property
+    def state(self):
+        return current_app.extensions['render_pool']
+
+    def attachments_size(self, attachments):
+        size = 0
+        for attachment in attachments:
+            try:
+                size += os.path.getsize(
+                    os.path.join(current_app.root_path, attachment.file_path))
+            except OSError:
+                pass  # reported when it is encoded
+        return size
+
+    def submit(self, msg, attachments):
+        """
+        starts rendering msg with attachments in a worker process if they
+        are big enough to be worth it, returns future of the bytes,
+        or None if msg should be rendered in this thread
+        """
+        state = self.state
+        if not state.processes or not attachments or self.attachments_size(
+                attachments) < state.min_bytes:
+            return None
+        spec = {
+            'subject': msg.subject,
+            'recipients': msg.recipients,
+            'body': msg.body,
+            'sender': msg.sender,
+            'date': msg.date,
+            'extra_headers': msg.extra_headers,
+            'attachments': [
+                (attachment.id,
+                 os.path.join(current_app.root_path, attachment.file_path),
+                 attachment.name, attachment.content_type)
+                for attachment in attachments
+            ]
+        }
+        return state.get_executor().submit(render, spec)
+
+    def close(self):
+        state = self.state
+        with state.lock:
+            if state.executor is not None:
+                state.executor.shutdown()
+                state.executor = None
+
+
+render_pool = RenderPool()
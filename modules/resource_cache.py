@@ -0,0 +1,117 @@
+"""
+in-process cache of serialized single resources (GET /email/<id>,
+GET /user/<id>) with ETag for conditional requests
+
+entries are dropped when this process changes the row and expire after
+RESOURCE_CACHE_TTL seconds, which bounds staleness of rows changed by
+other processes. RESOURCE_CACHE_SIZE = 0 disables the cache
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from flask import Response, current_app, request
+
+from modules.json_backend import dumps
+
+
+class CacheEntry:
+    def __init__(self, body, expires_at):
+        self.body = body
+        # no Last-Modified, time of filling this cache is not the time the
+        # row changed, is the same second for a change right after it and
+        # differs between processes; the hash of the body is exact
+        self.etag = hashlib.sha1(body).hexdigest()
+        self.expires_at = expires_at
+
+
+class TTLCache:
+    """
+    LRU cache with at most max_entries entries living ttl seconds
+    """
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry.expires_at <= time.monotonic():
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, body):
+        entry = CacheEntry(body, time.monotonic() + self.ttl)
+        if not self.max_entries:
+            return entry
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return entry
+
+    def invalidate(self, keys):
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class ResourceCache:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('RESOURCE_CACHE_SIZE', 10000)
+        app.config.setdefault('RESOURCE_CACHE_TTL', 30)
+        app.extensions['resource_cache'] = TTLCache(
+            app.config['RESOURCE_CACHE_SIZE'],
+            app.config['RESOURCE_CACHE_TTL'])
+
+    @property
+    def state(self):
+        return current_app.extensions['resource_cache']
+
+    def contains(self, kind, resource_id):
+        """
+        validators use it to skip existence queries of cached resources
+        """
+        return self.state.get((kind, resource_id)) is not None
+
+    def invalidate(self, kind, resource_ids):
+        self.state.invalidate((kind, resource_id)
+                              for resource_id in resource_ids)
+
+    def response(self, kind, resource_id, load):
+        """
+        cached json response of resource, load() serializes it on miss,
+        answers 304 when If-None-Match matches
+        """
+        cache = self.state
+        entry = cache.get((kind, resource_id))
+        if entry is None:
+            entry = cache.put((kind, resource_id), dumps(load()))
+        response = Response(entry.body, mimetype='application/json')
+        response.set_etag(entry.etag)
+        # clients may keep it, but have to revalidate every time
+        response.cache_control.no_cache = True
+        return response.make_conditional(request)
+
+
+resource_cache = ResourceCache()
@@ -0,0 +1,79 @@
+"""
+what happens to an email after a delivery attempt
+
+recipents refused temporarily (4xx, relay unreachable, circuit open) are
+'deferred': the email goes back to 'pending' with next_attempt_at set by
+exponential backoff with jitter, and only recipents not yet accepted are
+tried again. After DELIVERY_MAX_ATTEMPTS attempts it is moved to 'dead'
+(dead letter). Permanent refusals (5xx) make the email 'failed' at once
+"""
+import asyncio
+import random
+import smtplib
+from datetime import datetime, timedelta
+
+from flask import current_app
+
+from modules.async_smtp import SMTPReplyError
+from modules.smtp import CircuitOpenError
+
+# relay down or unreachable, worth trying again later
+TEMPORARY_ERRORS = (CircuitOpenError, smtplib.SMTPServerDisconnected, OSError,
+                    asyncio.TimeoutError)
+
+
+def is_temporary_code(code):
+    return 400 <= code < 500
+
+
+def is_temporary(error):
+    if isinstance(error, smtplib.SMTPResponseException):
+        return is_temporary_code(error.smtp_code)
+    if isinstance(error, SMTPReplyError):
+        return is_temporary_code(error.code)
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(
+            is_temporary_code(code) for code, _ in error.recipients.values())
+    return isinstance(error, TEMPORARY_ERRORS)
+
+
+def error_status(error):
+    return 'deferred' if is_temporary(error) else 'failed'
+
+
+def refused_status(code):
+    return 'deferred' if is_temporary_code(code) else 'failed'
+
+
+def retry_delay(attempts, base, cap, rng=random):
+    """
+    seconds before next attempt, exponential in attempts made so far,
+    half of it random so retries of many emails do not come at once
+    """
+    delay = min(cap, base * 2**(attempts - 1))
+    return delay / 2 + rng.uniform(0, delay / 2)
+
+
+def outcome(recipent_statuses, attempts):
+    """
+    returns (email status, recipent statuses, attempts, next_attempt_at)
+    after one more attempt, recipent_statuses is a list of
+    'sent', 'failed' or 'deferred'
+    """
+    config = current_app.config
+    attempts = (attempts or 0) + 1
+    if recipent_statuses and all(status == 'sent'
+                                 for status in recipent_statuses):
+        return 'sent', recipent_statuses, attempts, None
+    if 'deferred' not in recipent_statuses:
+        return 'failed', recipent_statuses, attempts, None
+    if attempts >= config['DELIVERY_MAX_ATTEMPTS']:
+        recipent_statuses = [
+            'failed' if status == 'deferred' else status
+            for status in recipent_statuses
+        ]
+        return 'dead', recipent_statuses, attempts, None
+    delay = retry_delay(attempts, config['DELIVERY_RETRY_BASE'],
+                        config['DELIVERY_RETRY_MAX'])
+    return ('pending', recipent_statuses, attempts,
+            datetime.utcnow() + timedelta(seconds=delay))
@@ -0,0 +1,99 @@
+import threading
+import time
+
+# 1 is highest, 5 is lowest, emails without priority are normal (3)
+PRIORITY_LEVELS = (1, 2, 3, 4, 5)
+DEFAULT_PRIORITY = 3
+DEFAULT_WEIGHTS = {1: 16, 2: 8, 3: 4, 4: 2, 5: 1}
+
+
+class PriorityScheduler:
+    """
+    splits every claimed batch between priority levels with smooth weighted
+    round robin, so higher priorities get most of the slots but the lowest
+    one still gets its share and is never starved
+    """
+    def __init__(self, weights=None):
+        self.weights = {**DEFAULT_WEIGHTS, **(weights or {})}
+        self.current = {level: 0 for level in PRIORITY_LEVELS}
+        self.lock = threading.Lock()
+
+    def next_level(self):
+        total = sum(self.weights.values())
+        for level in PRIORITY_LEVELS:
+            self.current[level] += self.weights[level]
+        # on tie the higher priority wins
+        level = max(PRIORITY_LEVELS, key=lambda l: (self.current[l], -l))
+        self.current[level] -= total
+        return level
+
+    def plan(self, batch_size):
+        """
+        returns {priority: number of emails to claim}
+        """
+        counts = dict.fromkeys(PRIORITY_LEVELS, 0)
+        with self.lock:
+            for _ in range(batch_size):
+                counts[self.next_level()] += 1
+        return counts
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate  # tokens per second
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self):
+        # seconds until one token is available, 0 if it is now
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+
+class DomainThrottle:
+    """
+    token bucket per recipent domain, so big providers do not start
+    deferring us, domains without configured rate use default_rate
+    rates are (messages per second, burst), None means unlimited
+    """
+    def __init__(self, rates=None, default_rate=None):
+        self.rates = {
+            domain.lower(): rate
+            for domain, rate in (rates or {}).items()
+        }
+        self.default_rate = default_rate
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def bucket(self, domain):
+        bucket = self.buckets.get(domain)
+        if bucket is None:
+            rate = self.rates.get(domain, self.default_rate)
+            if rate is None:
+                return None
+            bucket = self.buckets[domain] = TokenBucket(*rate)
+        return bucket
+
+    def try_acquire(self, domains):
+        """
+        takes token from bucket of every domain, or none of them
+        returns 0 on success, otherwise seconds to wait before next try
+        """
+        now = time.monotonic()
+        with self.lock:
+            buckets = [self.bucket(domain.lower()) for domain in domains]
+            buckets = [bucket for bucket in buckets if bucket]
+            for bucket in buckets:
+                bucket.refill(now)
+            wait = max([bucket.wait_time() for bucket in buckets] or [0])
+            if wait:
+                return wait
+            for bucket in buckets:
+                bucket.tokens -= 1
+            return 0
+
@@ -0,0 +1,112 @@
+"""
+full text search over email subject and message with sqlite FTS5
+
+email_search is an FTS5 table with rowid = email.id, kept up to date by
+triggers on email, so every new or edited email is indexed in the same
+transaction. sender_id and pub_date are stored in it UNINDEXED for filters.
+status changes several times in the life of an email and would make FTS5
+tokenize the row again on every change, it is read from email by primary
+key instead. Big bodies stored in message_body (modules.bodies) are not
+seen by the triggers, save paths index them with index_bodies
+"""
+import zlib
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import DateTime, Float, Integer, String, bindparam
+from sqlalchemy.sql import column, literal_column, table
+
+from modules.extensions import db
+
+search_table = table('email_search', column('rowid', Integer),
+                     column('message', String), column('sender_id', Integer),
+                     column('pub_date', DateTime), column('rank', Float))
+search_match = literal_column('email_search')
+
+CREATE_STATEMENTS = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS email_search USING fts5(
+        subject, message, sender_id UNINDEXED, pub_date UNINDEXED,
+        tokenize = 'unicode61 remove_diacritics 2')""",
+    """
+    CREATE TRIGGER IF NOT EXISTS email_search_insert AFTER INSERT ON email
+    BEGIN
+        INSERT INTO email_search (rowid, subject, message, sender_id, pub_date)
+        VALUES (new.id, new.subject, new.message, new.sender_id, new.pub_date);
+    END""",
+    # message is null for big bodies, their indexed text is kept
+    """
+    CREATE TRIGGER IF NOT EXISTS email_search_update
+    AFTER UPDATE OF subject, message, sender_id ON email
+    BEGIN
+        UPDATE email_search
+        SET subject = new.subject,
+            message = coalesce(new.message, message),
+            sender_id = new.sender_id
+        WHERE rowid = new.id;
+    END""",
+    """
+    CREATE TRIGGER IF NOT EXISTS email_search_delete AFTER DELETE ON email
+    BEGIN
+        DELETE FROM email_search WHERE rowid = old.id;
+    END""",
+]
+
+update_message = search_table.update().where(
+    search_table.c.rowid == bindparam('b_email_id')).values(
+        message=bindparam('b_message'))
+
+
+def create_index(conn):
+    for statement in CREATE_STATEMENTS:
+        conn.execute(statement)
+
+
+def rebuild_index(conn):
+    """
+    indexes all emails again, returns number of indexed emails
+    """
+    conn.execute('DELETE FROM email_search')
+    conn.execute("""
+        INSERT INTO email_search (rowid, subject, message, sender_id, pub_date)
+        SELECT id, subject, message, sender_id, pub_date FROM email""")
+    # big bodies, decompressed once for all emails using them
+    bodies = conn.execute("""
+        SELECT sha256, data FROM message_body
+        WHERE sha256 IN (SELECT body_sha256 FROM email)""")
+    for sha256, data in bodies.fetchall():
+        conn.execute(
+            """
+            UPDATE email_search SET message = ?
+            WHERE rowid IN (SELECT id FROM email WHERE body_sha256 = ?)""",
+            (zlib.decompress(data).decode('utf-8'), sha256))
+    conn.execute("INSERT INTO email_search (email_search) VALUES ('optimize')")
+    return conn.execute('SELECT count(*) FROM email_search').scalar()
+
+
+def index_bodies(bodies):
+    """
+    indexes big bodies of just saved emails, bodies is {email_id: text},
+    in the current transaction
+    """
+    if bodies:
+        db.session.execute(update_message, [{
+            'b_email_id': email_id,
+            'b_message': text
+        } for email_id, text in bodies.items()])
+
+
+@click.command('rebuild-search-index')
+@with_appcontext
+def rebuild_search_index_command():
+    """
+    create full text search index and index all emails again
+    """
+    with db.engine.begin() as conn:
+        create_index(conn)
+        indexed = rebuild_index(conn)
+    click.echo(f'Indexed emails: {indexed}')
+
+
+def init_app(app):
+    app.cli.add_command(rebuild_search_index_command)
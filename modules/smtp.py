@@ -0,0 +1,348 @@
+import queue
+import smtplib
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import current_app
+from flask_mail import (BadHeaderError, email_dispatched, sanitize_address,
+                        sanitize_addresses)
+
+from modules.extensions import mail as mailer
+from modules.metrics import metrics
+
+# errors after which smtplib resets the transaction, connection is still usable
+TRANSACTION_ERRORS = (smtplib.SMTPRecipientsRefused,
+                      smtplib.SMTPSenderRefused, smtplib.SMTPDataError)
+# errors meaning the connection is gone and sending can be retried on new one
+CONNECTION_ERRORS = (smtplib.SMTPServerDisconnected, ConnectionError)
+# errors meaning the relay is unreachable, counted by the circuit breaker
+RELAY_ERRORS = (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError,
+                OSError)
+
+
+class CircuitOpenError(smtplib.SMTPException):
+    pass
+
+
+class CircuitBreaker:
+    """
+    stops talking to the relay after threshold consecutive connection
+    failures, every send fails at once with CircuitOpenError instead of
+    waiting for SMTP_TIMEOUT. After reset_timeout seconds one send is let
+    through (half-open), its result closes or opens the circuit again
+    """
+    def __init__(self, threshold, reset_timeout, clock=time.monotonic):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self.lock:
+            if self.opened_at is None:
+                return 'closed'
+            if self.probing or self.clock(
+            ) - self.opened_at >= self.reset_timeout:
+                return 'half-open'
+            return 'open'
+
+    def before_call(self):
+        if not self.threshold:
+            return
+        with self.lock:
+            if self.opened_at is None:
+                return
+            if (not self.probing and
+                    self.clock() - self.opened_at >= self.reset_timeout):
+                self.probing = True  # this caller is the probe
+                return
+        raise CircuitOpenError('SMTP circuit is open')
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.probing or (self.threshold
+                                and self.failures >= self.threshold):
+                self.opened_at = self.clock()
+            self.probing = False
+
+    def serialize(self):
+        state = self.state
+        with self.lock:
+            return {'state': state, 'failures': self.failures}
+
+
+class SMTPStats:
+    def __init__(self):
+        self.messages = 0
+        self.failed = 0
+        self.connects = 0
+        self.reconnects = 0
+        self.send_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def record_send(self, seconds, ok=True):
+        with self._lock:
+            if ok:
+                self.messages += 1
+            else:
+                self.failed += 1
+            self.send_seconds += seconds
+
+    def record_connect(self, reconnect=False):
+        with self._lock:
+            self.connects += 1
+            if reconnect:
+                self.reconnects += 1
+
+    def serialize(self):
+        with self._lock:
+            rate = self.messages / self.send_seconds if self.send_seconds else 0
+            return {
+                'messages': self.messages,
+                'failed': self.failed,
+                'connects': self.connects,
+                'reconnects': self.reconnects,
+                'send_seconds': round(self.send_seconds, 6),
+                'messages_per_second': round(rate, 2)
+            }
+
+
+class _SMTPPoolState:
+    def __init__(self, size, breaker):
+        self.size = size
+        self.idle = queue.LifoQueue(maxsize=size) if size else None
+        self.stats = SMTPStats()
+        self.breaker = breaker
+
+    def after_fork(self):
+        # sockets are shared with the parent, dropped without QUIT
+        self.idle = queue.LifoQueue(maxsize=self.size) if self.size else None
+
+
+class SMTPPool:
+    """
+    keeps SMTP connections open between messages instead of doing
+    TCP handshake, EHLO, STARTTLS and AUTH for every single one
+
+    connections are flask-mail's mail.connect(), so every connection is
+    still recycled after MAIL_MAX_EMAILS messages.
+    SMTP_POOL_SIZE is number of idle connections kept open,
+    0 connects for every message like mail.send does
+
+    sending goes through CircuitBreaker, SMTP_BREAKER_THRESHOLD
+    consecutive connection failures open it for SMTP_BREAKER_RESET seconds
+    """
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('SMTP_POOL_SIZE', 8)
+        app.config.setdefault('SMTP_TIMEOUT', 30)
+        app.config.setdefault('SMTP_BREAKER_THRESHOLD', 5)
+        app.config.setdefault('SMTP_BREAKER_RESET', 30)
+        app.extensions['smtp_pool'] = _SMTPPoolState(
+            app.config['SMTP_POOL_SIZE'],
+            CircuitBreaker(app.config['SMTP_BREAKER_THRESHOLD'],
+                           app.config['SMTP_BREAKER_RESET']))
+
+    @property
+    def state(self):
+        return current_app.extensions['smtp_pool']
+
+    @property
+    def breaker(self):
+        return self.state.breaker
+
+    def stats(self):
+        stats = self.state.stats.serialize()
+        stats['circuit'] = self.breaker.serialize()
+        return stats
+
+    def configure_host(self, mail):
+        """
+        flask-mail's Connection.configure_host with SMTP_TIMEOUT, so a
+        stalled relay cannot block a sending thread forever
+        """
+        timeout = current_app.config['SMTP_TIMEOUT']
+        if mail.use_ssl:
+            host = smtplib.SMTP_SSL(mail.server, mail.port, timeout=timeout)
+        else:
+            host = smtplib.SMTP(mail.server, mail.port, timeout=timeout)
+        try:
+            host.set_debuglevel(int(mail.debug))
+            if mail.use_tls:
+                host.starttls()
+            if mail.username and mail.password:
+                host.login(mail.username, mail.password)
+        except Exception:
+            host.close()
+            raise
+        return host
+
+    def open_connection(self, reconnect=False):
+        with metrics.timer('smtp_connect_duration_seconds',
+                           'true' if reconnect else 'false',
+                           phase='smtp'):
+            connection = mailer.connect()
+            connection.num_emails = 0
+            connection.host = None
+            if not connection.mail.suppress:
+                connection.host = self.configure_host(connection.mail)
+        self.state.stats.record_connect(reconnect=reconnect)
+        return connection
+
+    def close_connection(self, connection):
+        try:
+            connection.__exit__(None, None, None)
+        except (smtplib.SMTPException, OSError):
+            pass  # server has already closed it
+
+    def acquire(self):
+        """
+        returns (connection, reused)
+        """
+        state = self.state
+        if state.idle is not None:
+            try:
+                return state.idle.get_nowait(), True
+            except queue.Empty:
+                pass
+        return self.open_connection(), False
+
+    def release(self, connection):
+        state = self.state
+        if state.idle is not None:
+            try:
+                state.idle.put_nowait(connection)
+                return
+            except queue.Full:
+                pass
+        self.close_connection(connection)
+
+    @contextmanager
+    def connection(self):
+        """
+        checks out connection for sending many messages in one session
+        """
+        connection, _ = self.acquire()
+        try:
+            yield connection
+        except TRANSACTION_ERRORS:
+            self.release(connection)
+            raise
+        except Exception:
+            self.close_connection(connection)
+            raise
+        else:
+            self.release(connection)
+
+    def sendmail(self, connection, msg, envelope_to=None):
+        """
+        same as flask-mail Connection.send, but RCPT TO can be given
+        separately from message headers and refused recipients are returned
+        """
+        envelope_to = envelope_to or msg.send_to
+        assert envelope_to, 'No recipients have been added'
+        if msg.has_bad_headers():
+            raise BadHeaderError
+        if msg.date is None:
+            msg.date = time.time()
+
+        refused = {}
+        if connection.host:
+            refused = connection.host.sendmail(
+                sanitize_address(msg.sender),
+                list(sanitize_addresses(envelope_to)), msg.as_bytes(),
+                msg.mail_options, msg.rcpt_options)
+        email_dispatched.send(msg, app=current_app._get_current_object())
+
+        connection.num_emails += 1
+        if connection.num_emails == connection.mail.max_emails:
+            connection.num_emails = 0
+            if connection.host:
+                connection.host.quit()
+                connection.host = self.configure_host(connection.mail)
+        return refused
+
+    def send(self, msg, envelope_to=None):
+        """
+        sends message on pooled connection, reconnects once if the
+        pooled connection turns out to be closed by the server
+        returns {address: (code, response)} of refused recipients
+        raises CircuitOpenError without connecting while relay is down
+        """
+        breaker = self.breaker
+        breaker.before_call()
+        start = time.perf_counter()
+        try:
+            connection, reused = self.acquire()
+        except RELAY_ERRORS:
+            breaker.record_failure()
+            self.record_send(start, 'error')
+            raise
+        except Exception:
+            breaker.record_success()  # relay answered, refused login
+            self.record_send(start, 'error')
+            raise
+        try:
+            try:
+                refused = self.sendmail(connection, msg, envelope_to)
+            except CONNECTION_ERRORS:
+                self.close_connection(connection)
+                if not reused:
+                    raise
+                connection = self.open_connection(reconnect=True)
+                refused = self.sendmail(connection, msg, envelope_to)
+        except TRANSACTION_ERRORS:
+            breaker.record_success()
+            self.record_send(start, 'refused')
+            self.release(connection)
+            raise
+        except Exception as e:
+            if isinstance(e, RELAY_ERRORS):
+                breaker.record_failure()
+            else:
+                breaker.record_success()
+            self.record_send(start, 'error')
+            self.close_connection(connection)
+            raise
+        breaker.record_success()
+        self.record_send(start, 'sent')
+        self.release(connection)
+        return refused
+
+    def record_send(self, start, outcome):
+        elapsed = time.perf_counter() - start
+        self.state.stats.record_send(elapsed, ok=outcome == 'sent')
+        metrics.observe('smtp_send_duration_seconds',
+                        elapsed,
+                        outcome,
+                        phase='smtp')
+
+    def close(self):
+        """
+        closes all idle connections
+        """
+        state = self.state
+        while state.idle is not None:
+            try:
+                connection = state.idle.get_nowait()
+            except queue.Empty:
+                break
+            self.close_connection(connection)
+
+
+smtp_pool = SMTPPool()
@@ -0,0 +1,84 @@
+"""
+sqlite settings for many gunicorn workers and delivery threads sharing
+one database file
+
+SQLITE_PROFILE = 'production' turns on WAL journal (readers do not block
+the writer), synchronous=NORMAL (no fsync per commit in WAL mode, still
+consistent after a crash), busy_timeout (writers wait for the lock instead
+of failing with 'database is locked') and a pool of reused connections
+instead of a new connection per checkout
+"""
+import os
+import weakref
+
+from sqlalchemy import event
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+
+from modules.extensions import db
+
+# apps whose engines are disposed around fork, see dispose_engines
+_apps = weakref.WeakSet()
+
+
+def set_pragmas(config):
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f"PRAGMA journal_mode={config['SQLITE_JOURNAL_MODE']}")
+        cursor.execute(f"PRAGMA synchronous={config['SQLITE_SYNCHRONOUS']}")
+        cursor.execute(f"PRAGMA busy_timeout={config['SQLITE_BUSY_TIMEOUT']}")
+        cursor.close()
+
+    return on_connect
+
+
+def dispose_engines():
+    """
+    closes pooled connections, sqlite connections must not be used by
+    both processes after fork. Called before every fork and again in the
+    forked worker (gunicorn post_fork), so it starts with an empty pool
+    """
+    for app in list(_apps):
+        with app.app_context():
+            db.get_engine(app).dispose()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(before=dispose_engines)
+
+
+class SQLiteStorage:
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        config = app.config
+        config.setdefault('SQLITE_PROFILE', None)
+        config.setdefault('SQLITE_JOURNAL_MODE', 'WAL')
+        config.setdefault('SQLITE_SYNCHRONOUS', 'NORMAL')
+        config.setdefault('SQLITE_BUSY_TIMEOUT', 5000)  # milliseconds
+        config.setdefault('SQLITE_POOL_SIZE', 5)
+        config.setdefault('SQLITE_MAX_OVERFLOW', 10)
+        if config['SQLITE_PROFILE'] != 'production':
+            return
+        url = make_url(config['SQLALCHEMY_DATABASE_URI'])
+        if url.drivername != 'sqlite' or url.database in (None, '',
+                                                          ':memory:'):
+            return  # in memory database lives in a single connection
+
+        options = config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {})
+        options.setdefault('poolclass', QueuePool)
+        options.setdefault('pool_size', config['SQLITE_POOL_SIZE'])
+        options.setdefault('max_overflow', config['SQLITE_MAX_OVERFLOW'])
+        connect_args = options.setdefault('connect_args', {})
+        # pooled connections move between threads, never used by two at once
+        connect_args.setdefault('check_same_thread', False)
+        connect_args.setdefault('timeout', config['SQLITE_BUSY_TIMEOUT'] / 1000)
+
+        with app.app_context():
+            event.listen(db.get_engine(app), 'connect', set_pragmas(config))
+        _apps.add(app)
+
+
+sqlite_storage = SQLiteStorage()
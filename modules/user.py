@@ -5,6 +5,10 @@ from webargs.flaskparser import abort, parser, use_args, use_kwargs
 
 from modules.database import EmailUser
 from modules.extensions import db
+from modules.json_backend import json_response
+from modules.pagination import (InvalidCursor, keyset_query, page_size,
+                                paginate, pagination_args, stream_json)
+from modules.resource_cache import resource_cache
 from modules.validators import user_must_exist_in_db, user_must_not_exist_in_db
 
 user_bp = Blueprint('user', __name__)
@@ -29,8 +33,9 @@ class UserResource(Resource):
         {'user_id': fields.Int(required=True, validate=user_must_exist_in_db)},
         location='view_args')
     def get(self, user_id):
-        user = EmailUser.query.get(user_id)
-        return self.serialize_user(user)
+        return resource_cache.response(
+            'user', user_id,
+            lambda: self.serialize_user(EmailUser.query.get(user_id)))
 
     @use_kwargs({
         'email':
@@ -48,9 +53,28 @@ class UserResource(Resource):
 
 
 class UserListResource(UserResource):
-    def get(self):
-        users = EmailUser.query.all()
-        return [self.serialize_user(user) for user in users]
+    @use_kwargs(pagination_args, location='query')
+    def get(self, limit=None, cursor=None, stream=False):
+        """
+        get list of users, page by page, see MailList.get
+        """
+        columns = [EmailUser.id]
+        # (id, email_address) tuples instead of ORM objects
+        query = db.session.query(EmailUser.id, EmailUser.email_address)
+        try:
+            if stream:
+                query = keyset_query(query, columns, cursor)
+                if limit:
+                    query = query.limit(limit)
+                return stream_json(query.yield_per(1000), self.serialize_user)
+            users, next_cursor = paginate(query, columns, cursor,
+                                          page_size(limit))
+        except InvalidCursor:
+            abort(400, errors={'cursor': ['Invalid cursor']})
+
+        headers = {'X-Next-Cursor': next_cursor} if next_cursor else {}
+        return json_response([self.serialize_user(user) for user in users],
+                             headers=headers)
 
     def post(self):
         raise NotImplementedError
@@ -1,32 +1,67 @@
 from webargs import ValidationError
 
-from modules.database import Email, Attachment, EmailUser
+from modules.addresses import address_index
+from modules.archive import archive
+from modules.database import Email, EmailUser
+from modules.lookup import get_attachments, get_users
+from modules.resource_cache import resource_cache
+
+
+def _join_ids(ids):
+    return ', '.join(str(i) for i in ids)
 
 
 def email_must_exist_in_db(email_id):
-    if not Email.query.get(email_id):
+    if resource_cache.contains('email', email_id):
+        return
+    if not Email.query.get(email_id) and not archive.exists(email_id):
         raise ValidationError(
             f"Email with given id ({email_id}) does not exist")
 
 
 def user_must_exist_in_db(user_id):
-    if not EmailUser.query.get(user_id):
+    if resource_cache.contains('user', user_id):
+        return
+    if not get_users([user_id])[user_id]:
         raise ValidationError(f"User with given id ({user_id}) does not exist")
 
 
+def users_must_exist_in_db(user_ids):
+    users = get_users(user_ids)
+    missing = [user_id for user_id in user_ids if not users[user_id]]
+    if missing:
+        raise ValidationError(
+            f"Users with given ids ({_join_ids(missing)}) do not exist")
+
+
 def user_must_not_exist_in_db(email):
-    if EmailUser.filter_by.get(email):
+    if address_index.contains(email) or EmailUser.query.filter_by(
+            email_address=email).first():
         raise ValidationError(
             f"User with given email ({email}) already exists in db")
 
 
 def attachment_must_exist_in_db(attachment_id):
-    if not Attachment.query.get(attachment_id):
+    if not get_attachments([attachment_id])[attachment_id]:
         raise ValidationError(
             f"Attachment with given id ({attachment_id}) does not exist")
 
 
-def attachment_must_not_be_connected_to_email(attachment_id):
-    attachment = Attachment.query.get(attachment_id)
-    if attachment and attachment.email_id:
-        raise ValidationError(f"Attachment can be only attached to one email")
+def attachments_must_exist_in_db(attachment_ids):
+    attachments = get_attachments(attachment_ids)
+    missing = [i for i in attachment_ids if not attachments[i]]
+    if missing:
+        raise ValidationError(
+            f"Attachments with given ids ({_join_ids(missing)}) do not exist")
+
+
+def attachments_must_not_be_connected_to_email(attachment_ids):
+    attachments = get_attachments(attachment_ids)
+    connected = [
+        i for i in attachment_ids if attachments[i] and (
+            attachments[i].email_id or attachments[i].archived_email_id)
+    ]
+    if connected:
+        raise ValidationError(
+            f"Attachment can be only attached to one email "
+            f"({_join_ids(connected)} already are)")
@@ -0,0 +1,127 @@
+import os
+
+import pytest
+
+from application import create_app
+from modules import migrations
+from modules.addresses import address_index
+from modules.delivery import delivery_queue
+from modules.extensions import db as _db
+from modules.resource_cache import resource_cache
+from modules.smtp import smtp_pool
+from smtp_stub import SMTPStub
+
+TESTDB = 'test_project.db'
+TESTDB_PATH = os.path.join(os.getcwd(), TESTDB)
+TEST_DATABASE_URI = 'sqlite:///' + TESTDB_PATH
+
+
+@pytest.fixture(scope='session')
+def app(request):
+    settings_override = {
+        'TESTING': True,
+        'SQLALCHEMY_DATABASE_URI': TEST_DATABASE_URI,
+        'MAIL_SUPPRESS_SEND': True,
+        'DELIVERY_WORKERS': 0
+    }
+    app = create_app(test_config=settings_override)
+
+    ctx = app.app_context()
+    ctx.push()
+
+    def teardown():
+        ctx.pop()
+
+    request.addfinalizer(teardown)
+    return app
+
+
+@pytest.fixture(scope='session')
+def db(app, request):
+    if os.path.exists(TESTDB_PATH):
+        os.unlink(TESTDB_PATH)
+
+    def teardown():
+        _db.drop_all()
+        os.unlink(TESTDB_PATH)
+
+    _db.app = app
+    _db.create_all()
+    migrations.upgrade(_db.engine)  # full text search index and triggers
+
+    request.addfinalizer(teardown)
+    return _db
+
+
+@pytest.fixture(scope='function')
+def session(db, request):
+    connection = db.engine.connect()
+    transaction = connection.begin()
+
+    options = dict(bind=connection, binds={})
+    session = db.create_scoped_session(options=options)
+
+    global_session = db.session
+    db.session = session
+
+    def teardown():
+        transaction.rollback()
+        connection.close()
+        session.remove()
+        db.session = global_session
+        # ids of rolled back rows are used again by the next test
+        resource_cache.state.clear()
+        address_index.state.clear()
+        # wakeups for emails of the rolled back transaction
+        delivery_queue.cancel_retry()
+
+    request.addfinalizer(teardown)
+    return session
+
+
+@pytest.fixture(scope='function')
+def client(app, session):
+    return app.test_client()
+
+
+@pytest.fixture(scope='function')
+def smtp_server(request):
+    server = SMTPStub().start()
+    request.addfinalizer(server.stop)
+    return server
+
+
+@pytest.fixture(scope='function')
+def stub_mail(app, smtp_server):
+    """
+    session app sending to local stub SMTP server
+    """
+    state = app.extensions['mail']
+    saved = state.server, state.port, state.suppress
+    state.server, state.port = '127.0.0.1', smtp_server.port
+    state.suppress = False
+    smtp_pool.close()  # idle connections were opened in suppress mode
+    yield smtp_server
+    smtp_pool.close()
+    state.server, state.port, state.suppress = saved
+
+
+@pytest.fixture(scope='function')
+def smtp_app(smtp_server, request):
+    """
+    app sending emails to local stub SMTP server, without database
+    """
+    app = create_app(
+        test_config={
+            'TESTING': True,
+            'SQLALCHEMY_DATABASE_URI': 'sqlite://',
+            'MAIL_SUPPRESS_SEND': False,
+            'MAIL_SERVER': '127.0.0.1',
+            'MAIL_PORT': smtp_server.port,
+            'MAIL_DEFAULT_SENDER': 'sender@a.pl',
+            'DELIVERY_WORKERS': 0
+        })
+    ctx = app.app_context()
+    ctx.push()
+    request.addfinalizer(ctx.pop)
+    return app
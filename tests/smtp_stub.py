@@ -0,0 +1,102 @@
+import socketserver
+import threading
+
+
+class SMTPStubHandler(socketserver.StreamRequestHandler):
+    """
+    accepts everything, just enough SMTP for smtplib
+    """
+    def reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+            server.open_sockets.add(self.request)
+        try:
+            self.reply('220 stub ESMTP')
+            envelope = {'rcpt': []}
+            while True:
+                line = self.rfile.readline()
+                if not line:
+                    break
+                command = line.decode(errors='replace').strip()
+                verb = command[:4].upper()
+                if verb in ('EHLO', 'HELO'):
+                    self.reply('250-stub')
+                    self.reply('250 8BITMIME')
+                elif verb == 'MAIL':
+                    envelope = {'from': command[10:], 'rcpt': []}
+                    self.reply('250 OK')
+                elif verb == 'RCPT':
+                    if command[8:].strip('<>') in server.refused:
+                        self.reply('550 No such user')
+                        continue
+                    if command[8:].strip('<>') in server.deferred:
+                        self.reply('450 Mailbox busy, try later')
+                        continue
+                    envelope['rcpt'].append(command[8:])
+                    self.reply('250 OK')
+                elif verb == 'DATA':
+                    self.reply('354 End data with <CR><LF>.<CR><LF>')
+                    data = []
+                    while True:
+                        line = self.rfile.readline()
+                        if not line or line == b'.\r\n':
+                            break
+                        data.append(line)
+                    envelope['data'] = b''.join(data)
+                    with server.lock:
+                        server.messages.append(envelope)
+                    self.reply('250 OK queued')
+                elif verb == 'QUIT':
+                    self.reply('221 Bye')
+                    break
+                else:  # RSET, NOOP etc
+                    self.reply('250 OK')
+        except OSError:
+            pass  # connection dropped by drop_connections
+        finally:
+            with server.lock:
+                server.open_sockets.discard(self.request)
+
+
+class SMTPStub(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='127.0.0.1', port=0):
+        super().__init__((host, port), SMTPStubHandler)
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.messages = []
+        self.refused = set()  # addresses rejected at RCPT TO
+        self.deferred = set()  # addresses rejected temporarily
+        self.open_sockets = set()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.drop_connections()
+        self.server_close()
+
+    def drop_connections(self):
+        """
+        simulates server closing idle connections
+        """
+        with self.lock:
+            sockets = list(self.open_sockets)
+        for sock in sockets:
+            try:
+                sock.shutdown(2)
+            except OSError:
+                pass
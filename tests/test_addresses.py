@@ -0,0 +1,75 @@
+from sqlalchemy import event
+
+from modules.database import Email, EmailUser
+
+
+def post_email(client, **fields):
+    return client.post('/email',
+                       json={
+                           'message': 'asd',
+                           'subject': 'asd',
+                           **fields
+                       })
+
+
+def test_email_by_addresses_creates_users_once(session, client, db):
+    res = post_email(client,
+                     sender_email='new@a.pl',
+                     receipents_emails='one@a.pl,two@b.pl,one@a.pl')
+    email = Email.query.get(res.json['id'])
+    assert email.sender.email_address == 'new@a.pl'
+    assert sorted(user.email_address
+                  for user in email.recipents) == ['one@a.pl', 'two@b.pl']
+
+    statements = []
+
+    def count(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', count)
+    try:
+        res = post_email(client,
+                         sender_email='new@a.pl',
+                         receipents_emails='two@b.pl')
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', count)
+    # cached addresses are not looked up
+    assert not any('FROM email_user' in s for s in statements)
+    assert EmailUser.query.filter(
+        EmailUser.email_address.in_(['new@a.pl', 'one@a.pl',
+                                     'two@b.pl'])).count() == 3
+
+
+def test_ids_and_addresses_mixed(session, client):
+    sender = EmailUser(email_address='sender@a.pl')
+    session.add(sender)
+    session.commit()
+    res = post_email(client, sender=sender.id, receipents_emails='x@a.pl')
+    email = Email.query.get(res.json['id'])
+    assert email.sender_id == sender.id
+    assert [user.email_address for user in email.recipents] == ['x@a.pl']
+
+    res = post_email(client, sender=sender.id)
+    assert 'receipents' in res.json['errors']['json']
+
+
+def test_batch_with_addresses(session, client):
+    item = {
+        'message': 'asd',
+        'subject': 'asd',
+        'sender_email': 'batch@a.pl',
+        'receipents_emails': 'r1@a.pl,r2@a.pl'
+    }
+    no_sender = {'message': 'asd', 'subject': 'asd'}
+    res = client.post('/emails/batch', json=[item, item, no_sender])
+    assert res.json['created'] == 2
+    assert 'sender' in res.json['results'][2]['errors']
+    assert EmailUser.query.filter(
+        EmailUser.email_address.in_(['batch@a.pl', 'r1@a.pl',
+                                     'r2@a.pl'])).count() == 3
+
+
+def test_user_must_not_exist(session, client):
+    assert client.post('/user', json={'email': 'dup@a.pl'}).status_code == 200
+    res = client.post('/user', json={'email': 'dup@a.pl'})
+    assert 'already exists' in res.json['errors']['json']['email'][0]
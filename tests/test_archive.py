@@ -0,0 +1,83 @@
+from datetime import datetime, timedelta
+
+from modules.archive import archive
+from modules.database import (Attachment, Email, EmailUser, email_archive,
+                              recipents_rels)
+from modules.mail import MailSearch
+
+
+def make_email(session, sender, recipent, status, age_days):
+    email = Email(subject=f'{status} {age_days}',
+                  message='body',
+                  status=status,
+                  pub_date=datetime.utcnow() - timedelta(days=age_days))
+    email.sender = sender
+    email.recipents.append(recipent)
+    session.add(email)
+    session.flush()
+    return email.id
+
+
+def test_old_sent_emails_archived_in_batches(session, client):
+    sender = EmailUser(email_address='sender@a.pl')
+    recipent = EmailUser(email_address='recipent@a.pl')
+    session.add_all([sender, recipent])
+    old_sent = [
+        make_email(session, sender, recipent, 'sent', 40) for _ in range(3)
+    ]
+    old_failed = make_email(session, sender, recipent, 'failed', 40)
+    new_sent = make_email(session, sender, recipent, 'sent', 1)
+    newest = make_email(session, sender, recipent, 'sent', 40)
+    session.commit()
+    session.execute(recipents_rels.update().where(
+        recipents_rels.c.email_id.in_(old_sent)).values(status='sent'))
+    session.commit()
+
+    assert archive.archive(timedelta(days=30), batch_size=2) == 3
+
+    working = {email.id for email in Email.query}
+    assert working == {old_failed, new_sent, newest}
+    assert {row.id for row in session.query(email_archive)} == set(old_sent)
+    assert not session.query(recipents_rels).filter(
+        recipents_rels.c.email_id.in_(old_sent)).count()
+
+    res = client.get(f'/email/{old_sent[0]}')
+    assert res.status_code == 200
+    assert res.json['subject'] == 'sent 40'
+    assert res.json['status'] == 'sent'
+    assert res.json['recipents'] == [{
+        'id': recipent.id,
+        'address': 'recipent@a.pl',
+        'status': 'sent'
+    }]
+    assert 'errors' in client.get('/email/1000000000').json
+
+
+def test_archived_attachments_and_search(session, client):
+    sender = EmailUser(email_address='sender@a.pl')
+    session.add(sender)
+    old = make_email(session, sender, sender, 'sent', 40)
+    make_email(session, sender, sender, 'sent', 1)
+    attachment = Attachment(name='invoice.pdf', email_id=old)
+    session.add(attachment)
+    session.commit()
+    Email.query.filter_by(id=old).update({'subject': 'archived invoice'})
+    session.commit()
+    assert len(MailSearch().search_query('archived').all()) == 1
+
+    archive.archive(timedelta(days=30))
+
+    attachment = Attachment.query.get(attachment.id)
+    assert (attachment.email_id, attachment.archived_email_id) == (None, old)
+    # still belongs to the archived email
+    res = client.post('/email',
+                      json={
+                          'message': 'asd',
+                          'subject': 'asd',
+                          'sender': sender.id,
+                          'receipents': str(sender.id),
+                          'attachments': str(attachment.id)
+                      })
+    assert 'attachments' in res.json['errors']['json']
+    # search covers the working tables only
+    assert MailSearch().search_query('archived').all() == []
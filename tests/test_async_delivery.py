@@ -0,0 +1,160 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+from application import create_app
+from modules.async_delivery import async_delivery
+from modules.async_smtp import SMTPReplyError, SMTPSession
+from modules.database import Email, EmailUser
+from modules.delivery import delivery_queue
+from modules.extensions import db
+
+
+@pytest.fixture
+def async_app(tmp_path, smtp_server):
+    app = create_app(
+        test_config={
+            'TESTING': True,
+            'SQLALCHEMY_DATABASE_URI': f'sqlite:///{tmp_path}/async.db',
+            'MAIL_SUPPRESS_SEND': False,
+            'MAIL_SERVER': '127.0.0.1',
+            'MAIL_PORT': smtp_server.port,
+            'DELIVERY_WORKERS': 0,
+            'SEND_NOW_ASYNC': True,
+            'SMTP_TIMEOUT': 5
+        })
+    ctx = app.app_context()
+    ctx.push()
+    yield app
+    db.session.remove()
+    ctx.pop()
+
+
+def test_send_now_returns_before_delivery(async_app, smtp_server):
+    smtp_server.refused.add('gone@b.pl')
+    users = [
+        EmailUser(email_address=address)
+        for address in ('sender@a.pl', 'one@a.pl', 'gone@b.pl')
+    ]
+    db.session.add_all(users)
+    db.session.commit()
+    sender, *recipents = [user.id for user in users]
+
+    client = async_app.test_client()
+    res = client.post('/email',
+                      json={
+                          'message': 'body',
+                          'subject': 'async',
+                          'sender': sender,
+                          'receipents': ','.join(map(str, recipents)),
+                          'send_now': True
+                      })
+    assert res.status_code == 202
+    assert res.json['status'] == 'sending'
+
+    done, not_done = async_delivery.wait(timeout=10)
+    assert not not_done
+    res = client.get(f'/email/{res.json["id"]}')
+    assert res.json['status'] == 'failed'
+    assert {r['address']: r['status'] for r in res.json['recipents']} == {
+        'one@a.pl': 'sent',
+        'gone@b.pl': 'failed'
+    }
+    assert smtp_server.messages[0]['rcpt'] == ['<one@a.pl>']
+    assert b'\r\n\r\nbody' in smtp_server.messages[0]['data']
+
+
+def test_session_times_out():
+    async def silent_server():
+        async def handle(reader, writer):
+            await asyncio.sleep(1)
+            writer.close()
+
+        server = await asyncio.start_server(handle, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        session = SMTPSession('127.0.0.1', port, timeout=0.1)
+        try:
+            await session.connect()
+        finally:
+            server.close()
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(silent_server())
+
+
+def test_all_recipients_refused(smtp_server):
+    smtp_server.refused.add('gone@b.pl')
+
+    async def send():
+        session = SMTPSession('127.0.0.1', smtp_server.port, timeout=5)
+        await session.connect()
+        try:
+            await session.sendmail('a@a.pl', ['gone@b.pl'], b'Subject: x\n\n.')
+        finally:
+            await session.close()
+
+    with pytest.raises(SMTPReplyError) as error:
+        asyncio.run(send())
+    assert error.value.code == 550
+
+
+def test_lost_async_delivery_is_claimed_again(async_app, smtp_server,
+                                              monkeypatch):
+    users = [
+        EmailUser(email_address=address)
+        for address in ('sender@a.pl', 'one@a.pl')
+    ]
+    db.session.add_all(users)
+    db.session.commit()
+    # process recycled before the loop ran the delivery
+    monkeypatch.setattr(async_delivery, 'submit', lambda *args: None)
+    res = async_app.test_client().post('/email',
+                                       json={
+                                           'message': 'body',
+                                           'subject': 'lost',
+                                           'sender': users[0].id,
+                                           'receipents': str(users[1].id),
+                                           'send_now': True
+                                       })
+    email = Email.query.get(res.json['id'])
+    assert email.status == 'sending' and email.claimed_at is not None
+    assert delivery_queue.submit() is None  # lease not expired yet
+
+    timeout = async_app.config['DELIVERY_CLAIM_TIMEOUT']
+    email.claimed_at = datetime.utcnow() - timedelta(seconds=timeout + 1)
+    db.session.commit()
+    delivery_queue.submit()
+    assert Email.query.get(email.id).status == 'sent'
+    assert smtp_server.messages[-1]['rcpt'] == ['<one@a.pl>']
+
+
+def test_unexpected_error_ends_breaker_probe(async_app, monkeypatch, caplog):
+    users = [
+        EmailUser(email_address=address)
+        for address in ('sender@a.pl', 'one@a.pl')
+    ]
+    db.session.add_all(users)
+    db.session.commit()
+    breaker = async_app.extensions['smtp_pool'].breaker
+    breaker.opened_at = breaker.clock() - breaker.reset_timeout  # half-open
+
+    async def broken(config, msg, addresses):
+        raise UnicodeEncodeError('ascii', 'ą', 0, 1, 'not ascii')
+
+    monkeypatch.setattr(async_delivery, 'send', broken)
+    client = async_app.test_client()
+    for _ in range(2):
+        client.post('/email',
+                    json={
+                        'message': 'body',
+                        'subject': 'probe',
+                        'sender': users[0].id,
+                        'receipents': str(users[1].id),
+                        'send_now': True
+                    })
+        async_delivery.wait(timeout=10)
+        assert not breaker.probing
+        assert breaker.state == 'open'
+    # the second email failed fast on the open circuit, without a traceback
+    assert [r.message for r in caplog.records].count('Send error') == 1
@@ -0,0 +1,106 @@
+import io
+import os
+
+import pytest
+
+from modules.database import Attachment, AttachmentContent
+
+
+@pytest.fixture(scope='function')
+def attachments_dir(app, tmp_path):
+    old_dir = app.config['ATTACHMENTS_DIR']
+    app.config['ATTACHMENTS_DIR'] = str(tmp_path)
+    yield tmp_path
+    app.config['ATTACHMENTS_DIR'] = old_dir
+
+
+def upload(client, data, filename='file.txt'):
+    return client.post('/file',
+                       data={'attachment': (io.BytesIO(data), filename)},
+                       content_type='multipart/form-data')
+
+
+def test_upload_attachment(client, attachments_dir):
+    res = upload(client, b'content')
+    attachment = Attachment.query.get(res.json['file_id'])
+    assert attachment.name == 'file.txt'
+    assert attachment.content.size == 7
+    with open(attachment.file_path, 'rb') as fp:
+        assert fp.read() == b'content'
+    # sharded by the first bytes of sha256
+    sha256 = attachment.sha256
+    assert attachment.file_path == os.path.join(str(attachments_dir),
+                                                sha256[:2], sha256[2:4],
+                                                sha256)
+
+
+def test_upload_duplicate_attachment(client, attachments_dir):
+    first = upload(client, b'same content', 'first.txt').json['file_id']
+    second = upload(client, b'same content', 'second.txt').json['file_id']
+    upload(client, b'other content')
+    assert first != second
+
+    first = Attachment.query.get(first)
+    second = Attachment.query.get(second)
+    assert first.file_path == second.file_path
+    assert first.content.ref_count == 2
+    assert AttachmentContent.query.count() == 2
+
+    stored = [files for _, _, files in os.walk(attachments_dir)]
+    assert sum(len(files) for files in stored) == 2
+
+
+def test_download_attachment(client, attachments_dir):
+    file_id = upload(client, b'0123456789', 'digits.txt').json['file_id']
+    attachment = Attachment.query.get(file_id)
+    attachment.content_type = 'application/x-digits'
+
+    res = client.get(f'/file/{file_id}')
+    assert res.status_code == 200
+    assert res.data == b'0123456789'
+    assert res.content_type == 'application/x-digits'
+    assert res.headers['Accept-Ranges'] == 'bytes'
+    assert 'digits.txt' in res.headers['Content-Disposition']
+    assert res.get_etag() == (attachment.sha256, False)
+    res.close()
+
+    res = client.get(f'/file/{file_id}',
+                     headers={'If-None-Match': f'"{attachment.sha256}"'})
+    assert res.status_code == 304
+    assert res.data == b''
+    res.close()
+
+
+def test_download_attachment_range(client, attachments_dir):
+    file_id = upload(client, b'0123456789').json['file_id']
+
+    res = client.get(f'/file/{file_id}', headers={'Range': 'bytes=2-5'})
+    assert res.status_code == 206
+    assert res.data == b'2345'
+    assert res.headers['Content-Range'] == 'bytes 2-5/10'
+    res.close()
+
+    res = client.get(f'/file/{file_id}', headers={'Range': 'bytes=20-30'})
+    assert res.status_code == 416
+    res.close()
+
+
+def test_download_missing_attachment(client, attachments_dir):
+    res = client.get('/file/12345')
+    assert 'attachment_id' in res.json['errors']['view_args']
+
+    file_id = upload(client, b'lost').json['file_id']
+    os.unlink(Attachment.query.get(file_id).file_path)
+    assert client.get(f'/file/{file_id}').status_code == 404
+
+
+def test_download_attachment_without_file_path(session, client):
+    # rows saved before file paths were stored
+    attachment = Attachment(name='old.txt')
+    session.add(attachment)
+    session.commit()
+    res = client.get(f'/file/{attachment.id}')
+    assert res.status_code == 404
+    assert res.json['errors']['attachment_id'] == [
+        f'File of attachment {attachment.id} is missing'
+    ]
@@ -0,0 +1,39 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                                'benchmarks'))
+
+import bench  # noqa: E402
+
+
+def test_benchmark_runs():
+    args = bench.parse_args([
+        '--users', '20', '--emails', '50', '--attachments', '2',
+        '--attachment-size', '1024', '--requests', '10', '--flush-size', '5'
+    ])
+    results = bench.run(args)
+    assert set(results['results']) == set(bench.SCENARIOS)
+    assert results['results']['flush_pending']['items'] == 5
+    assert results['meta']['smtp_messages'] >= 5
+    assert not bench.compare(results, results, threshold=0)
+
+
+def test_compare_finds_regression():
+    baseline = {
+        'results': {
+            'get_email': {
+                'requests_per_second': 100,
+                'p99_ms': 10
+            }
+        }
+    }
+    results = {
+        'results': {
+            'get_email': {
+                'requests_per_second': 50,
+                'p99_ms': 10
+            }
+        }
+    }
+    assert len(bench.compare(results, baseline, threshold=0.2)) == 1
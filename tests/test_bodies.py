@@ -0,0 +1,72 @@
+import email
+
+from modules.database import Email, EmailUser, MessageBody
+from modules.delivery import delivery_queue
+
+
+def test_big_bodies_stored_once_and_loaded_lazily(app, session, client,
+                                                  stub_mail, monkeypatch):
+    monkeypatch.setitem(app.config, 'MESSAGE_BODY_MIN_BYTES', 1000)
+    sender = EmailUser(email_address='sender@a.pl')
+    session.add(sender)
+    session.commit()
+    body = '<p>newsletter</p>' * 1000
+    item = {
+        'message': body,
+        'subject': 'campaign',
+        'sender': sender.id,
+        'receipents': str(sender.id)
+    }
+    small = dict(item, message='short')
+    res = client.post('/emails/batch', json=[item, item, small])
+    ids = [result['id'] for result in res.json['results']]
+
+    assert session.query(MessageBody).count() == 1
+    stored = session.query(MessageBody).one()
+    assert stored.size == len(body) and len(stored.data) < stored.size / 10
+    rows = {e.id: e for e in Email.query.filter(Email.id.in_(ids))}
+    assert rows[ids[0]].message is None
+    assert rows[ids[0]].body_sha256 == rows[ids[1]].body_sha256
+    assert (rows[ids[2]].message, rows[ids[2]].body_sha256) == ('short', None)
+
+    assert client.get(f'/email/{ids[0]}').json['message'] == body
+    listing = client.get('/emails', query_string={'sender': sender.id})
+    listed = {row['id']: row['message'] for row in listing.json}
+    assert listed[ids[0]] is None and listed[ids[2]] == 'short'
+    found = client.get('/emails/search',
+                       query_string={
+                           'q': 'newsletter',
+                           'sender': sender.id
+                       })
+    assert {row['id'] for row in found.json} == set(ids[:2])
+
+    delivery_queue.submit(email_ids=ids[:1])
+    sent = email.message_from_bytes(stub_mail.messages[0]['data'])
+    assert sent.get_payload(decode=True).decode().strip() == body
+    assert app.extensions['message_bodies'].get_many(
+        [rows[ids[0]].body_sha256])
+
+
+def test_missing_body(app, session, client, stub_mail, monkeypatch):
+    monkeypatch.setitem(app.config, 'MESSAGE_BODY_MIN_BYTES', 10)
+    sender = EmailUser(email_address='lost@a.pl')
+    session.add(sender)
+    session.commit()
+    res = client.post('/email',
+                      json={
+                          'message': 'body that is lost' * 10,
+                          'subject': 'lost',
+                          'sender': sender.id,
+                          'receipents': str(sender.id)
+                      })
+    email_id = res.json['id']
+    session.query(MessageBody).delete()
+    session.commit()
+
+    res = client.get(f'/email/{email_id}')
+    assert res.status_code == 404
+    assert 'email_id' in res.json['errors']
+
+    delivery_queue.submit([email_id])
+    assert Email.query.get(email_id).status == 'failed'
+    assert not stub_mail.messages
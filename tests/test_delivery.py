@@ -0,0 +1,126 @@
+import time
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy.exc import OperationalError
+
+from modules.database import Email, EmailUser, recipents_rels
+from modules.delivery import delivery_queue
+
+
+def make_pending_emails(session, count):
+    sender = EmailUser(email_address='queue@a.pl')
+    recipent = EmailUser(email_address='to@a.pl')
+    session.add_all([sender, recipent])
+    emails = []
+    for i in range(count):
+        email = Email(subject=f'subject {i}', message='body',
+                      status='pending')
+        email.sender = sender
+        email.recipents.append(recipent)
+        emails.append(email)
+    session.add_all(emails)
+    session.commit()
+    return [email.id for email in emails]
+
+
+def test_rows_claimed_by_another_job_are_not_sent(session, stub_mail):
+    first, second = make_pending_emails(session, 2)
+    # claimed a moment ago by another job or process, not sent yet
+    Email.query.filter_by(id=first).update({
+        'status': 'sending',
+        'claimed_by': 'other'
+    })
+    session.commit()
+
+    job = delivery_queue.submit([first, second])
+    assert job.serialize()['sent'] == 1
+    assert len(stub_mail.messages) == 1
+    assert Email.query.get(first).status == 'sending'
+    assert Email.query.get(second).status == 'sent'
+
+
+@pytest.fixture
+def committed(db):
+    """
+    global session committing to the test database, for code that rolls
+    back; rows are deleted afterwards
+    """
+    yield db.session
+    db.session.rollback()
+    db.session.execute(recipents_rels.delete())
+    Email.query.delete()
+    EmailUser.query.delete()
+    db.session.commit()
+
+
+def test_failed_batch_is_put_back(committed, stub_mail, monkeypatch):
+    from modules.mail import MailResource
+
+    email_id, = make_pending_emails(committed, 1)
+
+    def locked(self, emails, throttle=None):
+        raise OperationalError('UPDATE email', {}, 'database is locked')
+
+    monkeypatch.setattr(MailResource, 'send_saved_emails', locked)
+    with pytest.raises(OperationalError):
+        delivery_queue.submit([email_id])
+    email = Email.query.get(email_id)
+    assert (email.status, email.claimed_by) == ('pending', None)
+
+    monkeypatch.undo()
+    delivery_queue.submit([email_id])
+    assert Email.query.get(email_id).status == 'sent'
+
+
+def test_expired_claim_is_claimed_again(app, session, stub_mail):
+    fresh, expired = make_pending_emails(session, 2)
+    timeout = app.config['DELIVERY_CLAIM_TIMEOUT']
+    for email_id, claimed_ago in ((fresh, 1), (expired, timeout + 1)):
+        Email.query.filter_by(id=email_id).update({
+            'status': 'sending',
+            'claimed_by': 'dead worker',
+            'claimed_at': datetime.utcnow() - timedelta(seconds=claimed_ago)
+        })
+    session.commit()
+
+    job = delivery_queue.submit()
+    assert job.serialize()['sent'] == 1
+    assert Email.query.get(fresh).status == 'sending'
+    assert Email.query.get(expired).status == 'sent'
+
+
+def test_deferred_email_is_sent_without_another_flush(app, committed,
+                                                      stub_mail,
+                                                      monkeypatch):
+    monkeypatch.setitem(app.config, 'DELIVERY_RETRY_BASE', 0.2)
+    stub_mail.deferred.add('to@a.pl')
+    email_id, = make_pending_emails(committed, 1)
+
+    assert delivery_queue.submit().serialize()['deferred'] == 1
+    assert delivery_queue.state.retry_timer is not None
+    stub_mail.deferred.clear()
+
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        committed.remove()
+        if Email.query.get(email_id).status == 'sent':
+            break
+        time.sleep(0.05)
+    assert Email.query.get(email_id).status == 'sent'
+    assert delivery_queue.state.retry_timer is None
+
+
+def test_render_error_is_logged(session, stub_mail, monkeypatch, caplog):
+    from modules.mail import MailResource
+
+    email_id, = make_pending_emails(session, 1)
+
+    def broken(self, email, merged=False):
+        raise ValueError('broken template')
+
+    monkeypatch.setattr(MailResource, 'build_message', broken)
+    delivery_queue.submit([email_id])
+    record, = [r for r in caplog.records if r.message == 'Render error']
+    assert record.exc_info[0] is ValueError
+    assert not stub_mail.messages
@@ -0,0 +1,130 @@
+import json
+
+import pytest
+
+from modules.delivery import delivery_queue
+from modules.events import Subscription, _EventHub, status_events
+
+
+def parse(chunk):
+    fields = dict(
+        line.split(': ', 1) for line in chunk.decode().strip().split('\n'))
+    return fields.get('id'), json.loads(fields['data'])
+
+
+def test_hub_fans_out_to_matching_subscriptions():
+    hub = _EventHub(buffer_size=10)
+    by_email = Subscription(email_ids=[1, 2])
+    by_both = Subscription(email_ids=[2], sender=7)
+    by_sender = Subscription(sender=7)
+    everything = Subscription()
+    for subscription in (by_email, by_both, by_sender, everything):
+        hub.subscribe(subscription)
+
+    hub.publish([(1, 5, 'sent'), (2, 7, 'failed'), (3, 7, 'sending')])
+
+    def drain(subscription):
+        events = []
+        while True:
+            event = subscription.get(0)
+            if event is None:
+                return events
+            events.append(event[1:])
+
+    assert drain(by_email) == [(1, 5, 'sent'), (2, 7, 'failed')]
+    assert drain(by_both) == [(2, 7, 'failed')]
+    assert drain(by_sender) == [(2, 7, 'failed'), (3, 7, 'sending')]
+    assert len(drain(everything)) == 3
+
+    for subscription in (by_email, by_both, by_sender, everything):
+        hub.unsubscribe(subscription)
+    assert hub.subscribers() == 0
+    assert not hub.by_email and not hub.by_sender
+
+
+def test_hub_replays_missed_events_and_drops_slow_clients():
+    hub = _EventHub(buffer_size=10)
+    hub.publish([(1, 5, 'sending'), (1, 5, 'sent'), (2, 5, 'sent')])
+
+    # reconnected after the first event
+    subscription = Subscription(email_ids=[1])
+    hub.subscribe(subscription, last_event_id=1)
+    assert subscription.get(0) == (2, 1, 5, 'sent')
+    assert subscription.get(0) is None
+
+    slow = Subscription(max_events=1)
+    hub.subscribe(slow)
+    hub.publish([(3, 5, 'pending'), (4, 5, 'pending')])
+    assert slow.overflowed
+
+
+@pytest.fixture
+def short_streams(app, monkeypatch):
+    monkeypatch.setitem(app.config, 'EVENTS_KEEPALIVE', 0.05)
+    monkeypatch.setitem(app.config, 'EVENTS_STREAM_SECONDS', 0.2)
+
+
+def test_stream_of_email_statuses(session, client, short_streams):
+    res = client.post('/email',
+                      json={
+                          'message': 'asd',
+                          'subject': 'asd',
+                          'sender_email': 'events@a.pl',
+                          'receipents_emails': 'to@a.pl'
+                      })
+    email_id = res.json['id']
+
+    res = client.get(f'/emails/events?email_id={email_id}',
+                     buffered=False)
+    assert res.mimetype == 'text/event-stream'
+    chunks = iter(res.response)
+    assert next(chunks) == b': subscribed\n\n'
+    # current status on connect, without event id
+    event_id, data = parse(next(chunks))
+    assert event_id is None
+    assert data['id'] == email_id and data['status'] == 'pending'
+
+    delivery_queue.submit([email_id])
+    statuses = []
+    for chunk in chunks:
+        if not chunk.startswith(b':'):
+            event_id, data = parse(chunk)
+            statuses.append(data['status'])
+    res.close()
+    assert statuses == ['sending', 'sent']
+    assert status_events.state.subscribers() == 0
+
+    # reconnecting client gets what it missed after Last-Event-ID
+    res = client.get(f'/emails/events?sender={data["sender"]}',
+                     headers={'Last-Event-ID': str(int(event_id) - 1)})
+    events = [
+        parse(chunk)[1] for chunk in res.data.split(b'\n\n')
+        if chunk.startswith(b'id')
+    ]
+    res.close()
+    assert [event['status'] for event in events] == ['sent']
+
+
+def test_stream_closed_before_start_unsubscribes(session, client,
+                                                 short_streams):
+    email_ids = ','.join(str(i) for i in range(1, 2000))
+    res = client.get(f'/emails/events?email_id={email_ids}', buffered=False)
+    assert status_events.state.subscribers() == 1
+    # client gone before the first chunk was sent
+    res.close()
+    assert status_events.state.subscribers() == 0
+
+
+def test_streams_over_the_limit_are_refused(session, client, short_streams,
+                                            monkeypatch):
+    monkeypatch.setattr(status_events.state, 'max_streams', 1)
+    first = client.get('/emails/events', buffered=False)
+    res = client.get('/emails/events', buffered=False)
+    assert res.status_code == 503
+    assert res.headers['Retry-After'] == '5'
+    assert status_events.state.subscribers() == 1
+
+    first.close()
+    res = client.get('/emails/events', buffered=False)
+    assert res.status_code == 200
+    res.close()
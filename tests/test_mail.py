@@ -1,77 +1,8 @@
-import os
+import json
 
-import pytest
+from sqlalchemy import event
 
-from application import create_app
 from modules.database import Attachment, Email, EmailUser
-from modules.extensions import db as _db
-from modules.extensions import mail
-
-TESTDB = 'test_project.db'
-TESTDB_PATH = os.path.join(os.getcwd(), TESTDB)
-TEST_DATABASE_URI = 'sqlite:///' + TESTDB_PATH
-
-
-@pytest.fixture(scope='session')
-def app(request):
-    settings_override = {
-        'TESTING': True,
-        'SQLALCHEMY_DATABASE_URI': TEST_DATABASE_URI,
-        'MAIL_SUPPRESS_SEND': True
-    }
-    app = create_app(test_config=settings_override)
-
-    ctx = app.app_context()
-    ctx.push()
-
-    def teardown():
-        ctx.pop()
-
-    request.addfinalizer(teardown)
-    return app
-
-
-@pytest.fixture(scope='session')
-def db(app, request):
-    if os.path.exists(TESTDB_PATH):
-        os.unlink(TESTDB_PATH)
-
-    def teardown():
-        _db.drop_all()
-        os.unlink(TESTDB_PATH)
-
-    _db.app = app
-    _db.create_all()
-
-    request.addfinalizer(teardown)
-    return _db
-
-
-@pytest.fixture(scope='function')
-def session(db, request):
-    connection = db.engine.connect()
-    transaction = connection.begin()
-
-    options = dict(bind=connection, binds={})
-    session = db.create_scoped_session(options=options)
-
-    db.session = session
-
-    def teardown():
-        transaction.rollback()
-        connection.close()
-        session.remove()
-
-    request.addfinalizer(teardown)
-    return session
-
-
-@pytest.fixture(scope='function')
-def client(app, session):
-    return app.test_client()
-
-
-# end of fixtures
 
 
 def test_add_user(session):
@@ -149,11 +80,43 @@ def test_send_all_pending(client):
                         'send_now': False
                     })
     res = client.post('/emails')
-    assert res.json.get('status') == 'ok'
+    assert res.json.get('status') == 'done'
+    assert res.json.get('sent') == 5
     sent_emails = Email.query.filter_by(status='sent').all()
     assert len(sent_emails) == 5
 
 
+def test_send_all_pending_job_progress(session, client):
+    sender = EmailUser(email_address='sender@a.pl')
+    recipent = EmailUser(email_address='recipent@a.pl')
+    session.add_all([sender, recipent])
+    session.commit()
+    for i in range(3):
+        client.post('/email',
+                    json={
+                        'message': 'asd',
+                        'subject': 'asd',
+                        'sender': sender.id,
+                        'receipents': str(recipent.id),
+                        'send_now': False
+                    })
+    res = client.post('/emails')
+    assert res.status_code == 202
+    job_id = res.json['job_id']
+    res = client.get(f'/emails/jobs/{job_id}')
+    assert res.json['job_id'] == job_id
+    assert res.json['status'] == 'done'
+    assert res.json['total'] == 3
+    assert res.json['sent'] == 3
+    assert res.json['failed'] == 0
+    assert client.post('/emails').json == {'status': 'no pending mails'}
+
+
+def test_unknown_job(client):
+    res = client.get('/emails/jobs/unknown')
+    assert res.status_code == 404
+
+
 def test_send_bad_email(client):
     res = client.post('/email',
                       json={
@@ -169,3 +132,207 @@ def test_send_bad_email(client):
     assert len(sent_emails) == 0
 
     # tests for attachments etc
+
+
+def test_get_emails_pages(session, client):
+    sender = EmailUser(email_address='sender@a.pl')
+    session.add(sender)
+    session.commit()
+    for i in range(5):
+        session.add(Email(subject=f'{i}', status='pending'))
+    session.add(Email(subject='5', status='sent', sender_id=sender.id))
+    session.commit()
+
+    res = client.get('/emails?limit=2&status=pending')
+    assert [email['subject'] for email in res.json] == ['0', '1']
+    cursor = res.headers['X-Next-Cursor']
+    res = client.get(f'/emails?limit=2&status=pending&cursor={cursor}')
+    assert [email['subject'] for email in res.json] == ['2', '3']
+    cursor = res.headers['X-Next-Cursor']
+    res = client.get(f'/emails?limit=2&status=pending&cursor={cursor}')
+    assert [email['subject'] for email in res.json] == ['4']
+    assert 'X-Next-Cursor' not in res.headers
+
+    res = client.get(f'/emails?sender={sender.id}&order=pub_date')
+    assert [email['subject'] for email in res.json] == ['5']
+
+
+def test_get_emails_single_query(session, client, db):
+    user = EmailUser(email_address='listed@a.pl')
+    session.add(user)
+    session.commit()
+    for i in range(3):
+        email = Email(subject=f'{i}', message='body', status='pending')
+        email.recipents.append(user)
+        session.add(email)
+    session.commit()
+    email_id = email.id
+
+    statements = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', count)
+    try:
+        res = client.get('/emails')
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', count)
+
+    # only projected columns, recipents are not loaded
+    assert len(statements) == 1
+    assert 'recipents' not in statements[0]
+    listed = res.json[-1]
+    assert listed == {
+        key: value
+        for key, value in client.get(f'/email/{email_id}').json.items()
+        if key != 'recipents'
+    }
+
+
+def test_get_emails_bad_cursor(client):
+    res = client.get('/emails?cursor=abc')
+    assert res.status_code == 400
+
+
+def test_get_emails_stream(session, client):
+    for i in range(3):
+        session.add(Email(subject=f'{i}'))
+    session.commit()
+    res = client.get('/emails?stream=true')
+    assert res.is_streamed
+    assert [email['subject'] for email in res.json] == ['0', '1', '2']
+
+
+def test_get_users_pages(session, client):
+    for i in range(3):
+        session.add(EmailUser(email_address=f'{i}@a.pl'))
+    session.commit()
+    res = client.get('/users?limit=2')
+    assert res.json == ['0@a.pl', '1@a.pl']
+    cursor = res.headers['X-Next-Cursor']
+    res = client.get(f'/users?cursor={cursor}')
+    assert res.json == ['2@a.pl']
+
+
+def test_create_email_queries_are_set_based(session, client, db):
+    users = [EmailUser(email_address=f'{i}@a.pl') for i in range(20)]
+    attachments = [Attachment(name=f'{i}') for i in range(3)]
+    session.add_all(users + attachments)
+    session.commit()
+    user_ids = [user.id for user in users]
+    attachment_ids = [attachment.id for attachment in attachments]
+
+    statements = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', count)
+    try:
+        res = client.post('/email',
+                          json={
+                              'message': 'asd',
+                              'subject': 'asd',
+                              'sender': user_ids[0],
+                              'receipents': ','.join(map(str, user_ids)),
+                              'attachments': ','.join(map(str, attachment_ids))
+                          })
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', count)
+
+    assert res.json['status'] == 'pending'
+    email = Email.query.get(res.json['id'])
+    assert len(email.recipents) == 20
+    assert len(email.attachments) == 3
+    user_selects = [s for s in statements if 'FROM email_user' in s]
+    attachment_selects = [s for s in statements if 'FROM attachment' in s]
+    # at most one IN (...) query for sender and one for all recipents
+    assert len(user_selects) <= 2
+    assert not [s for s in user_selects if 'email_user.id = ?' in s]
+    assert len(attachment_selects) == 1
+    recipent_inserts = [
+        s for s in statements if s.startswith('INSERT INTO recipents')
+    ]
+    assert len(recipent_inserts) == 1  # executemany
+
+
+def test_create_email_unknown_recipents(session, client):
+    sender = EmailUser(email_address='sender@a.pl')
+    session.add(sender)
+    session.commit()
+    res = client.post('/email',
+                      json={
+                          'message': 'asd',
+                          'subject': 'asd',
+                          'sender': sender.id,
+                          'receipents': f'{sender.id},998,999'
+                      })
+    assert res.json['errors']['json']['receipents'] == [
+        'Users with given ids (998, 999) do not exist'
+    ]
+
+
+def test_create_emails_batch(session, client):
+    sender = EmailUser(email_address='sender@a.pl')
+    recipent = EmailUser(email_address='recipent@a.pl')
+    attachment = Attachment(name='file')
+    session.add_all([sender, recipent, attachment])
+    session.commit()
+    item = {
+        'message': 'asd',
+        'subject': 'asd',
+        'sender': sender.id,
+        'receipents': f'{sender.id},{recipent.id}'
+    }
+    res = client.post('/emails/batch',
+                      json=[
+                          {
+                              **item, 'attachments': str(attachment.id)
+                          },
+                          {
+                              **item, 'send_now': True
+                          },
+                          {
+                              **item, 'receipents': '999'
+                          },
+                      ])
+    assert res.json['created'] == 2
+    assert res.json['failed'] == 1
+    first, second, third = res.json['results']
+    assert first['status'] == 'pending'
+    assert third['errors'] == {
+        'receipents': ['Users with given ids (999) do not exist']
+    }
+    assert res.json['job']['sent'] == 1
+
+    email = Email.query.get(first['id'])
+    assert email.status == 'pending'
+    assert len(email.recipents) == 2
+    assert [a.name for a in email.attachments] == ['file']
+    email = Email.query.get(second['id'])
+    assert email.status == 'sent'
+
+
+def test_create_emails_batch_ndjson(session, client):
+    sender = EmailUser(email_address='sender@a.pl')
+    session.add(sender)
+    session.commit()
+    item = json.dumps({
+        'message': 'asd',
+        'subject': 'asd',
+        'sender': sender.id,
+        'receipents': str(sender.id)
+    })
+    res = client.post('/emails/batch',
+                      data='\n'.join([item] * 3) + '\n',
+                      content_type='application/x-ndjson')
+    assert res.json['created'] == 3
+    ids = [result['id'] for result in res.json['results']]
+    assert len(set(ids)) == 3
+    assert Email.query.filter(Email.id.in_(ids)).count() == 3
+
+
+def test_create_emails_batch_not_a_list(client):
+    res = client.post('/emails/batch', json={'message': 'asd'})
+    assert res.status_code == 400
@@ -0,0 +1,44 @@
+from modules.database import Email, EmailUser
+from modules.metrics import Histogram
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram('latency_seconds', 'Latency', ('endpoint', ),
+                          buckets=(0.1, 1))
+    for value in (0.05, 0.5, 0.7, 5):
+        histogram.observe(value, '/email')
+    assert list(histogram.samples()) == [
+        ('latency_seconds_bucket', '{endpoint="/email",le="0.1"}', 1),
+        ('latency_seconds_bucket', '{endpoint="/email",le="1.0"}', 3),
+        ('latency_seconds_bucket', '{endpoint="/email",le="+Inf"}', 4),
+        ('latency_seconds_sum', '{endpoint="/email"}', 6.25),
+        ('latency_seconds_count', '{endpoint="/email"}', 4),
+    ]
+
+
+def test_metrics_endpoint(session, client):
+    user = EmailUser(email_address='metrics@a.pl')
+    session.add(user)
+    session.commit()
+    for _ in range(2):
+        email = Email(subject='queued', status='pending')
+        email.sender = user
+        session.add(email)
+    session.commit()
+
+    client.get(f'/email/{email.id}')
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.content_type.startswith('text/plain; version=0.0.4')
+    samples = dict(
+        line.rsplit(' ', 1)
+        for line in response.get_data(as_text=True).splitlines()
+        if not line.startswith('#'))
+    # session app is shared by all tests, other requests may be counted too
+    assert float(samples['http_requests_total{method="GET",'
+                         'endpoint="/email/<email_id>",status="200"}']) >= 1
+    assert samples['email_queue_depth{status="pending"}'] == '2.0'
+    assert float(samples['http_request_db_queries_sum'
+                         '{endpoint="/email/<email_id>"}']) > 0
+    assert 'http_request_phase_seconds_count{endpoint="/email/<email_id>",' \
+        'phase="db"}' in samples
@@ -0,0 +1,71 @@
+import sqlite3
+
+from application import create_app
+from modules.extensions import db
+from modules.migrations import MIGRATIONS, upgrade
+
+# schema created by the first version of the models
+BASELINE_SCHEMA = """
+CREATE TABLE email_user (
+    id INTEGER NOT NULL, email_address VARCHAR, PRIMARY KEY (id));
+CREATE TABLE email (
+    id INTEGER NOT NULL, pub_date DATETIME NOT NULL, subject VARCHAR,
+    message VARCHAR, status VARCHAR, priority INTEGER, sender_id INTEGER,
+    PRIMARY KEY (id), FOREIGN KEY(sender_id) REFERENCES email_user (id));
+CREATE TABLE attachment (
+    id INTEGER NOT NULL, file_path VARCHAR, name VARCHAR,
+    content_type VARCHAR, email_id INTEGER, PRIMARY KEY (id),
+    FOREIGN KEY(email_id) REFERENCES email (id));
+CREATE TABLE recipents (
+    email_id INTEGER NOT NULL, recipent_id INTEGER NOT NULL,
+    PRIMARY KEY (email_id, recipent_id),
+    FOREIGN KEY(email_id) REFERENCES email (id),
+    FOREIGN KEY(recipent_id) REFERENCES email_user (id));
+INSERT INTO email_user VALUES (1, 'a@a.pl'), (2, 'b@b.pl'), (3, 'a@a.pl');
+INSERT INTO email VALUES (1, '2020-01-01 00:00:00', 's', 'm', 'pending', 1, 3);
+INSERT INTO recipents VALUES (1, 1), (1, 2), (1, 3);
+"""
+
+
+def test_upgrade_baseline_database(tmp_path):
+    path = tmp_path / 'database.db'
+    conn = sqlite3.connect(str(path))
+    conn.executescript(BASELINE_SCHEMA)
+    conn.close()
+
+    create_app(test_config={
+        'TESTING': True,
+        'SQLALCHEMY_DATABASE_URI': f'sqlite:///{path}'
+    })
+
+    conn = sqlite3.connect(str(path))
+    assert conn.execute('PRAGMA user_version').fetchone()[0] == MIGRATIONS[-1][0]
+    indexes = {
+        row[0]
+        for row in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index'")
+    }
+    assert 'ix_email_status_priority_pub_date' in indexes
+    assert 'ix_email_user_email_address' in indexes
+    assert 'sha256' in {row[1] for row in conn.execute(
+        'PRAGMA table_info(attachment)')}
+
+    # duplicated user merged into the first one
+    assert conn.execute('SELECT id, email_address FROM email_user').fetchall(
+    ) == [(1, 'a@a.pl'), (2, 'b@b.pl')]
+    assert conn.execute('SELECT sender_id FROM email').fetchall() == [(1, )]
+    assert conn.execute('SELECT recipent_id FROM recipents ORDER BY 1'
+                        ).fetchall() == [(1, ), (2, )]
+    conn.close()
+
+
+def test_upgrade_is_noop_for_current_database(tmp_path):
+    path = tmp_path / 'database.db'
+    uri = f'sqlite:///{path}'
+    create_app(test_config={'TESTING': True, 'SQLALCHEMY_DATABASE_URI': uri})
+    app = create_app(test_config={
+        'TESTING': True,
+        'SQLALCHEMY_DATABASE_URI': uri
+    })
+    with app.app_context():
+        assert upgrade(db.get_engine(app)) == []
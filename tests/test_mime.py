@@ -0,0 +1,62 @@
+import email
+
+from modules.database import Attachment
+from modules.mime import EncodedPartCache, MailMessage, attachment_cache
+from modules.smtp import smtp_pool
+
+
+def make_attachment(tmp_path, attachment_id, content):
+    path = tmp_path / f'{attachment_id}.txt'
+    path.write_bytes(content)
+    return Attachment(id=attachment_id,
+                      file_path=str(path),
+                      name=f'{attachment_id}.txt',
+                      content_type='text/plain')
+
+
+def make_message():
+    return MailMessage(subject='subject',
+                       recipients=['recipent@a.pl'],
+                       body='body',
+                       sender='sender@a.pl')
+
+
+def test_attachment_is_encoded_once(smtp_app, smtp_server, tmp_path):
+    attachment = make_attachment(tmp_path, 1, b'attached content')
+    for _ in range(3):
+        msg = make_message()
+        msg.attach_encoded(attachment)
+        smtp_pool.send(msg)
+
+    cache = attachment_cache.state
+    assert cache.misses == 1
+    assert cache.hits == 2
+
+    assert len(smtp_server.messages) == 3
+    for message in smtp_server.messages:
+        parsed = email.message_from_bytes(message['data'])
+        body, part = parsed.get_payload()
+        assert body.get_payload() == 'body'
+        assert part.get_filename() == '1.txt'
+        assert part.get_content_type() == 'text/plain'
+        assert part.get_payload(decode=True) == b'attached content'
+
+
+def test_message_without_attachments(smtp_app):
+    parsed = email.message_from_bytes(make_message().as_bytes())
+    assert not parsed.is_multipart()
+    assert parsed['Subject'] == 'subject'
+
+
+def test_cache_evicts_least_recently_used(smtp_app, tmp_path):
+    # 30 bytes encode to 41 bytes of base64
+    attachments = [
+        make_attachment(tmp_path, i, bytes(30)) for i in range(3)
+    ]
+    cache = EncodedPartCache(max_bytes=100)
+    cache.get(attachments[0])
+    cache.get(attachments[1])
+    cache.get(attachments[0])
+    cache.get(attachments[2])
+    assert list(cache.parts) == [0, 2]
+    assert cache.size <= 100
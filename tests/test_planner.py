@@ -0,0 +1,87 @@
+import email
+
+from modules.database import Email, EmailUser
+from modules.delivery import delivery_queue
+from modules.planner import plan_deliveries
+
+
+def make_email(session, sender, recipents, subject='subject'):
+    email = Email(subject=subject, message='body', status='pending')
+    email.sender = sender
+    email.recipents.extend(recipents)
+    session.add(email)
+    return email
+
+
+def make_users(session, *addresses):
+    users = [EmailUser(email_address=address) for address in addresses]
+    session.add_all(users)
+    return users
+
+
+def test_recipents_grouped_by_domain(session):
+    sender, *recipents = make_users(session, 'sender@a.pl', 'one@a.pl',
+                                    'two@b.pl', 'three@a.pl', 'four@a.pl')
+    email = make_email(session, sender, recipents)
+    session.commit()
+
+    plan = plan_deliveries([email], max_recipents=2)
+    assert [(envelope.domain, envelope.addresses)
+            for envelope in plan.envelopes] == [
+                ('a.pl', ['one@a.pl', 'three@a.pl']),
+                ('a.pl', ['four@a.pl']),
+                ('b.pl', ['two@b.pl']),
+            ]
+    assert list(plan.messages) == [('email', email.id)]
+
+
+def test_identical_emails_merged(session):
+    sender, first, second = make_users(session, 'sender@a.pl', 'first@a.pl',
+                                       'second@a.pl')
+    emails = [
+        make_email(session, sender, [first]),
+        make_email(session, sender, [second]),
+        make_email(session, sender, [second], subject='other'),
+    ]
+    session.commit()
+
+    assert len(plan_deliveries(emails).messages) == 3
+    plan = plan_deliveries(emails, merge_identical=True)
+    assert len(plan.messages) == 2
+    assert plan.envelopes[0].addresses == ['first@a.pl', 'second@a.pl']
+
+
+def test_envelope_per_domain_with_recipent_status(session, client,
+                                                   stub_mail):
+    stub_mail.refused.add('gone@b.pl')
+    sender, *recipents = make_users(session, 'sender@a.pl', 'one@a.pl',
+                                    'two@a.pl', 'three@b.pl', 'gone@b.pl')
+    delivered = make_email(session, sender, recipents[:2])
+    partial = make_email(session, sender, recipents)
+    session.commit()
+
+    job = delivery_queue.submit([delivered.id, partial.id])
+    assert (job.sent, job.failed) == (1, 1)
+
+    envelopes = sorted((message['rcpt'], message['data'])
+                       for message in stub_mail.messages)
+    assert [rcpt for rcpt, _ in envelopes] == [
+        ['<one@a.pl>', '<two@a.pl>'],
+        ['<one@a.pl>', '<two@a.pl>'],
+        ['<three@b.pl>'],
+    ]
+    # message of every email is rendered once, for all its envelopes
+    message_ids = {email.message_from_bytes(data)['Message-ID']
+                for _, data in envelopes}
+    assert len(message_ids) == 2
+
+    response = client.get(f'/email/{partial.id}')
+    assert response.json['status'] == 'failed'
+    assert {r['address']: r['status'] for r in response.json['recipents']} == {
+        'one@a.pl': 'sent',
+        'two@a.pl': 'sent',
+        'three@b.pl': 'sent',
+        'gone@b.pl': 'failed'
+    }
+    response = client.get(f'/email/{delivered.id}')
+    assert response.json['status'] == 'sent'
@@ -0,0 +1,62 @@
+"""
+hot queries have to use indexes, fails when sqlite falls back to full scan
+"""
+import pytest
+
+from modules.database import Attachment, Email, EmailUser, recipents_rels
+from modules.delivery import delivery_queue
+from modules.mail import MailSearch
+
+
+def query_plan(db, query):
+    statement = getattr(query, 'statement', query)
+    sql = statement.compile(dialect=db.engine.dialect,
+                            compile_kwargs={'literal_binds': True})
+    rows = db.session.execute(f'EXPLAIN QUERY PLAN {sql}')
+    return [row[-1] for row in rows]
+
+
+def assert_no_full_scan(plan):
+    scans = [
+        step for step in plan
+        if step.startswith('SCAN') and 'INDEX' not in step
+    ]
+    assert not scans, plan
+
+
+HOT_QUERIES = {
+    'pending queue':
+    lambda: delivery_queue.pending_query().with_entities(Email.id).order_by(
+        Email.priority, Email.pub_date).limit(100),
+    'pending claim':
+    lambda: delivery_queue.pending_query().with_entities(Email.id).order_by(
+        Email.id).limit(100),
+    'pending claim by priority':
+    lambda: delivery_queue.pending_priority_query(1).limit(100),
+    'pending claim by default priority':
+    lambda: delivery_queue.pending_priority_query(3).limit(100),
+    'pending count':
+    lambda: delivery_queue.pending_query().with_entities(Email.id),
+    'emails by status':
+    lambda: Email.query.filter(Email.status == 'sent').order_by(Email.id),
+    'emails of sender':
+    lambda: Email.query.filter(Email.sender_id == 1).order_by(Email.id),
+    'emails by date':
+    lambda: Email.query.order_by(Email.pub_date, Email.id).limit(100),
+    'user by address':
+    lambda: EmailUser.query.filter(EmailUser.email_address == 'a@a.pl'),
+    'emails of recipent':
+    lambda: recipents_rels.select().where(recipents_rels.c.recipent_id == 1),
+    'attachments of email':
+    lambda: Attachment.query.filter(Attachment.email_id == 1),
+    'full text search':
+    lambda: MailSearch().search_query('invoice', status='sent', sender=1),
+    'attachments with content':
+    lambda: Attachment.query.filter(Attachment.sha256 == 'abc'),
+}
+
+
+@pytest.mark.parametrize('name', sorted(HOT_QUERIES))
+def test_hot_query_uses_index(session, db, name):
+    plan = query_plan(db, HOT_QUERIES[name]())
+    assert_no_full_scan(plan)
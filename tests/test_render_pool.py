@@ -0,0 +1,69 @@
+import email
+
+import pytest
+
+from application import create_app
+from modules.database import Attachment
+from modules.mail import MailResource
+from modules.mime import MailMessage
+from modules.render_pool import render_pool
+
+
+@pytest.fixture
+def render_app(smtp_server, request):
+    app = create_app(
+        test_config={
+            'TESTING': True,
+            'SQLALCHEMY_DATABASE_URI': 'sqlite://',
+            'MAIL_SUPPRESS_SEND': False,
+            'MAIL_SERVER': '127.0.0.1',
+            'MAIL_PORT': smtp_server.port,
+            'DELIVERY_WORKERS': 0,
+            'MIME_RENDER_PROCESSES': 1,
+            'MIME_RENDER_MIN_BYTES': 1000
+        })
+    ctx = app.app_context()
+    ctx.push()
+
+    def teardown():
+        render_pool.close()
+        ctx.pop()
+
+    request.addfinalizer(teardown)
+    return app
+
+
+def make_attachment(tmp_path, attachment_id, content):
+    path = tmp_path / f'{attachment_id}.bin'
+    path.write_bytes(content)
+    return Attachment(id=attachment_id,
+                      file_path=str(path),
+                      name=f'{attachment_id}.bin',
+                      content_type='application/octet-stream')
+
+
+def make_message():
+    return MailMessage(subject='rendered',
+                       recipients=['recipent@a.pl'],
+                       body='body',
+                       sender='sender@a.pl')
+
+
+def test_big_attachments_rendered_in_worker(render_app, smtp_server,
+                                            tmp_path):
+    big = make_attachment(tmp_path, 1, bytes(range(256)) * 8)
+    small = make_attachment(tmp_path, 2, b'small')
+
+    assert render_pool.submit(make_message(), [small]) is None
+    assert render_pool.submit(make_message(), [big]) is not None
+
+    status, refused = MailResource().send_message(
+        make_message(), {'X-Priority': '1'}, [big, small])
+    assert (status, refused) == ('sent', {})
+    parsed = email.message_from_bytes(smtp_server.messages[0]['data'])
+    assert parsed['Subject'] == 'rendered'
+    assert parsed['X-Priority'] == '1'
+    body, *parts = parsed.get_payload()
+    assert body.get_payload() == 'body'
+    assert [part.get_payload(decode=True)
+            for part in parts] == [bytes(range(256)) * 8, b'small']
@@ -0,0 +1,72 @@
+import time
+
+from sqlalchemy import event
+
+from modules.database import Email, EmailUser
+from modules.delivery import delivery_queue
+from modules.resource_cache import TTLCache
+
+
+def test_cache_is_bounded_and_expires():
+    cache = TTLCache(max_entries=2, ttl=0.05)
+    for key in 'abc':
+        cache.put(key, b'{}')
+    assert list(cache.entries) == ['b', 'c']
+    assert cache.get('c').body == b'{}'
+    time.sleep(0.06)
+    assert cache.get('c') is None
+
+
+def test_repeated_poll_is_not_modified(session, client, db):
+    user = EmailUser(email_address='poll@a.pl')
+    session.add(user)
+    session.commit()
+    email = Email(subject='poll', status='pending')
+    email.sender = user
+    email.recipents.append(user)
+    session.add(email)
+    session.commit()
+    email_id = email.id
+
+    res = client.get(f'/email/{email_id}')
+    assert res.json['status'] == 'pending'
+    etag = res.headers['ETag']
+    assert 'Last-Modified' not in res.headers
+
+    statements = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', count)
+    try:
+        res = client.get(f'/email/{email_id}',
+                         headers={'If-None-Match': etag})
+        assert res.status_code == 304
+        res = client.get(f'/email/{email_id}')
+        assert res.status_code == 200
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', count)
+    assert statements == []
+
+    # sending changes the row, the cached entry is dropped
+    delivery_queue.submit([email_id])
+    res = client.get(f'/email/{email_id}', headers={'If-None-Match': etag})
+    assert res.status_code == 200
+    assert res.json['status'] == 'sent'
+    assert res.headers['ETag'] != etag
+
+
+def test_user_cached(session, client):
+    user = EmailUser(email_address='cached@a.pl')
+    session.add(user)
+    session.commit()
+    res = client.get(f'/user/{user.id}')
+    assert res.json == 'cached@a.pl'
+    res = client.get(f'/user/{user.id}',
+                     headers={'If-None-Match': res.headers['ETag']})
+    assert res.status_code == 304
+    # only the body hash decides, not the time the cache was filled
+    res = client.get(f'/user/{user.id}',
+                     headers={'If-Modified-Since': res.headers['Date']})
+    assert res.status_code == 200
@@ -0,0 +1,168 @@
+import random
+import smtplib
+from datetime import datetime, timedelta
+
+import pytest
+
+from modules.database import Email, EmailUser, recipents_rels
+from modules.delivery import delivery_queue
+from modules.mime import MailMessage
+from modules.retry import is_temporary, retry_delay
+from modules.smtp import CircuitBreaker, CircuitOpenError, smtp_pool
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_retry_delay_grows_with_jitter():
+    rng = random.Random(1)
+    for attempts, full in [(1, 60), (2, 120), (3, 240), (10, 3600)]:
+        delays = [retry_delay(attempts, 60, 3600, rng) for _ in range(50)]
+        assert all(full / 2 <= delay <= full for delay in delays)
+        assert len(set(delays)) > 1
+
+
+def test_temporary_errors():
+    assert is_temporary(ConnectionRefusedError())
+    assert is_temporary(CircuitOpenError())
+    assert is_temporary(smtplib.SMTPSenderRefused(451, b'later', 'a@a.pl'))
+    assert not is_temporary(smtplib.SMTPDataError(554, b'rejected'))
+    assert not is_temporary(ValueError())
+
+
+def test_breaker_opens_and_probes():
+    clock = Clock()
+    breaker = CircuitBreaker(2, 30, clock=clock)
+    breaker.before_call()
+    breaker.record_failure()
+    assert breaker.state == 'closed'
+    breaker.record_failure()
+    assert breaker.state == 'open'
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+    clock.now = 30
+    breaker.before_call()  # probe
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()  # only one probe at a time
+    breaker.record_failure()
+    assert breaker.state == 'open'
+
+    clock.now = 60
+    breaker.before_call()
+    breaker.record_success()
+    assert breaker.state == 'closed'
+    breaker.before_call()
+
+
+def test_breaker_fails_fast_when_relay_is_down(smtp_app, smtp_server):
+    smtp_server.stop()
+    threshold = smtp_app.config['SMTP_BREAKER_THRESHOLD']
+    msg = MailMessage(subject='subject',
+                      recipients=['a@a.pl'],
+                      body='body',
+                      sender='sender@a.pl')
+    for _ in range(threshold):
+        with pytest.raises(OSError):
+            smtp_pool.send(msg)
+    with pytest.raises(CircuitOpenError):
+        smtp_pool.send(msg)
+    assert smtp_pool.stats()['circuit']['state'] == 'open'
+
+
+def recipent_statuses(session, email_id):
+    rows = session.query(EmailUser.email_address,
+                         recipents_rels.c.status).join(
+                             recipents_rels,
+                             recipents_rels.c.recipent_id == EmailUser.id
+                         ).filter(recipents_rels.c.email_id == email_id)
+    return dict(rows)
+
+
+def make_pending_email(session):
+    users = [
+        EmailUser(email_address=address)
+        for address in ('sender@a.pl', 'ok@a.pl', 'busy@b.pl')
+    ]
+    session.add_all(users)
+    email = Email(subject='subject', message='body', status='pending')
+    email.sender = users[0]
+    email.recipents.extend(users[1:])
+    session.add(email)
+    session.commit()
+    return email
+
+
+def make_due(session, email):
+    Email.query.filter_by(id=email.id).update(
+        {'next_attempt_at': datetime.utcnow() - timedelta(seconds=1)})
+    session.commit()
+
+
+def test_deferred_recipent_is_retried_alone(session, stub_mail):
+    stub_mail.deferred.add('busy@b.pl')
+    email = make_pending_email(session)
+
+    job = delivery_queue.submit()
+    assert job.serialize()['deferred'] == 1
+    email = Email.query.get(email.id)
+    assert (email.status, email.attempts) == ('pending', 1)
+    assert email.next_attempt_at > datetime.utcnow()
+    assert recipent_statuses(session, email.id) == {
+        'ok@a.pl': 'sent',
+        'busy@b.pl': 'pending'
+    }
+    # not due yet
+    assert delivery_queue.submit() is None
+
+    stub_mail.deferred.clear()
+    make_due(session, email)
+    delivery_queue.submit()
+    assert Email.query.get(email.id).status == 'sent'
+    assert [message['rcpt'] for message in stub_mail.messages
+            ] == [['<ok@a.pl>'], ['<busy@b.pl>']]
+
+
+def test_dead_after_max_attempts(app, session, stub_mail, monkeypatch):
+    monkeypatch.setitem(app.config, 'DELIVERY_MAX_ATTEMPTS', 2)
+    stub_mail.deferred.add('busy@b.pl')
+    email = make_pending_email(session)
+
+    delivery_queue.submit()
+    make_due(session, email)
+    delivery_queue.submit()
+    email = Email.query.get(email.id)
+    assert (email.status, email.attempts) == ('dead', 2)
+    assert email.next_attempt_at is None
+    assert recipent_statuses(session, email.id) == {
+        'ok@a.pl': 'sent',
+        'busy@b.pl': 'failed'
+    }
+
+
+def test_send_now_keeps_refused_and_deferred_recipents(session, client,
+                                                       stub_mail):
+    stub_mail.refused.add('gone@b.pl')
+    stub_mail.deferred.add('busy@b.pl')
+    res = client.post('/email',
+                      json={
+                          'message': 'body',
+                          'subject': 'subject',
+                          'sender_email': 'sender@a.pl',
+                          'receipents_emails': 'ok@a.pl,gone@b.pl,busy@b.pl',
+                          'send_now': True
+                      })
+    assert res.json['status'] == 'pending'
+    email = Email.query.get(res.json['id'])
+    assert email.attempts == 1
+    assert email.next_attempt_at > datetime.utcnow()
+    assert recipent_statuses(session, email.id) == {
+        'ok@a.pl': 'sent',
+        'gone@b.pl': 'failed',
+        'busy@b.pl': 'pending'
+    }
@@ -0,0 +1,55 @@
+from modules.database import Email, EmailUser
+from modules.delivery import delivery_queue
+from modules.extensions import mail
+from modules.scheduler import DomainThrottle, PriorityScheduler
+
+
+def test_plan_follows_weights():
+    scheduler = PriorityScheduler()
+    assert scheduler.plan(31) == {1: 16, 2: 8, 3: 4, 4: 2, 5: 1}
+
+
+def test_lowest_priority_is_not_starved():
+    scheduler = PriorityScheduler({1: 100})
+    batches = [scheduler.plan(10) for _ in range(20)]
+    assert sum(batch[5] for batch in batches) > 0
+
+
+def test_throttle_limits_domain():
+    throttle = DomainThrottle({'slow.pl': (10, 2)})
+    assert throttle.try_acquire({'slow.pl'}) == 0
+    assert throttle.try_acquire({'SLOW.pl', 'fast.pl'}) == 0
+    wait = throttle.try_acquire({'slow.pl', 'fast.pl'})
+    assert 0 < wait <= 0.1
+    # unlimited domains are never throttled
+    for _ in range(100):
+        assert throttle.try_acquire({'fast.pl'}) == 0
+
+
+def test_pending_sent_by_priority(app, session, client):
+    user = EmailUser(email_address='user@a.pl')
+    session.add(user)
+    session.commit()
+    for i in range(10):
+        email = Email(subject='newsletter', status='pending', priority=5)
+        email.sender = user
+        email.recipents.append(user)
+        session.add(email)
+    for i in range(3):
+        email = Email(subject='password reset', status='pending', priority=1)
+        email.sender = user
+        email.recipents.append(user)
+        session.add(email)
+    session.commit()
+
+    app.config['DELIVERY_BATCH_SIZE'] = 4
+    delivery_queue.init_app(app)
+    try:
+        with mail.record_messages() as outbox:
+            job = delivery_queue.submit()
+    finally:
+        app.config['DELIVERY_BATCH_SIZE'] = 100
+        delivery_queue.init_app(app)
+
+    assert job.sent == 13
+    assert [msg.subject for msg in outbox[:3]] == ['password reset'] * 3
@@ -0,0 +1,86 @@
+from datetime import datetime, timedelta
+
+from modules.database import Email, EmailUser
+
+
+def make_emails(session):
+    alice = EmailUser(email_address='alice@a.pl')
+    bob = EmailUser(email_address='bob@a.pl')
+    session.add_all([alice, bob])
+    emails = [
+        Email(subject='Invoice for March',
+              message='your invoice is attached',
+              status='sent',
+              sender=alice),
+        Email(subject='Lunch',
+              message='invoice? no, lunch',
+              status='pending',
+              sender=alice),
+        Email(subject='Invoice reminder',
+              message='please pay the invoice',
+              status='sent',
+              sender=bob,
+              pub_date=datetime.utcnow() - timedelta(days=10)),
+        Email(subject='Holiday', message='see you', status='sent',
+              sender=bob),
+    ]
+    session.add_all(emails)
+    session.commit()
+    return alice, bob, [email.id for email in emails]
+
+
+def search(client, **params):
+    res = client.get('/emails/search', query_string=params)
+    assert res.status_code == 200, res.json
+    return res
+
+
+def test_search_ranked_and_filtered(session, client):
+    alice, bob, ids = make_emails(session)
+
+    res = search(client, q='invoice')
+    found = [row['id'] for row in res.json]
+    assert set(found) == set(ids[:3])
+    assert found[-1] == ids[1]  # only in the message, ranked last
+    assert '[invoice]' in res.json[0]['snippet'].lower()
+
+    assert {row['id']
+            for row in search(client, q='invoice', status='sent').json
+            } == {ids[0], ids[2]}
+    assert {row['id']
+            for row in search(client, q='invoice', sender=bob.id).json
+            } == {ids[2]}
+    since = (datetime.utcnow() - timedelta(days=1)).isoformat()
+    assert {row['id']
+            for row in search(client, q='invoice', since=since).json
+            } == {ids[0], ids[1]}
+
+
+def test_search_pages_and_follows_updates(session, client):
+    _, _, ids = make_emails(session)
+
+    first = search(client, q='invoice', limit=2)
+    assert len(first.json) == 2
+    second = search(client,
+                    q='invoice',
+                    limit=2,
+                    cursor=first.headers['X-Next-Cursor'])
+    assert 'X-Next-Cursor' not in second.headers
+    assert {row['id']
+            for row in first.json + second.json} == set(ids[:3])
+
+    holiday = Email.query.get(ids[3])
+    holiday.subject = 'Holiday invoice'
+    session.commit()
+    assert ids[3] in {row['id'] for row in search(client, q='invoice').json}
+    session.delete(holiday)
+    session.commit()
+    assert ids[3] not in {
+        row['id']
+        for row in search(client, q='invoice').json
+    }
+
+
+def test_search_bad_query(session, client):
+    res = client.get('/emails/search', query_string={'q': '"unbalanced'})
+    assert 'q' in res.json['errors']
@@ -0,0 +1,45 @@
+from flask_mail import Message
+
+from modules.smtp import smtp_pool
+
+
+def make_message(i=0):
+    return Message(subject=f'subject {i}',
+                   recipients=['recipent@a.pl'],
+                   body='body')
+
+
+def test_pool_reuses_connection(smtp_app, smtp_server):
+    for i in range(10):
+        smtp_pool.send(make_message(i))
+    assert len(smtp_server.messages) == 10
+    assert smtp_server.connections == 1
+    stats = smtp_pool.stats()
+    assert stats['messages'] == 10
+    assert stats['connects'] == 1
+    assert stats['messages_per_second'] > 0
+
+
+def test_pool_reconnects_after_max_emails(smtp_app, smtp_server):
+    smtp_app.extensions['mail'].max_emails = 4
+    for i in range(10):
+        smtp_pool.send(make_message(i))
+    assert len(smtp_server.messages) == 10
+    assert smtp_server.connections == 3
+
+
+def test_pool_reconnects_when_server_drops_connection(smtp_app, smtp_server):
+    smtp_pool.send(make_message())
+    smtp_server.drop_connections()
+    smtp_pool.send(make_message())
+    assert len(smtp_server.messages) == 2
+    assert smtp_server.connections == 2
+    assert smtp_pool.stats()['reconnects'] == 1
+
+
+def test_pool_disabled_connects_per_message(smtp_app, smtp_server):
+    smtp_app.config['SMTP_POOL_SIZE'] = 0
+    smtp_pool.init_app(smtp_app)
+    for i in range(3):
+        smtp_pool.send(make_message(i))
+    assert smtp_server.connections == 3
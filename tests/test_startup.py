@@ -0,0 +1,51 @@
+import sqlite3
+
+from application import create_app
+from modules import prefork
+from modules.migrations import MIGRATIONS, migrate_db_command
+
+
+def table_names(path):
+    conn = sqlite3.connect(str(path))
+    try:
+        return {
+            row[0]
+            for row in conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table'")
+        }
+    finally:
+        conn.close()
+
+
+def test_schema_setup_disabled(tmp_path):
+    path = tmp_path / 'database.db'
+    app = create_app(test_config={
+        'TESTING': True,
+        'SQLALCHEMY_DATABASE_URI': f'sqlite:///{path}',
+        'SCHEMA_SETUP': False
+    })
+    assert 'email' not in table_names(path)
+    assert '/email' in {rule.rule for rule in app.url_map.iter_rules()}
+
+    result = app.test_cli_runner().invoke(migrate_db_command)
+    assert result.exit_code == 0, result.output
+    assert {'email', 'email_user', 'email_search'} <= table_names(path)
+    conn = sqlite3.connect(str(path))
+    assert conn.execute(
+        'PRAGMA user_version').fetchone()[0] == MIGRATIONS[-1][0]
+    conn.close()
+
+
+def test_reset_after_fork(app):
+    smtp_state = app.extensions['smtp_pool']
+    delivery_state = app.extensions['delivery']
+    sentinel = object()
+    if smtp_state.idle is not None:
+        smtp_state.idle.put(sentinel)
+    delivery_state.executor = sentinel
+
+    prefork.reset_after_fork()
+
+    assert app.extensions['delivery'].executor is None
+    assert smtp_state.idle is None or smtp_state.idle.empty()
+    assert app.extensions['render_pool'].executor is None
@@ -0,0 +1,75 @@
+import threading
+
+import pytest
+from sqlalchemy.pool import QueuePool
+
+from application import create_app
+from modules.database import Email, EmailUser
+from modules.delivery import delivery_queue
+from modules.extensions import db
+from modules.storage import dispose_engines
+
+
+@pytest.fixture
+def production_app(tmp_path):
+    app = create_app(
+        test_config={
+            'TESTING': True,
+            'SQLALCHEMY_DATABASE_URI': f'sqlite:///{tmp_path}/prod.db',
+            'SQLITE_PROFILE': 'production',
+            'MAIL_SUPPRESS_SEND': True,
+            'DELIVERY_WORKERS': 0,
+            'DELIVERY_GROUP_COMMIT': True,
+            'DELIVERY_GROUP_COMMIT_WINDOW': 0.2
+        })
+    ctx = app.app_context()
+    ctx.push()
+    yield app
+    db.session.remove()
+    ctx.pop()
+
+
+def test_production_profile(production_app):
+    engine = db.get_engine(production_app)
+    assert isinstance(engine.pool, QueuePool)
+    with engine.connect() as conn:
+        assert conn.execute('PRAGMA journal_mode').scalar() == 'wal'
+        assert conn.execute('PRAGMA synchronous').scalar() == 1  # NORMAL
+        assert conn.execute('PRAGMA busy_timeout').scalar() == 5000
+    dispose_engines()
+    assert engine.pool.checkedin() == 0
+
+
+def test_group_commit(production_app):
+    user = EmailUser(email_address='group@a.pl')
+    db.session.add(user)
+    db.session.commit()
+    for _ in range(4):
+        email = Email(subject='group', status='pending')
+        email.sender = user
+        email.recipents.append(user)
+        db.session.add(email)
+    db.session.commit()
+    email_ids = [email_id for email_id, in db.session.query(Email.id)]
+
+    jobs = []
+
+    def send(email_id):
+        with production_app.app_context():
+            jobs.append(delivery_queue.submit([email_id]))
+            db.session.remove()
+
+    threads = [
+        threading.Thread(target=send, args=(email_id, ))
+        for email_id in email_ids
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(job.sent for job in jobs) == [1] * 4
+    # four sending threads, their statuses committed together
+    assert delivery_queue.state.committer.commits < 4
+    db.session.expire_all()
+    assert {email.status for email in Email.query} == {'sent'}